@@ -11,8 +11,10 @@ import os
 import re
 
 
-def loadNCSCLibrary():
-    library_filename = "ncs"
+def loadNCSCLibrary(library_filename = "ncs"):
+    """
+    library_filename is "ncs", or "ncsf" for the single precision library.
+    """
 
     #
     # This assumes that the C libraries are in this directory.
@@ -2,7 +2,8 @@
  * C library for "Noise Correction Algorithm for sCMOS cameras".
  *
  * Notes: 
- *  1. We assume that lbfgsfloat_val is a double.
+ *  1. We assume that lbfgsfloat_val is the same type as ncsfloat,
+ *     a double, or a float when built with NCS_FLOAT defined.
  *  2. The input image should be corrected for gain and offset and
  *     also have had any negative values removed. For example any
  *     values less than 1.0 are set to 1.0.
@@ -16,134 +17,942 @@
 #include <math.h>
 
 #include <fftw3.h>
+
+#ifdef NCS_FLOAT
+#define LBFGS_FLOAT 32
+#endif
 #include <lbfgs.h>
 
+#ifdef _OPENMP
+#include <omp.h>
+#endif
+
 #include "ncs.h"
 
 
+static int ncsSRProgress(void *, const lbfgsfloatval_t *, const lbfgsfloatval_t *,
+			 const lbfgsfloatval_t, const lbfgsfloatval_t, const lbfgsfloatval_t,
+			 const lbfgsfloatval_t, int, int, int);
+static int ncsSRStarts(int *, int, int);
+
+/* FFTW planner flags, see ncsFFTWSetFlags(). */
+static unsigned ncs_fftw_flags = FFTW_ESTIMATE;
+
+
 /*
- * ncsReduceNoise() 
+ * ncsContextCleanup()
  *
- * Run NCS noise reduction on an image.
- * 
- * Note: Any zero or negative values in the image should be
- *       set to a small positive value like 1.0.
+ * Free the sub-regions and other storage of a ncsContext.
+ *
+ * context - Pointer to a ncsContext structure.
+ */
+void ncsContextCleanup(ncsContext *context)
+{
+  int i;
+
+  for(i=0;i<context->threads;i++){
+    ncsSRCleanup(context->ncs_srs[i]);
+  }
+  free(context->ncs_srs);
+  free(context->gamma);
+  free(context->starts_x);
+  free(context->starts_y);
+  free(context);
+}
+
+
+/*
+ * ncsContextInitialize()
+ *
+ * Set up to run NCS on im_x x im_y images in r_size sub-regions with
+ * threads threads, each with its own ncsSubRegion. The sub-regions are
+ * created here as FFTW planning is not thread safe.
  *
- * ncs_image - Pre-allocated storage for the NCS image.
- * image - Original image in e-.
- * gamma - CMOS variance in units of e-^2.
- * otf_mask - r_size x r_size array containing the OTF mask.
- * alpha - NCS alpha term. 
  * im_x - Image size (slow axis). 
  * im_y - Image size (fast axis).
- * r_size - otf_mask size.
+ * r_size - Sub-region size, the OTF mask size.
+ * threads - Number of threads.
+ *
+ * Returns a pointer to a ncsContext structure, or NULL if r_size is
+ * not divisible by 2.
  */
-void ncsReduceNoise(double *ncs_image,
-		    double *image,
-		    double *gamma,
-		    double *otf_mask,
-		    double alpha,
-		    int im_x,
-		    int im_y,
-		    int r_size)
+ncsContext *ncsContextInitialize(int im_x, int im_y, int r_size, int threads)
 {
-  int i,j,k,l,m,n,o,p;
-  int bx,by,res,s_size;
-  ncsSubRegion *ncs_sr;
-  
+  int i,s_size;
+  ncsContext *context;
+
   /* Check OTF mask size. */
   if((r_size%2)!=0){
     printf("OTF mask size of %d is not divisible by 2!", r_size);
-    return;
+    return NULL;
   }
 
-  s_size = r_size - 2;
-  
-  /* Initialization. */
-  ncs_sr = ncsSRInitialize(r_size);
-  ncsSRSetOTFMask(ncs_sr, otf_mask);
+  if(threads<1){
+    threads = 1;
+  }
+
+  context = (ncsContext *)malloc(sizeof(ncsContext));
 
+  context->im_x = im_x;
+  context->im_y = im_y;
+  context->r_size = r_size;
+  context->threads = threads;
+
+  context->gamma = (ncsfloat *)malloc(sizeof(ncsfloat)*im_x*im_y);
+  for(i=0;i<(im_x*im_y);i++){
+    context->gamma[i] = 0.0;
+  }
+  
   /*
    * This is somewhat complicated by the goal of using a 1 pixel
    * pad around each sub region, and also using duplicate values
-   * for sub regions that are on the edge of the image.
+   * for sub regions that are on the edge of the image. The last
+   * sub-region along each axis is moved back to fit in the image,
+   * so it overlaps the one before it.
    */
-  for(i=-1;i<(im_x+1);i+=s_size){
-    if((i+r_size)>(im_x+1)){
-      bx = im_x + 1 - r_size;
+  s_size = r_size - 2;
+  context->starts_x = (int *)malloc(sizeof(int)*((im_x+1)/s_size + 2));
+  context->starts_y = (int *)malloc(sizeof(int)*((im_y+1)/s_size + 2));
+  context->n_x = ncsSRStarts(context->starts_x, im_x, r_size);
+  context->n_y = ncsSRStarts(context->starts_y, im_y, r_size);
+
+  context->ncs_srs = (ncsSubRegion **)malloc(sizeof(ncsSubRegion *)*threads);
+  for(i=0;i<threads;i++){
+    context->ncs_srs[i] = ncsSRInitialize(r_size);
+  }
+
+  return context;
+}
+
+
+/*
+ * ncsContextReduceNoise()
+ *
+ * Run NCS noise reduction on a stack of images, with the sub-regions
+ * of all the images spread over the threads of the context. The result
+ * is the same for any number of threads, as each sub-region only writes
+ * the pixels that a serial loop would have left to it. Without OpenMP
+ * support the sub-regions are done serially.
+ *
+ * Note: Any zero or negative values in the images should be
+ *       set to a small positive value like 1.0.
+ *
+ * context - Pointer to a ncsContext structure.
+ * ncs_images - Pre-allocated storage for the NCS images.
+ * images - n_frames x im_x x im_y original images in e-.
+ * u_inits - Initial estimates, the same size as images. This can be
+ *           images to start from the images.
+ * alpha - NCS alpha term. 
+ * n_frames - Number of images.
+ * bg_iterations - Maximum iterations for background sub-regions, as
+ *                 for ncsReduceNoiseFromU().
+ */
+void ncsContextReduceNoise(ncsContext *context,
+			   ncsfloat *ncs_images,
+			   ncsfloat *images,
+			   ncsfloat *u_inits,
+			   double alpha,
+			   int n_frames,
+			   int bg_iterations)
+{
+  int i,im_x,im_y,n_x,n_y,r_size;
+  int *starts_x,*starts_y;
+  ncsfloat *gamma;
+  ncsSubRegion **ncs_srs;
+
+  im_x = context->im_x;
+  im_y = context->im_y;
+  n_x = context->n_x;
+  n_y = context->n_y;
+  r_size = context->r_size;
+  starts_x = context->starts_x;
+  starts_y = context->starts_y;
+  gamma = context->gamma;
+  ncs_srs = context->ncs_srs;
+  
+#ifdef _OPENMP
+#pragma omp parallel for num_threads(context->threads) schedule(dynamic)
+#endif
+  for(i=0;i<(n_frames*n_x*n_y);i++){
+    int bx,by,j,k,l,m,n,o,p,res,x_end,y_end;
+    ncsfloat *image,*ncs_image,*u_init;
+    ncsSubRegion *ncs_sr;
+
+#ifdef _OPENMP
+    ncs_sr = ncs_srs[omp_get_thread_num()];
+#else
+    ncs_sr = ncs_srs[0];
+#endif
+    
+    /* Sub-region j of image i/(n_x*n_y). */
+    j = i%(n_x*n_y);
+    image = images + (i/(n_x*n_y))*im_x*im_y;
+    ncs_image = ncs_images + (i/(n_x*n_y))*im_x*im_y;
+    u_init = u_inits + (i/(n_x*n_y))*im_x*im_y;
+    
+    bx = starts_x[j/n_y];
+    by = starts_y[j%n_y];
+
+    /* 
+     * Copy results up to where the next sub-region starts, the 
+     * serial loop would overwrite the rest with its values.
+     */
+    x_end = r_size - 1;
+    if((j/n_y)<(n_x-1)){
+      x_end = starts_x[j/n_y+1] + 1 - bx;
     }
-    else{
-      bx = i;
+    y_end = r_size - 1;
+    if((j%n_y)<(n_y-1)){
+      y_end = starts_y[j%n_y+1] + 1 - by;
     }
     
-    for(j=-1;j<(im_y+1);j+=s_size){
-      if((j+r_size)>(im_y+1)){
-	by = im_y + 1 - r_size;
+    /* Copy sub-region. */
+    for(k=0;k<r_size;k++){
+      if((k + bx) < 0){
+	l = 0;
+      }
+      else if((k + bx)>=im_x){
+	l = (im_x - 1)*im_y;
       }
       else{
-	by = j;
+	l = (k + bx)*im_y;
       }
-
-      /* Copy sub-region. */
-      for(k=0;k<r_size;k++){
-	if((k + bx) < 0){
-	  l = 0;
+      m = k*r_size;
+      for(n=0;n<r_size;n++){
+	if((n + by) < 0){
+	  o = l;
 	}
-	else if((k + bx)>=im_x){
-	  l = (im_x - 1)*im_y;
+	else if((n + by)>=im_y){
+	  o = l + im_y - 1;
 	}
 	else{
-	  l = (k + bx)*im_y;
-	}
-	m = k*r_size;
-	for(n=0;n<r_size;n++){
-	  if((n + by) < 0){
-	    o = l;
-	  }
-	  else if((n + by)>=im_y){
-	    o = l + im_y - 1;
-	  }
-	  else{
-	    o = l + n + by;
-	  }
-	  p = m + n;
-	  ncs_sr->data[p] = image[o];
-	  ncs_sr->gamma[p] = gamma[o];
+	  o = l + n + by;
 	}
+	p = m + n;
+	ncs_sr->data[p] = image[o];
+	ncs_sr->gamma[p] = gamma[o];
+	ncs_sr->u[p] = u_init[o];
       }
+    }
       
-      /* Solve. */
-      res = ncsSRSolve(ncs_sr, alpha, 0);
-      if(res!=0){
-	printf("NCS solver failed on region %d %d with code %d!\n",bx,by,res);
-      }
-      
-      /* Copy results. */
-      for(k=1;k<(r_size-1);k++){
-	l = (k + bx)*im_y;
-	m = k*r_size;
-	for(n=1;n<(r_size-1);n++){
-	  o = l + n + by;
-	  p = m + n;
-	  ncs_image[o] = ncs_sr->u[p];
+    /* Solve. */
+    if((bg_iterations >= 0) && ncsSRIsBackground(ncs_sr)){
+      ncsSRBackgroundU(ncs_sr, alpha);
+      res = 0;
+      if(bg_iterations > 0){
+	m = ncs_sr->param->max_iterations;
+	ncs_sr->param->max_iterations = bg_iterations;
+	res = ncsSRSolveFromU(ncs_sr, alpha, 0);
+	ncs_sr->param->max_iterations = m;
+	if(res == LBFGSERR_MAXIMUMITERATION){
+	  res = 0;
 	}
       }
+    }
+    else{
+      res = ncsSRSolveFromU(ncs_sr, alpha, 0);
+    }
+    if(res!=0){
+      printf("NCS solver failed on region %d %d with code %d!\n",bx,by,res);
+    }
       
-      /* 
-       * This keeps us from analyzing the outer edge twice, which
-       * can happen depending the values of s_size and im_y.
-       */
-      if(by == im_y + 1 - r_size){
-	break;
+    /* Copy results. */
+    for(k=1;k<x_end;k++){
+      l = (k + bx)*im_y;
+      m = k*r_size;
+      for(n=1;n<y_end;n++){
+	o = l + n + by;
+	p = m + n;
+	ncs_image[o] = ncs_sr->u[p];
       }
     }
-    if(bx == im_x + 1 - r_size){
-      break;
+  }
+}
+
+
+/*
+ * ncsContextSetGamma()
+ *
+ * Set the CMOS variance for the images, which is copied.
+ *
+ * context - Pointer to a ncsContext structure.
+ * gamma - CMOS variance in units of e-^2, im_x x im_y.
+ */
+void ncsContextSetGamma(ncsContext *context, ncsfloat *gamma)
+{
+  int i;
+  
+  for(i=0;i<(context->im_x*context->im_y);i++){
+    context->gamma[i] = gamma[i];
+  }
+}
+
+
+/*
+ * ncsContextSetOTFMask()
+ *
+ * Set the OTF mask of all the sub-regions.
+ *
+ * context - Pointer to a ncsContext structure.
+ * otf_mask - r_size x r_size array containing the OTF mask.
+ */
+void ncsContextSetOTFMask(ncsContext *context, ncsfloat *otf_mask)
+{
+  int i;
+
+  for(i=0;i<context->threads;i++){
+    ncsSRSetOTFMask(context->ncs_srs[i], otf_mask);
+  }
+}
+
+
+/*
+ * ncsFFTWExportWisdom()
+ *
+ * Save the FFTW wisdom, what FFTW has learned about the fastest plans
+ * so far, to a file. Importing it in a later session saves the planning
+ * time of FFTW_MEASURE or FFTW_PATIENT.
+ *
+ * filename - The wisdom file.
+ *
+ * Returns 1 on success.
+ */
+int ncsFFTWExportWisdom(const char *filename)
+{
+  return NCS_FFTW(export_wisdom_to_filename)(filename);
+}
+
+
+/*
+ * ncsFFTWImportWisdom()
+ *
+ * Add the FFTW wisdom in a file to the wisdom of this session.
+ *
+ * filename - The wisdom file.
+ *
+ * Returns 1 on success.
+ */
+int ncsFFTWImportWisdom(const char *filename)
+{
+  return NCS_FFTW(import_wisdom_from_filename)(filename);
+}
+
+
+/*
+ * ncsFFTWSetFlags()
+ *
+ * Set the FFTW planner flags for the sub-regions and frames that are
+ * initialized after this call. The default is FFTW_ESTIMATE, which plans
+ * quickly. FFTW_MEASURE or FFTW_PATIENT find faster plans by timing
+ * them, which takes a while the first time a size is planned. After
+ * that FFTW remembers the plan (its wisdom) for the rest of the session,
+ * so each new sub-region or call to ncsReduceNoise() only pays for a
+ * look up.
+ *
+ * flags - FFTW planner flags.
+ */
+void ncsFFTWSetFlags(unsigned flags)
+{
+  ncs_fftw_flags = flags;
+}
+
+
+/*
+ * ncsFrameCalcCostGradient()
+ *
+ * Calculate the cost (log-likelihood plus alpha times the noise
+ * contribution) and its gradient with current u, data and gamma.
+ *
+ * The noise contribution uses the half spectrum of the real FFT. The
+ * weights (see ncsFrameSetOTFMask()) count each bin that stands for a
+ * pair of conjugate bins twice, so there is no need to unfold it.
+ *
+ * frame - Pointer to a ncsFrame structure.
+ * alpha - NCS alpha term.
+ * gradient - Pre-allocated storage for the gradient (of size f_x x f_y).
+ */
+double ncsFrameCalcCostGradient(ncsFrame *frame, double alpha, ncsfloat *gradient)
+{
+  int i,n;
+  double ll,nc,t1,t2;
+
+  n = frame->f_x*frame->f_y;
+
+  /* Noise contribution. */
+  NCS_FFTW(execute)(frame->fft_forward);
+
+  nc = 0.0;
+  for(i=0;i<(frame->f_x*frame->fft_size);i++){
+    t1 = frame->u_fft[i][0]*frame->u_fft[i][0] + frame->u_fft[i][1]*frame->u_fft[i][1];
+    nc += t1*frame->nc_weights[i];
+
+    t2 = 2.0*frame->otf_mask_sqr[i];
+    frame->g_fft[i][0] = frame->u_fft[i][0]*t2;
+    frame->g_fft[i][1] = frame->u_fft[i][1]*t2;
+  }
+  
+  NCS_FFTW(execute)(frame->fft_backward);
+
+  /* Log-likelihood and total gradient. */
+  ll = 0.0;
+  for(i=0;i<n;i++){
+    t1 = frame->data[i] + frame->gamma[i];
+    t2 = frame->u[i] + frame->gamma[i];
+
+    /* Negative values guard. */
+    if(t2 < 1.0e-6){
+      t2 = 1.0e-6;
+    }
+
+    ll += frame->u[i] - t1*log(t2);
+    gradient[i] = 1.0 - t1/t2 + alpha*frame->g[i]*frame->normalization;
+  }
+
+  return ll + alpha*nc*frame->normalization;
+}
+
+
+/*
+ * ncsFrameCleanup()
+ *
+ * frame - Pointer to ncsFrame structure.
+ */
+void ncsFrameCleanup(ncsFrame *frame)
+{
+  free(frame->data);
+  free(frame->gamma);
+  free(frame->nc_weights);
+  free(frame->otf_mask_sqr);
+
+  lbfgs_free(frame->u);
+
+  NCS_FFTW(destroy_plan)(frame->fft_backward);
+  NCS_FFTW(destroy_plan)(frame->fft_forward);
+
+  NCS_FFTW(free)(frame->g);
+  NCS_FFTW(free)(frame->g_fft);
+  NCS_FFTW(free)(frame->u_fft);
+
+  free(frame->param);
+  
+  free(frame);
+}
+
+
+/*
+ * ncsFrameEvaluate()
+ *
+ * Callback for solver updates, used by L-BFGS method.
+ */
+static lbfgsfloatval_t ncsFrameEvaluate(void *instance,
+					const lbfgsfloatval_t *x,
+					lbfgsfloatval_t *g,
+					const int n,
+					const lbfgsfloatval_t step)
+{
+  ncsFrame *frame;
+
+  frame = (ncsFrame *)instance;
+  return ncsFrameCalcCostGradient(frame, frame->alpha, g) - frame->cost_offset;
+}
+
+
+/*
+ * ncsFrameGetU()
+ *
+ * Get the current u vector, usually would call this after ncsFrameSolve().
+ *
+ * frame - Pointer to ncsFrame structure.
+ * u - Pre-allocated storage for the u vector.
+ */
+void ncsFrameGetU(ncsFrame *frame, ncsfloat *u)
+{
+  int i;
+
+  for(i=0;i<(frame->f_x*frame->f_y);i++){
+    u[i] = frame->u[i];
+  }
+}
+
+
+/*
+ * ncsFrameInitialize()
+ *
+ * Set things up for NCS for a whole frame. The FFTs are fastest when 
+ * f_x and f_y only have small prime factors.
+ *
+ * f_x - Frame size (slow axis).
+ * f_y - Frame size (fast axis).
+ */
+ncsFrame *ncsFrameInitialize(int f_x, int f_y)
+{
+  int i,fft_size;
+  ncsFrame *frame;
+
+  frame = (ncsFrame *)malloc(sizeof(ncsFrame));
+
+  frame->f_x = f_x;
+  frame->f_y = f_y;
+  frame->alpha = 0.0;
+  frame->cost_offset = 0.0;
+
+  fft_size = f_y/2 + 1;
+  frame->fft_size = fft_size;
+  frame->normalization = 1.0/((double)(f_x*f_y));
+
+  frame->data = (ncsfloat *)malloc(sizeof(ncsfloat)*f_x*f_y);
+  frame->gamma = (ncsfloat *)malloc(sizeof(ncsfloat)*f_x*f_y);
+  frame->nc_weights = (ncsfloat *)malloc(sizeof(ncsfloat)*f_x*fft_size);
+  frame->otf_mask_sqr = (ncsfloat *)malloc(sizeof(ncsfloat)*f_x*fft_size);
+
+  frame->u = lbfgs_malloc(f_x*f_y);
+
+  for(i=0;i<(f_x*f_y);i++){
+    frame->data[i] = 0.0;
+    frame->gamma[i] = 0.0;
+    frame->u[i] = 0.0;
+  }
+  for(i=0;i<(f_x*fft_size);i++){
+    frame->nc_weights[i] = 0.0;
+    frame->otf_mask_sqr[i] = 0.0;
+  }
+
+  /* Backward FFT for NC gradient calculation. */
+  frame->g = (ncsfloat *)NCS_FFTW(malloc)(sizeof(ncsfloat)*f_x*f_y);
+  frame->g_fft = (NCS_FFTW(complex) *)NCS_FFTW(malloc)(sizeof(NCS_FFTW(complex))*f_x*fft_size);
+  frame->fft_backward = NCS_FFTW(plan_dft_c2r_2d)(f_x, f_y, frame->g_fft, (ncsfloat *)frame->g, ncs_fftw_flags);
+  
+  /* Forward FFT. */
+  frame->u_fft = (NCS_FFTW(complex) *)NCS_FFTW(malloc)(sizeof(NCS_FFTW(complex))*f_x*fft_size);
+  frame->fft_forward = NCS_FFTW(plan_dft_r2c_2d)(f_x, f_y, (ncsfloat *)frame->u, frame->u_fft, ncs_fftw_flags);
+
+  /* Planning with FFTW_MEASURE or slower overwrites u. */
+  for(i=0;i<(f_x*f_y);i++){
+    frame->u[i] = 0.0;
+  }
+
+  /* L-BFGS parameter initialization. */
+  frame->param = (lbfgs_parameter_t *)malloc(sizeof(lbfgs_parameter_t));
+  lbfgs_parameter_init(frame->param);
+  
+  return frame;
+}
+
+
+/*
+ * ncsFrameNewImage()
+ *
+ * Start analysis of a new frame.
+ *
+ * frame - Pointer to ncsFrame structure.
+ * image - The image (of size f_x x f_y).
+ * gamma - The CMOS variance (of size f_x x f_y).
+ */
+void ncsFrameNewImage(ncsFrame *frame, ncsfloat *image, ncsfloat *gamma)
+{
+  int i;
+  
+  for(i=0;i<(frame->f_x*frame->f_y);i++){
+    frame->data[i] = image[i];
+    frame->gamma[i] = gamma[i];
+  }
+}
+
+
+/*
+ * ncsFrameSetOTFMask()
+ *
+ * Initialize / change OTF mask. The mask is symmetrized, so that the
+ * gradient of the noise contribution is real, and cut down to the half
+ * spectrum of the real FFT.
+ *
+ * frame - Pointer to ncsFrame structure.
+ * otf_mask - f_x x f_y array containing the OTF mask (FFT order, i.e.
+ *            zero frequency at 0,0).
+ */
+void ncsFrameSetOTFMask(ncsFrame *frame, ncsfloat *otf_mask)
+{
+  int i,j,k,l,f_x,f_y,fft_size;
+  double t1,t2;
+
+  f_x = frame->f_x;
+  f_y = frame->f_y;
+  fft_size = frame->fft_size;
+  
+  for(i=0;i<f_x;i++){
+    for(j=0;j<fft_size;j++){
+      k = i*f_y + j;
+      l = ((f_x-i)%f_x)*f_y + (f_y-j)%f_y;
+      t1 = 0.5*(otf_mask[k]*otf_mask[k] + otf_mask[l]*otf_mask[l]);
+
+      /* Bins other than the zero and Nyquist frequencies are two bins. */
+      t2 = 2.0;
+      if((j==0)||((2*j)==f_y)){
+	t2 = 1.0;
+      }
+      
+      frame->otf_mask_sqr[i*fft_size+j] = t1;
+      frame->nc_weights[i*fft_size+j] = t1*t2;
     }
   }
+}
+
+
+/*
+ * ncsFrameSetU()
+ *
+ * Set the u vector, for example to an initial estimate.
+ *
+ * frame - Pointer to ncsFrame structure.
+ * u - The new u vector.
+ */
+void ncsFrameSetU(ncsFrame *frame, ncsfloat *u)
+{
+  int i;
+
+  for(i=0;i<(frame->f_x*frame->f_y);i++){
+    frame->u[i] = u[i];
+  }
+}
+
+
+/*
+ * ncsFrameSolve()
+ *
+ * Solve for optimal u using the L-BFGS algorithm, starting from the
+ * current u.
+ *
+ * frame - Pointer to a ncsFrame structure.
+ */
+int ncsFrameSolve(ncsFrame *frame, double alpha, int verbose)
+{
+  int ret;
+  lbfgsfloatval_t fx;
+#ifdef NCS_FLOAT
+  ncsfloat *gradient;
+#endif
   
+  frame->alpha = alpha;
+
+#ifdef NCS_FLOAT
+  /* See ncsSRSolveFromU(). */
+  gradient = (ncsfloat *)malloc(sizeof(ncsfloat)*frame->f_x*frame->f_y);
+  frame->cost_offset = ncsFrameCalcCostGradient(frame, alpha, gradient);
+  free(gradient);
+#endif
+
+  if (verbose){
+    ret = lbfgs(frame->f_x*frame->f_y, frame->u, &fx, ncsFrameEvaluate, ncsSRProgress, (void *)frame, frame->param);
+  }
+  else{
+    ret = lbfgs(frame->f_x*frame->f_y, frame->u, &fx, ncsFrameEvaluate, NULL, (void *)frame, frame->param);
+  }
+
+  return ret;
+}
+
+
+/*
+ * ncsReduceNoise() 
+ *
+ * Run NCS noise reduction on an image.
+ * 
+ * Note: Any zero or negative values in the image should be
+ *       set to a small positive value like 1.0.
+ *
+ * ncs_image - Pre-allocated storage for the NCS image.
+ * image - Original image in e-.
+ * gamma - CMOS variance in units of e-^2.
+ * otf_mask - r_size x r_size array containing the OTF mask.
+ * alpha - NCS alpha term. 
+ * im_x - Image size (slow axis). 
+ * im_y - Image size (fast axis).
+ * r_size - otf_mask size.
+ */
+void ncsReduceNoise(ncsfloat *ncs_image,
+		    ncsfloat *image,
+		    ncsfloat *gamma,
+		    ncsfloat *otf_mask,
+		    double alpha,
+		    int im_x,
+		    int im_y,
+		    int r_size)
+{
+  ncsReduceNoiseFromU(ncs_image, image, image, gamma, otf_mask, alpha, im_x, im_y, r_size, -1);
+}
+
+
+/*
+ * ncsReduceNoiseFrame() 
+ *
+ * Run NCS noise reduction on an image as a whole, instead of in
+ * sub-regions. The image is placed in a larger frame, with a 1 pixel
+ * offset and its edge values duplicated out to the frame size, and the
+ * frame is solved with one real FFT per cost evaluation. This avoids
+ * the sub-region seams, but for large images the solver needs more
+ * iterations than it does for a sub-region.
+ *
+ * Note: Any zero or negative values in the image should be
+ *       set to a small positive value like 1.0.
+ *
+ * ncs_image - Pre-allocated storage for the NCS image.
+ * image - Original image in e-.
+ * gamma - CMOS variance in units of e-^2.
+ * otf_mask - f_x x f_y array containing the OTF mask.
+ * alpha - NCS alpha term. 
+ * im_x - Image size (slow axis). 
+ * im_y - Image size (fast axis).
+ * f_x - Frame size (slow axis), at least im_x + 2.
+ * f_y - Frame size (fast axis), at least im_y + 2.
+ *
+ * Returns the L-BFGS status.
+ */
+int ncsReduceNoiseFrame(ncsfloat *ncs_image,
+			ncsfloat *image,
+			ncsfloat *gamma,
+			ncsfloat *otf_mask,
+			double alpha,
+			int im_x,
+			int im_y,
+			int f_x,
+			int f_y)
+{
+  int i,j,k,l,ret;
+  ncsFrame *frame;
+
+  /* Check frame size. */
+  if((f_x<(im_x+2))||(f_y<(im_y+2))){
+    printf("Frame size %d x %d is too small for a %d x %d image!", f_x, f_y, im_x, im_y);
+    return -1;
+  }
+
+  /* Initialization. */
+  frame = ncsFrameInitialize(f_x, f_y);
+  ncsFrameSetOTFMask(frame, otf_mask);
+
+  /* Copy image, duplicating the edge values. */
+  for(i=0;i<f_x;i++){
+    k = i-1;
+    if(k<0){
+      k = 0;
+    }
+    else if(k>=im_x){
+      k = im_x-1;
+    }
+    for(j=0;j<f_y;j++){
+      l = j-1;
+      if(l<0){
+	l = 0;
+      }
+      else if(l>=im_y){
+	l = im_y-1;
+      }
+      frame->data[i*f_y+j] = image[k*im_y+l];
+      frame->gamma[i*f_y+j] = gamma[k*im_y+l];
+      frame->u[i*f_y+j] = image[k*im_y+l];
+    }
+  }
+
+  /* Solve. */
+  ret = ncsFrameSolve(frame, alpha, 0);
+
+  /* Copy results. */
+  for(i=0;i<im_x;i++){
+    for(j=0;j<im_y;j++){
+      ncs_image[i*im_y+j] = frame->u[(i+1)*f_y+j+1];
+    }
+  }
+
   /* Clean up. */
-  ncsSRCleanup(ncs_sr);
+  ncsFrameCleanup(frame);
+
+  return ret;
+}
+
+
+/*
+ * ncsReduceNoiseFromU() 
+ *
+ * Run NCS noise reduction on an image, starting the solver from an
+ * initial estimate instead of from the image. For time-lapse data
+ * this could be the NCS image of the previous frame. As with the image
+ * any zero or negative values in u_init should be set to a small
+ * positive value.
+ *
+ * Sub-regions that look like pure background (see ncsSRIsBackground())
+ * can take a fast path. They start from the closed form estimate of
+ * ncsSRBackgroundU() instead of u_init, and the solver is limited to
+ * bg_iterations iterations. With bg_iterations = 0 the closed form
+ * estimate is used as is, and with bg_iterations < 0 all sub-regions
+ * get the full solver.
+ * 
+ * ncs_image - Pre-allocated storage for the NCS image.
+ * image - Original image in e-.
+ * u_init - Initial estimate, the same size as image.
+ * gamma - CMOS variance in units of e-^2.
+ * otf_mask - r_size x r_size array containing the OTF mask.
+ * alpha - NCS alpha term. 
+ * im_x - Image size (slow axis). 
+ * im_y - Image size (fast axis).
+ * r_size - otf_mask size.
+ * bg_iterations - Maximum iterations for background sub-regions.
+ */
+void ncsReduceNoiseFromU(ncsfloat *ncs_image,
+			 ncsfloat *image,
+			 ncsfloat *u_init,
+			 ncsfloat *gamma,
+			 ncsfloat *otf_mask,
+			 double alpha,
+			 int im_x,
+			 int im_y,
+			 int r_size,
+			 int bg_iterations)
+{
+  ncsReduceNoiseThreads(ncs_image, image, u_init, gamma, otf_mask, alpha, im_x, im_y, r_size, bg_iterations, 1);
+}
+
+
+/*
+ * ncsReduceNoiseStack() 
+ *
+ * Run NCS noise reduction on a stack of images that share the same
+ * camera calibration. The sub-region workspaces are set up once for
+ * the whole stack, and the sub-regions of all the images are spread
+ * over threads threads. The results are the same as running 
+ * ncsReduceNoise() on each image.
+ *
+ * Note: Any zero or negative values in the images should be
+ *       set to a small positive value like 1.0.
+ * 
+ * ncs_images - Pre-allocated storage for the NCS images.
+ * images - n_frames x im_x x im_y original images in e-.
+ * gamma - CMOS variance in units of e-^2, im_x x im_y.
+ * otf_mask - r_size x r_size array containing the OTF mask.
+ * alpha - NCS alpha term. 
+ * n_frames - Number of images.
+ * im_x - Image size (slow axis). 
+ * im_y - Image size (fast axis).
+ * r_size - otf_mask size.
+ * bg_iterations - Maximum iterations for background sub-regions, as
+ *                 for ncsReduceNoiseFromU().
+ * threads - Number of threads.
+ */
+void ncsReduceNoiseStack(ncsfloat *ncs_images,
+			 ncsfloat *images,
+			 ncsfloat *gamma,
+			 ncsfloat *otf_mask,
+			 double alpha,
+			 int n_frames,
+			 int im_x,
+			 int im_y,
+			 int r_size,
+			 int bg_iterations,
+			 int threads)
+{
+  ncsContext *context;
+
+  context = ncsContextInitialize(im_x, im_y, r_size, threads);
+  if(context == NULL){
+    return;
+  }
+  ncsContextSetGamma(context, gamma);
+  ncsContextSetOTFMask(context, otf_mask);
+  ncsContextReduceNoise(context, ncs_images, images, images, alpha, n_frames, bg_iterations);
+  ncsContextCleanup(context);
+}
+
+
+/*
+ * ncsReduceNoiseThreads() 
+ *
+ * ncsReduceNoiseFromU() with the sub-regions spread over threads
+ * threads. Without OpenMP support the sub-regions are done serially.
+ * 
+ * ncs_image - Pre-allocated storage for the NCS image.
+ * image - Original image in e-.
+ * u_init - Initial estimate, the same size as image.
+ * gamma - CMOS variance in units of e-^2.
+ * otf_mask - r_size x r_size array containing the OTF mask.
+ * alpha - NCS alpha term. 
+ * im_x - Image size (slow axis). 
+ * im_y - Image size (fast axis).
+ * r_size - otf_mask size.
+ * bg_iterations - Maximum iterations for background sub-regions.
+ * threads - Number of threads.
+ */
+void ncsReduceNoiseThreads(ncsfloat *ncs_image,
+			   ncsfloat *image,
+			   ncsfloat *u_init,
+			   ncsfloat *gamma,
+			   ncsfloat *otf_mask,
+			   double alpha,
+			   int im_x,
+			   int im_y,
+			   int r_size,
+			   int bg_iterations,
+			   int threads)
+{
+  ncsContext *context;
+
+  context = ncsContextInitialize(im_x, im_y, r_size, threads);
+  if(context == NULL){
+    return;
+  }
+  ncsContextSetGamma(context, gamma);
+  ncsContextSetOTFMask(context, otf_mask);
+  ncsContextReduceNoise(context, ncs_image, image, u_init, alpha, 1, bg_iterations);
+  ncsContextCleanup(context);
+}
+
+
+/*
+ * ncsSRBackgroundU()
+ *
+ * Set u to the closed form estimate for a background sub-region. The
+ * log-likelihood is replaced by its quadratic expansion about the data,
+ * with the curvature 1/(data + gamma) replaced by its sub-region average.
+ * The cost is then diagonal in frequency space, and each frequency of
+ * the data is scaled by 1/(1 + 2*alpha*s*otf_mask^2), where s is the
+ * average of data + gamma.
+ *
+ * ncs_sr - Pointer to a ncsSubRegion structure.
+ * alpha - NCS alpha term.
+ */
+void ncsSRBackgroundU(ncsSubRegion *ncs_sr, double alpha)
+{
+  int i,j,k,size,fft_size;
+  double s,t1;
+
+  size = ncs_sr->r_size;
+  fft_size = ncs_sr->fft_size;
+
+  s = 0.0;
+  for(i=0;i<(size*size);i++){
+    ncs_sr->u[i] = ncs_sr->data[i];
+    s += ncs_sr->data[i] + ncs_sr->gamma[i];
+  }
+  s = s*ncs_sr->normalization;
+
+  NCS_FFTW(execute)(ncs_sr->fft_forward);
+  
+  for(i=0;i<size;i++){
+    for(j=0;j<fft_size;j++){
+      k = i*fft_size+j;
+      t1 = 1.0/(1.0 + 2.0*alpha*s*ncs_sr->otf_mask_sqr[i*size+j]);
+      ncs_sr->g_fft[k][0] = ncs_sr->u_fft[k][0]*t1;
+      ncs_sr->g_fft[k][1] = ncs_sr->u_fft[k][1]*t1;
+    }
+  }
+
+  NCS_FFTW(execute)(ncs_sr->fft_backward);
+
+  /* Negative values guard. */
+  for(i=0;i<(size*size);i++){
+    ncs_sr->u[i] = ncs_sr->g[i]*ncs_sr->normalization;
+    if(ncs_sr->u[i] < 1.0e-6){
+      ncs_sr->u[i] = 1.0e-6;
+    }
+  }
 }
 
 
@@ -153,9 +962,9 @@ void ncsReduceNoise(double *ncs_image,
  * Calculate the gradient of the log-likelihood with current u, data and gamma.
  *
  * ncs_sr - Pointer to a ncsSubRegion structure.
- * gradient - Pointer to an array of doubles
+ * gradient - Pointer to an array of ncsfloats
  */
-void ncsSRCalcLLGradient(ncsSubRegion *ncs_sr, double *gradient)
+void ncsSRCalcLLGradient(ncsSubRegion *ncs_sr, ncsfloat *gradient)
 {
   int i,size;
   double t1,t2;
@@ -217,7 +1026,7 @@ double ncsSRCalcLogLikelihood(ncsSubRegion *ncs_sr)
  *
  * ncs_sr - Pointer to a ncsSubRegion structure.
  */
-void ncsSRCalcNCGradient(ncsSubRegion *ncs_sr, double *gradient)
+void ncsSRCalcNCGradient(ncsSubRegion *ncs_sr, ncsfloat *gradient)
 {
   int i,j,k,size,fft_size;
   double t1;
@@ -241,7 +1050,7 @@ void ncsSRCalcNCGradient(ncsSubRegion *ncs_sr, double *gradient)
   }
   
   /* IFFT. */
-  fftw_execute(ncs_sr->fft_backward);
+  NCS_FFTW(execute)(ncs_sr->fft_backward);
 
   /* Update gradient. */
   for(i=0;i<(size*size);i++){
@@ -265,7 +1074,7 @@ double ncsSRCalcNoiseContribution(ncsSubRegion *ncs_sr)
   fft_size = ncs_sr->fft_size;
 
   /* Compute FFT of the current estimate. */
-  fftw_execute(ncs_sr->fft_forward);
+  NCS_FFTW(execute)(ncs_sr->fft_forward);
 
   /*
    * FIXME: It seems like there should be some symmetries here that we could
@@ -314,12 +1123,12 @@ void ncsSRCleanup(ncsSubRegion *ncs_sr)
 
   lbfgs_free(ncs_sr->u);
 
-  fftw_destroy_plan(ncs_sr->fft_backward);
-  fftw_destroy_plan(ncs_sr->fft_forward);
+  NCS_FFTW(destroy_plan)(ncs_sr->fft_backward);
+  NCS_FFTW(destroy_plan)(ncs_sr->fft_forward);
 
-  fftw_free(ncs_sr->g);
-  fftw_free(ncs_sr->g_fft);
-  fftw_free(ncs_sr->u_fft);
+  NCS_FFTW(free)(ncs_sr->g);
+  NCS_FFTW(free)(ncs_sr->g_fft);
+  NCS_FFTW(free)(ncs_sr->u_fft);
 
   free(ncs_sr->param);
   
@@ -339,7 +1148,7 @@ static lbfgsfloatval_t ncsSREvaluate(void *instance,
 				     const lbfgsfloatval_t step)
 {
   int i,size;
-  lbfgsfloatval_t fx;
+  double fx;
   ncsSubRegion *ncs_sr;
 
   ncs_sr = (ncsSubRegion *)instance;
@@ -350,6 +1159,7 @@ static lbfgsfloatval_t ncsSREvaluate(void *instance,
    */
   fx = ncsSRCalcLogLikelihood(ncs_sr);
   fx += ncs_sr->alpha*ncsSRCalcNoiseContribution(ncs_sr);
+  fx -= ncs_sr->cost_offset;
 
   /*
    * Calculate cost gradient.
@@ -372,7 +1182,7 @@ static lbfgsfloatval_t ncsSREvaluate(void *instance,
  * ncs_sr - Pointer to ncsSubRegion structure.
  * u - Pre-allocated storage for the u vector.
  */
-void ncsSRGetU(ncsSubRegion *ncs_sr, double *u)
+void ncsSRGetU(ncsSubRegion *ncs_sr, ncsfloat *u)
 {
   int i,size;
 
@@ -406,12 +1216,13 @@ ncsSubRegion *ncsSRInitialize(int r_size)
   
   ncs_sr->r_size = r_size;
   ncs_sr->alpha = 0.0;
+  ncs_sr->cost_offset = 0.0;
 
-  ncs_sr->data = (double *)malloc(sizeof(double)*r_size*r_size);
-  ncs_sr->gamma = (double *)malloc(sizeof(double)*r_size*r_size);
-  ncs_sr->otf_mask_sqr = (double *)malloc(sizeof(double)*r_size*r_size);
-  ncs_sr->t1 = (double *)malloc(sizeof(double)*r_size*r_size);
-  ncs_sr->t2 = (double *)malloc(sizeof(double)*r_size*r_size);
+  ncs_sr->data = (ncsfloat *)malloc(sizeof(ncsfloat)*r_size*r_size);
+  ncs_sr->gamma = (ncsfloat *)malloc(sizeof(ncsfloat)*r_size*r_size);
+  ncs_sr->otf_mask_sqr = (ncsfloat *)malloc(sizeof(ncsfloat)*r_size*r_size);
+  ncs_sr->t1 = (ncsfloat *)malloc(sizeof(ncsfloat)*r_size*r_size);
+  ncs_sr->t2 = (ncsfloat *)malloc(sizeof(ncsfloat)*r_size*r_size);
   
   ncs_sr->u = lbfgs_malloc(r_size*r_size);
   
@@ -430,13 +1241,18 @@ ncsSubRegion *ncsSRInitialize(int r_size)
   ncs_sr->normalization = 1.0/((double)(r_size*r_size));
 
   /* Backward FFT for NC gradient calculation. */
-  ncs_sr->g = (double *)fftw_malloc(sizeof(double)*r_size*r_size);
-  ncs_sr->g_fft = (fftw_complex *)fftw_malloc(sizeof(fftw_complex)*r_size*fft_size);
-  ncs_sr->fft_backward = fftw_plan_dft_c2r_2d(r_size, r_size, ncs_sr->g_fft, (double *)ncs_sr->g, FFTW_ESTIMATE);
+  ncs_sr->g = (ncsfloat *)NCS_FFTW(malloc)(sizeof(ncsfloat)*r_size*r_size);
+  ncs_sr->g_fft = (NCS_FFTW(complex) *)NCS_FFTW(malloc)(sizeof(NCS_FFTW(complex))*r_size*fft_size);
+  ncs_sr->fft_backward = NCS_FFTW(plan_dft_c2r_2d)(r_size, r_size, ncs_sr->g_fft, (ncsfloat *)ncs_sr->g, ncs_fftw_flags);
   
   /* Forward FFT. */
-  ncs_sr->u_fft = (fftw_complex *)fftw_malloc(sizeof(fftw_complex)*r_size*fft_size);
-  ncs_sr->fft_forward = fftw_plan_dft_r2c_2d(r_size, r_size, (double *)ncs_sr->u, ncs_sr->u_fft, FFTW_ESTIMATE);
+  ncs_sr->u_fft = (NCS_FFTW(complex) *)NCS_FFTW(malloc)(sizeof(NCS_FFTW(complex))*r_size*fft_size);
+  ncs_sr->fft_forward = NCS_FFTW(plan_dft_r2c_2d)(r_size, r_size, (ncsfloat *)ncs_sr->u, ncs_sr->u_fft, ncs_fftw_flags);
+
+  /* Planning with FFTW_MEASURE or slower overwrites u. */
+  for(i=0;i<(r_size*r_size);i++){
+    ncs_sr->u[i] = 0.0;
+  }
 
   /* L-BFGS parameter initialization. */
   ncs_sr->param = (lbfgs_parameter_t *)malloc(sizeof(lbfgs_parameter_t));
@@ -446,6 +1262,39 @@ ncsSubRegion *ncsSRInitialize(int r_size)
 }
 
 
+/*
+ * ncsSRIsBackground()
+ *
+ * Returns 1 if the current sub-region looks like pure background. This
+ * is the case when the spread of the data about its mean is what shot
+ * noise plus read noise give, i.e. when the reduced chi-square of the
+ * data about the mean is within 3 sigma of 1.
+ *
+ * ncs_sr - Pointer to ncsSubRegion structure.
+ */
+int ncsSRIsBackground(ncsSubRegion *ncs_sr)
+{
+  int i,n;
+  double chi2,m,t1;
+
+  n = ncs_sr->r_size*ncs_sr->r_size;
+  m = 0.0;
+  for(i=0;i<n;i++){
+    m += ncs_sr->data[i];
+  }
+  m = m/((double)n);
+
+  chi2 = 0.0;
+  for(i=0;i<n;i++){
+    t1 = ncs_sr->data[i] - m;
+    chi2 += t1*t1/(m + ncs_sr->gamma[i]);
+  }
+  chi2 = chi2/((double)(n-1));
+
+  return (chi2 < 1.0 + 3.0*sqrt(2.0/((double)(n-1))));
+}
+
+
 /*
  * ncsSRNewRegion()
  *
@@ -456,7 +1305,7 @@ ncsSubRegion *ncsSRInitialize(int r_size)
  * gamma - The CMOS variance in the sub-region.
  * alpha - Alpha parameter to use when solving.
  */
-void ncsSRNewRegion(ncsSubRegion *ncs_sr, double *image, double *gamma)
+void ncsSRNewRegion(ncsSubRegion *ncs_sr, ncsfloat *image, ncsfloat *gamma)
 {
   int i,size;
   
@@ -499,7 +1348,7 @@ static int ncsSRProgress(void *instance,
  * ncs_sr - Pointer to ncsSubRegion structure.
  * otf - The microscopes OTF.
  */
-void ncsSRSetOTFMask(ncsSubRegion *ncs_sr, double *otf_mask)
+void ncsSRSetOTFMask(ncsSubRegion *ncs_sr, ncsfloat *otf_mask)
 {
   int i,size;
 
@@ -518,7 +1367,7 @@ void ncsSRSetOTFMask(ncsSubRegion *ncs_sr, double *otf_mask)
  * ncs_sr - Pointer to ncsSubRegion structure.
  * u - The new u vector.
  */
-void ncsSRSetU(ncsSubRegion *ncs_sr, double *u)
+void ncsSRSetU(ncsSubRegion *ncs_sr, ncsfloat *u)
 {
   int i,size;
 
@@ -538,10 +1387,7 @@ void ncsSRSetU(ncsSubRegion *ncs_sr, double *u)
  */
 int ncsSRSolve(ncsSubRegion *ncs_sr, double alpha, int verbose)
 {
-  int i,ret,size;
-  lbfgsfloatval_t fx;
-  
-  ncs_sr->alpha = alpha;
+  int i,size;
 
   size = ncs_sr->r_size;
 
@@ -550,6 +1396,37 @@ int ncsSRSolve(ncsSubRegion *ncs_sr, double alpha, int verbose)
     ncs_sr->u[i] = ncs_sr->data[i];
   }
 
+  return ncsSRSolveFromU(ncs_sr, alpha, verbose);
+}
+
+
+/*
+ * ncsSRSolveFromU()
+ *
+ * Solve for optimal u using the L-BFGS algorithm, starting from the
+ * current u (as set by ncsSRSetU()) instead of from the image. Like
+ * the image, u should not have any zero or negative values.
+ *
+ * ncs_sr - Pointer to a ncsSubRegion structure.
+ */
+int ncsSRSolveFromU(ncsSubRegion *ncs_sr, double alpha, int verbose)
+{
+  int ret,size;
+  lbfgsfloatval_t fx;
+  
+  ncs_sr->alpha = alpha;
+
+  size = ncs_sr->r_size;
+
+#ifdef NCS_FLOAT
+  /*
+   * In single precision L-BFGS is given the cost relative to the cost
+   * at the starting u. The cost itself is too large for a float to
+   * resolve the small decreases of the line search near the minimum.
+   */
+  ncs_sr->cost_offset = ncsSRCalcLogLikelihood(ncs_sr) + alpha*ncsSRCalcNoiseContribution(ncs_sr);
+#endif
+
   if (verbose){
     ret = lbfgs(size*size, ncs_sr->u, &fx, ncsSREvaluate, ncsSRProgress, (void *)ncs_sr, ncs_sr->param);
   }
@@ -559,3 +1436,43 @@ int ncsSRSolve(ncsSubRegion *ncs_sr, double alpha, int verbose)
 
   return ret;
 }
+
+
+/*
+ * ncsSRStarts()
+ *
+ * Fill starts with the (padded) start of each sub-region along an
+ * image axis, the last one moved back to fit in the image.
+ *
+ * starts - Pre-allocated storage for at least (im_size+1)/(r_size-2)+2 values.
+ * im_size - Image size along the axis.
+ * r_size - Sub-region size.
+ *
+ * Returns the number of sub-regions.
+ */
+static int ncsSRStarts(int *starts, int im_size, int r_size)
+{
+  int i,n,s_size;
+
+  s_size = r_size - 2;
+  n = 0;
+  for(i=-1;i<(im_size+1);i+=s_size){
+    if((i+r_size)>(im_size+1)){
+      starts[n] = im_size + 1 - r_size;
+    }
+    else{
+      starts[n] = i;
+    }
+    n++;
+    
+    /* 
+     * This keeps us from analyzing the outer edge twice, which
+     * can happen depending the values of s_size and im_size.
+     */
+    if(starts[n-1] == im_size + 1 - r_size){
+      break;
+    }
+  }
+
+  return n;
+}
@@ -6,6 +6,19 @@
 
 #ifndef NCS_H
 
+/*
+ * The library is normally built in double precision. Built with 
+ * NCS_FLOAT defined it is in single precision instead, using the
+ * fftwf_ functions of FFTW and a liblbfgs built with LBFGS_FLOAT = 32.
+ */
+#ifdef NCS_FLOAT
+typedef float ncsfloat;
+#define NCS_FFTW(name) fftwf_ ## name
+#else
+typedef double ncsfloat;
+#define NCS_FFTW(name) fftw_ ## name
+#endif
+
 /*
  * This structure contains everything necessary to run NCS on a sub-region.
  */
@@ -15,41 +28,119 @@ typedef struct ncsSubRegion
   int fft_size;                 /* Size of the FFT on the second axis. */
   
   double alpha;                 /* NCS alpha parameter value. */
+  double cost_offset;           /* Subtracted from the cost for L-BFGS. */
   double normalization;         /* FFT normalization constant. */
 
-  double *data;                 /* Image data (of size r_size x r_size). */
-  double *g;                    /* Temporary gradient storage. */
-  double *gamma;                /* CMOS variance data (of size r_size x r_size). */
-  double *otf_mask_sqr;         /* OTF mask squared (of size r_size x r_size). */
-  double *t1;                   /* Temporary storage (used in gradient calculation). */
-  double *t2;                   /* Temporary storage (used in gradient calculation). */
+  ncsfloat *data;               /* Image data (of size r_size x r_size). */
+  ncsfloat *g;                  /* Temporary gradient storage. */
+  ncsfloat *gamma;              /* CMOS variance data (of size r_size x r_size). */
+  ncsfloat *otf_mask_sqr;       /* OTF mask squared (of size r_size x r_size). */
+  ncsfloat *t1;                 /* Temporary storage (used in gradient calculation). */
+  ncsfloat *t2;                 /* Temporary storage (used in gradient calculation). */
 
   lbfgsfloatval_t *u;           /* Current fit. */
   
-  fftw_plan fft_backward;       /* IFFT transform plan. */
-  fftw_plan fft_forward;        /* FFT transform plan. */
+  NCS_FFTW(plan) fft_backward;  /* IFFT transform plan. */
+  NCS_FFTW(plan) fft_forward;   /* FFT transform plan. */
 
-  fftw_complex *g_fft;          /* FFT of NC gradient. */
-  fftw_complex *u_fft;          /* FFT of current fit. */
+  NCS_FFTW(complex) *g_fft;     /* FFT of NC gradient. */
+  NCS_FFTW(complex) *u_fft;     /* FFT of current fit. */
 
   lbfgs_parameter_t *param;     /* The parameters of the L-BFGS method. */
 } ncsSubRegion;
 
 
+/*
+ * This structure contains everything necessary to run NCS on a whole
+ * frame, without dividing it into sub-regions.
+ */
+typedef struct ncsFrame
+{
+  int f_x;                      /* Frame size (slow axis). */
+  int f_y;                      /* Frame size (fast axis). */
+  int fft_size;                 /* Size of the FFT on the second axis. */
+
+  double alpha;                 /* NCS alpha parameter value. */
+  double cost_offset;           /* Subtracted from the cost for L-BFGS. */
+  double normalization;         /* FFT normalization constant. */
+
+  ncsfloat *data;               /* Image data (of size f_x x f_y). */
+  ncsfloat *g;                  /* Temporary gradient storage. */
+  ncsfloat *gamma;              /* CMOS variance data (of size f_x x f_y). */
+  ncsfloat *nc_weights;         /* Noise contribution weights (of size f_x x fft_size). */
+  ncsfloat *otf_mask_sqr;       /* Symmetrized OTF mask squared (of size f_x x fft_size). */
+
+  lbfgsfloatval_t *u;           /* Current fit. */
+
+  NCS_FFTW(plan) fft_backward;  /* IFFT transform plan. */
+  NCS_FFTW(plan) fft_forward;   /* FFT transform plan. */
+
+  NCS_FFTW(complex) *g_fft;     /* FFT of NC gradient. */
+  NCS_FFTW(complex) *u_fft;     /* FFT of current fit. */
+
+  lbfgs_parameter_t *param;     /* The parameters of the L-BFGS method. */
+} ncsFrame;
+
+
+/*
+ * This structure contains the sub-regions and the CMOS variance to run
+ * NCS on a series of images of the same size.
+ */
+typedef struct ncsContext
+{
+  int im_x;                     /* Image size (slow axis). */
+  int im_y;                     /* Image size (fast axis). */
+  int n_x;                      /* Number of sub-regions (slow axis). */
+  int n_y;                      /* Number of sub-regions (fast axis). */
+  int r_size;                   /* Sub-region size. */
+  int threads;                  /* Number of threads. */
+
+  int *starts_x;                /* Sub-region starts (slow axis). */
+  int *starts_y;                /* Sub-region starts (fast axis). */
+
+  ncsfloat *gamma;              /* CMOS variance data (of size im_x x im_y). */
+
+  ncsSubRegion **ncs_srs;       /* One sub-region per thread. */
+} ncsContext;
+
+
 /*
  * Functions.
  */
-void ncsReduceNoise(double *, double *, double *, double *, double, int, int, int);
-void ncsSRCalcLLGradient(ncsSubRegion *, double *);
+void ncsContextCleanup(ncsContext *);
+ncsContext *ncsContextInitialize(int, int, int, int);
+void ncsContextReduceNoise(ncsContext *, ncsfloat *, ncsfloat *, ncsfloat *, double, int, int);
+void ncsContextSetGamma(ncsContext *, ncsfloat *);
+void ncsContextSetOTFMask(ncsContext *, ncsfloat *);
+int ncsFFTWExportWisdom(const char *);
+int ncsFFTWImportWisdom(const char *);
+void ncsFFTWSetFlags(unsigned);
+double ncsFrameCalcCostGradient(ncsFrame *, double, ncsfloat *);
+void ncsFrameCleanup(ncsFrame *);
+void ncsFrameGetU(ncsFrame *, ncsfloat *);
+ncsFrame *ncsFrameInitialize(int, int);
+void ncsFrameNewImage(ncsFrame *, ncsfloat *, ncsfloat *);
+void ncsFrameSetOTFMask(ncsFrame *, ncsfloat *);
+void ncsFrameSetU(ncsFrame *, ncsfloat *);
+int ncsFrameSolve(ncsFrame *, double, int);
+void ncsReduceNoise(ncsfloat *, ncsfloat *, ncsfloat *, ncsfloat *, double, int, int, int);
+int ncsReduceNoiseFrame(ncsfloat *, ncsfloat *, ncsfloat *, ncsfloat *, double, int, int, int, int);
+void ncsReduceNoiseFromU(ncsfloat *, ncsfloat *, ncsfloat *, ncsfloat *, ncsfloat *, double, int, int, int, int);
+void ncsReduceNoiseStack(ncsfloat *, ncsfloat *, ncsfloat *, ncsfloat *, double, int, int, int, int, int, int);
+void ncsReduceNoiseThreads(ncsfloat *, ncsfloat *, ncsfloat *, ncsfloat *, ncsfloat *, double, int, int, int, int, int);
+void ncsSRBackgroundU(ncsSubRegion *, double);
+void ncsSRCalcLLGradient(ncsSubRegion *, ncsfloat *);
 double ncsSRCalcLogLikelihood(ncsSubRegion *);
-void ncsSRCalcNCGradient(ncsSubRegion *, double *);
+void ncsSRCalcNCGradient(ncsSubRegion *, ncsfloat *);
 double ncsSRCalcNoiseContribution(ncsSubRegion *);
 void ncsSRCleanup(ncsSubRegion *);
-void ncsSRGetU(ncsSubRegion *, double *);
+void ncsSRGetU(ncsSubRegion *, ncsfloat *);
 ncsSubRegion *ncsSRInitialize(int);
-void ncsSRNewRegion(ncsSubRegion *, double *, double *);
-void ncsSRSetOTFMask(ncsSubRegion *, double *);
-void ncsSRSetU(ncsSubRegion *, double *);
+int ncsSRIsBackground(ncsSubRegion *);
+void ncsSRNewRegion(ncsSubRegion *, ncsfloat *, ncsfloat *);
+void ncsSRSetOTFMask(ncsSubRegion *, ncsfloat *);
+void ncsSRSetU(ncsSubRegion *, ncsfloat *);
 int ncsSRSolve(ncsSubRegion *, double, int);
+int ncsSRSolveFromU(ncsSubRegion *, double, int);
   
 #endif
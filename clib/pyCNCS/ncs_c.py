@@ -8,6 +8,7 @@ import ctypes
 import numpy
 from numpy.ctypeslib import ndpointer
 import scipy
+import scipy.fft
 import scipy.optimize
 
 import pyCNCS.loadclib as loadclib
@@ -15,6 +16,111 @@ import pyCNCS.loadclib as loadclib
 
 ncs = loadclib.loadNCSCLibrary()
 
+
+class NCSCMissingFunction(object):
+    """
+    Stands in for a function that the loaded C library does not have,
+    calling it raises an NCSCException.
+    """
+    argtypes = None
+    restype = None
+
+    def __init__(self, name = None, **kwds):
+        super().__init__(**kwds)
+        self.name = name
+
+    def __call__(self, *args):
+        raise NCSCException(self.name + " is not in " + ncs._name + ", this needs a newer build of the C library!")
+
+#
+# These functions were added after the pre-built Windows DLL, so they
+# are only bound if the library has them.
+#
+for name in ["ncsContextCleanup",
+             "ncsContextInitialize",
+             "ncsContextReduceNoise",
+             "ncsContextSetGamma",
+             "ncsContextSetOTFMask",
+             "ncsFFTWExportWisdom",
+             "ncsFFTWImportWisdom",
+             "ncsFFTWSetFlags",
+             "ncsFrameCalcCostGradient",
+             "ncsFrameCleanup",
+             "ncsFrameGetU",
+             "ncsFrameInitialize",
+             "ncsFrameNewImage",
+             "ncsFrameSetOTFMask",
+             "ncsFrameSetU",
+             "ncsFrameSolve",
+             "ncsReduceNoiseFrame",
+             "ncsReduceNoiseFromU",
+             "ncsReduceNoiseStack",
+             "ncsReduceNoiseThreads",
+             "ncsSRBackgroundU",
+             "ncsSRIsBackground",
+             "ncsSRSolveFromU"]:
+    if not hasattr(ncs, name):
+        setattr(ncs, name, NCSCMissingFunction(name))
+
+ncs.ncsContextCleanup.argtypes = [ctypes.c_void_p]
+
+ncs.ncsContextInitialize.argtypes = [ctypes.c_int,
+                                     ctypes.c_int,
+                                     ctypes.c_int,
+                                     ctypes.c_int]
+ncs.ncsContextInitialize.restype = ctypes.c_void_p
+
+ncs.ncsContextReduceNoise.argtypes = [ctypes.c_void_p,
+                                      ndpointer(dtype = numpy.float64, flags = "C_CONTIGUOUS"),
+                                      ndpointer(dtype = numpy.float64, flags = "C_CONTIGUOUS"),
+                                      ndpointer(dtype = numpy.float64, flags = "C_CONTIGUOUS"),
+                                      ctypes.c_double,
+                                      ctypes.c_int,
+                                      ctypes.c_int]
+
+ncs.ncsContextSetGamma.argtypes = [ctypes.c_void_p,
+                                   ndpointer(dtype = numpy.float64, flags = "C_CONTIGUOUS")]
+
+ncs.ncsContextSetOTFMask.argtypes = [ctypes.c_void_p,
+                                     ndpointer(dtype = numpy.float64, flags = "C_CONTIGUOUS")]
+
+ncs.ncsFFTWExportWisdom.argtypes = [ctypes.c_char_p]
+ncs.ncsFFTWExportWisdom.restype = ctypes.c_int
+
+ncs.ncsFFTWImportWisdom.argtypes = [ctypes.c_char_p]
+ncs.ncsFFTWImportWisdom.restype = ctypes.c_int
+
+ncs.ncsFFTWSetFlags.argtypes = [ctypes.c_uint]
+
+ncs.ncsFrameCalcCostGradient.argtypes = [ctypes.c_void_p,
+                                         ctypes.c_double,
+                                         ndpointer(dtype = numpy.float64)]
+ncs.ncsFrameCalcCostGradient.restype = ctypes.c_double
+
+ncs.ncsFrameCleanup.argtypes = [ctypes.c_void_p]
+
+ncs.ncsFrameGetU.argtypes = [ctypes.c_void_p,
+                             ndpointer(dtype = numpy.float64)]
+
+ncs.ncsFrameInitialize.argtypes = [ctypes.c_int,
+                                   ctypes.c_int]
+ncs.ncsFrameInitialize.restype = ctypes.c_void_p
+
+ncs.ncsFrameNewImage.argtypes = [ctypes.c_void_p,
+                                 ndpointer(dtype = numpy.float64),
+                                 ndpointer(dtype = numpy.float64)]
+
+ncs.ncsFrameSetOTFMask.argtypes = [ctypes.c_void_p,
+                                   ndpointer(dtype = numpy.float64)]
+
+ncs.ncsFrameSetU.argtypes = [ctypes.c_void_p,
+                             ndpointer(dtype = numpy.float64)]
+
+ncs.ncsFrameSolve.argtypes = [ctypes.c_void_p,
+                              ctypes.c_double,
+                              ctypes.c_int]
+ncs.ncsFrameSolve.restype = ctypes.c_int
+
 ncs.ncsReduceNoise.argtypes = [ndpointer(dtype = numpy.float64),
                                ndpointer(dtype = numpy.float64),
                                ndpointer(dtype = numpy.float64),
@@ -24,6 +130,55 @@ ncs.ncsReduceNoise.argtypes = [ndpointer(dtype = numpy.float64),
                                ctypes.c_int,
                                ctypes.c_int]
 
+ncs.ncsReduceNoiseFrame.argtypes = [ndpointer(dtype = numpy.float64),
+                                    ndpointer(dtype = numpy.float64),
+                                    ndpointer(dtype = numpy.float64),
+                                    ndpointer(dtype = numpy.float64),
+                                    ctypes.c_double,
+                                    ctypes.c_int,
+                                    ctypes.c_int,
+                                    ctypes.c_int,
+                                    ctypes.c_int]
+ncs.ncsReduceNoiseFrame.restype = ctypes.c_int
+
+ncs.ncsReduceNoiseFromU.argtypes = [ndpointer(dtype = numpy.float64),
+                                    ndpointer(dtype = numpy.float64),
+                                    ndpointer(dtype = numpy.float64),
+                                    ndpointer(dtype = numpy.float64),
+                                    ndpointer(dtype = numpy.float64),
+                                    ctypes.c_double,
+                                    ctypes.c_int,
+                                    ctypes.c_int,
+                                    ctypes.c_int,
+                                    ctypes.c_int]
+
+ncs.ncsReduceNoiseStack.argtypes = [ndpointer(dtype = numpy.float64, flags = "C_CONTIGUOUS"),
+                                    ndpointer(dtype = numpy.float64, flags = "C_CONTIGUOUS"),
+                                    ndpointer(dtype = numpy.float64, flags = "C_CONTIGUOUS"),
+                                    ndpointer(dtype = numpy.float64, flags = "C_CONTIGUOUS"),
+                                    ctypes.c_double,
+                                    ctypes.c_int,
+                                    ctypes.c_int,
+                                    ctypes.c_int,
+                                    ctypes.c_int,
+                                    ctypes.c_int,
+                                    ctypes.c_int]
+
+ncs.ncsReduceNoiseThreads.argtypes = [ndpointer(dtype = numpy.float64),
+                                      ndpointer(dtype = numpy.float64),
+                                      ndpointer(dtype = numpy.float64),
+                                      ndpointer(dtype = numpy.float64),
+                                      ndpointer(dtype = numpy.float64),
+                                      ctypes.c_double,
+                                      ctypes.c_int,
+                                      ctypes.c_int,
+                                      ctypes.c_int,
+                                      ctypes.c_int,
+                                      ctypes.c_int]
+
+ncs.ncsSRBackgroundU.argtypes = [ctypes.c_void_p,
+                                 ctypes.c_double]
+
 ncs.ncsSRCalcLLGradient.argtypes = [ctypes.c_void_p,
                                     ndpointer(dtype = numpy.float64)]
 
@@ -44,6 +199,9 @@ ncs.ncsSRGetU.argtypes = [ctypes.c_void_p,
 ncs.ncsSRInitialize.argtypes = [ctypes.c_int]
 ncs.ncsSRInitialize.restype = ctypes.c_void_p
 
+ncs.ncsSRIsBackground.argtypes = [ctypes.c_void_p]
+ncs.ncsSRIsBackground.restype = ctypes.c_int
+
 ncs.ncsSRNewRegion.argtypes = [ctypes.c_void_p,
                                ndpointer(dtype = numpy.float64),
                                ndpointer(dtype = numpy.float64)]
@@ -59,11 +217,217 @@ ncs.ncsSRSolve.argtypes = [ctypes.c_void_p,
                            ctypes.c_int]
 ncs.ncsSRSolve.restype = ctypes.c_int
 
+ncs.ncsSRSolveFromU.argtypes = [ctypes.c_void_p,
+                                ctypes.c_double,
+                                ctypes.c_int]
+ncs.ncsSRSolveFromU.restype = ctypes.c_int
+
+#
+# The single precision library, if it was built. It has the same 
+# functions, with float32 instead of float64 arrays.
+#
+try:
+    ncsf = loadclib.loadNCSCLibrary("ncsf")
+except OSError:
+    ncsf = None
+
+if ncsf is not None:
+    for name in [name for name in vars(ncs) if name.startswith("ncs")]:
+        c_func = getattr(ncsf, name)
+        if getattr(ncs, name).argtypes is not None:
+            c_func.argtypes = [ndpointer(dtype = numpy.float32, flags = arg._flags_) if hasattr(arg, "_dtype_") else arg
+                               for arg in getattr(ncs, name).argtypes]
+        c_func.restype = getattr(ncs, name).restype
+
 
 class NCSCException(Exception):
     pass
 
 
+class NCSCContext(object):
+    """
+    NCS solver for a series of images of the same size, taken with the 
+    same camera and optics. The sub-regions (one per thread), their FFTW
+    plans, the OTF mask and gamma are set up once and kept until 
+    cleanup(), so each image only pays for the solve. Use it in a with
+    statement to clean up when done.
+
+    shape - The image size.
+    gamma - CMOS variance (in units of e-), or a calibration object with
+            a gamma attribute like pyNCS's Calibration.
+    otf_mask - M x M array containing the OTF mask, fftshifted as for
+               cReduceNoise(), so the same mask works for both.
+    alpha - NCS alpha term.
+    threads - Number of threads, as for cReduceNoise().
+    bg_iterations - As for cReduceNoise().
+    dtype - As for cReduceNoise().
+    """
+    def __init__(self, shape = None, gamma = None, otf_mask = None, alpha = None, threads = 1, bg_iterations = None, dtype = numpy.float64, strict = True, **kwds):
+        super().__init__(**kwds)
+        self.alpha = alpha
+        self.bg_iterations = -1 if bg_iterations is None else bg_iterations
+        self.c_ncs = None
+        self.dtype = numpy.dtype(dtype)
+        self.lib = library(dtype)
+        self.shape = tuple(shape)
+        self.strict = strict
+
+        if (otf_mask.shape[0] != otf_mask.shape[1]):
+            raise NCSCException("OTF must be square!")
+        
+        if ((otf_mask.shape[0]%2)!=0):
+            raise NCSCException("Sub region size must be divisible by 2!")
+        
+        self.r_size = otf_mask.shape[0]
+        self.c_ncs = self.lib.ncsContextInitialize(self.shape[0], self.shape[1], self.r_size, threads)
+        try:
+            self.setGamma(gamma)
+            self.setOTFMask(otf_mask)
+        except NCSCException:
+            self.cleanup()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, value, traceback):
+        self.cleanup()
+
+    def checkOut(self, out, shape):
+        if out is None:
+            return numpy.zeros(shape, dtype = self.dtype)
+        if (out.shape != shape) or (out.dtype != self.dtype) or not out.flags["C_CONTIGUOUS"]:
+            raise NCSCException("out must be a C contiguous array of the context dtype the size of the images!")
+        return out
+        
+    def cleanup(self):
+        if self.c_ncs is not None:
+            self.lib.ncsContextCleanup(self.c_ncs)
+            self.c_ncs = None
+
+    def reduce(self, image, out = None, u_init = None):
+        """
+        Run NCS on an image, optionally into out and starting from the
+        initial estimate u_init. Returns the NCS image.
+        """
+        if self.strict and (image.shape != self.shape):
+            raise NCSCException("Image size must match the context image size!")
+        return self.reduceStack(image[None], None if out is None else out[None], None if u_init is None else u_init[None])[0]
+
+    def reduceStack(self, images, out = None, u_inits = None):
+        """
+        Run NCS on a N x X x Y stack of images, optionally into out and
+        starting from the initial estimates u_inits. Returns the NCS images.
+        """
+        if self.strict:
+            if (images.ndim != 3) or (images.shape[1:] != self.shape):
+                raise NCSCException("Images must be a stack of images of the context image size!")
+
+            if (u_inits is not None) and (u_inits.shape != images.shape):
+                raise NCSCException("u_inits must be the same size as the images!")
+            
+        out = self.checkOut(out, images.shape)
+        images = numpy.ascontiguousarray(images, dtype = self.dtype)
+        if u_inits is None:
+            u_inits = images
+        self.lib.ncsContextReduceNoise(self.c_ncs,
+                                  out,
+                                  images,
+                                  numpy.ascontiguousarray(u_inits, dtype = self.dtype),
+                                  self.alpha,
+                                  images.shape[0],
+                                  self.bg_iterations)
+        return out
+
+    def setGamma(self, gamma):
+        gamma = calibrationGamma(gamma)
+        if self.strict and (gamma.shape != self.shape):
+            raise NCSCException("Gamma size must match the context image size!")
+        
+        self.lib.ncsContextSetGamma(self.c_ncs,
+                                    numpy.ascontiguousarray(gamma, dtype = self.dtype))
+        
+    def setOTFMask(self, otf_mask):
+        if self.strict:
+            if (otf_mask.shape != (self.r_size, self.r_size)):
+                raise NCSCException("OTF size must match sub-region size!")
+
+            if not checkOTFMask(numpy.fft.ifftshift(otf_mask)):
+                raise NCSCException("OTF does not have the expected symmetry!")
+            
+        self.lib.ncsContextSetOTFMask(self.c_ncs,
+                                      numpy.ascontiguousarray(otf_mask, dtype = self.dtype))
+
+
+class NCSCFrame(object):
+    """
+    NCS solver for a whole frame, without sub-regions.
+    """
+    def __init__(self, f_size = None, strict = True, **kwds):
+        super().__init__(**kwds)
+        self.f_size = tuple(f_size)
+        self.strict = strict
+
+        self.c_ncs = ncs.ncsFrameInitialize(*self.f_size)
+
+    def calcCostGradient(self, alpha):
+        """
+        Returns the cost and its gradient for the current u.
+        """
+        gradient = numpy.zeros(self.f_size, dtype = numpy.float64)
+        cost = ncs.ncsFrameCalcCostGradient(self.c_ncs, alpha, gradient)
+        return [cost, gradient]
+
+    def cleanup(self):
+        if self.c_ncs is not None:
+            ncs.ncsFrameCleanup(self.c_ncs)
+            self.c_ncs = None
+
+    def cSolve(self, alpha, verbose = True):
+        """
+        Solve starting from the current u, as set by setU().
+        """
+        ret = ncs.ncsFrameSolve(self.c_ncs, alpha, verbose)
+        if verbose:
+            print("L-BFGS method returned {0:d}".format(ret))
+            
+        if self.strict and (ret < 0):
+            raise NCSCException("Solver failed with error code {0:d}!".format(ret))
+          
+        return self.getU()
+
+    def getU(self):
+        u = numpy.zeros(self.f_size, dtype = numpy.float64)
+        ncs.ncsFrameGetU(self.c_ncs, u)
+        return u
+
+    def newImage(self, image, gamma):
+        if self.strict:
+            if (image.shape != self.f_size) or (gamma.shape != self.f_size):
+                raise NCSCException("Image and gamma size must match frame size!")
+
+        ncs.ncsFrameNewImage(self.c_ncs,
+                             numpy.ascontiguousarray(image, dtype = numpy.float64),
+                             numpy.ascontiguousarray(gamma, dtype = numpy.float64))
+
+    def setOTFMask(self, otf_mask):
+        if self.strict:
+            if (otf_mask.shape != self.f_size):
+                raise NCSCException("OTF size must match frame size!")
+
+        tmp = numpy.fft.ifftshift(otf_mask)
+        ncs.ncsFrameSetOTFMask(self.c_ncs,
+                               numpy.ascontiguousarray(tmp, dtype = numpy.float64))
+
+    def setU(self, u):
+        if self.strict:
+            if (u.shape != self.f_size):
+                raise NCSCException("u size must match frame size!")
+
+        ncs.ncsFrameSetU(self.c_ncs,
+                         numpy.ascontiguousarray(u, dtype = numpy.float64))
+
+
 class NCSCSubRegion(object):
     """
     NCS solver for a square sub-region of an image.
@@ -79,6 +443,12 @@ class NCSCSubRegion(object):
         
         self.c_ncs = ncs.ncsSRInitialize(r_size)
 
+    def backgroundU(self, alpha):
+        """
+        Set u to the closed form estimate for a background sub-region.
+        """
+        ncs.ncsSRBackgroundU(self.c_ncs, alpha)
+        
     def calcCost(self, u):
         """
         This is used by pySolve().
@@ -113,8 +483,16 @@ class NCSCSubRegion(object):
             ncs.ncsSRCleanup(self.c_ncs)
             self.c_ncs = None
 
-    def cSolve(self, alpha, verbose = True):
-        ret = ncs.ncsSRSolve(self.c_ncs, alpha, verbose)
+    def cSolve(self, alpha, verbose = True, u_init = None):
+        """
+        u_init is an optional initial estimate, by default the solver
+        starts from the image.
+        """
+        if u_init is None:
+            ret = ncs.ncsSRSolve(self.c_ncs, alpha, verbose)
+        else:
+            self.setU(u_init)
+            ret = ncs.ncsSRSolveFromU(self.c_ncs, alpha, verbose)
         if verbose:
             print("L-BFGS method returned {0:d}".format(ret))
             
@@ -128,6 +506,12 @@ class NCSCSubRegion(object):
         ncs.ncsSRGetU(self.c_ncs, u)
         return u
 
+    def isBackground(self):
+        """
+        Returns True if the current sub-region looks like pure background.
+        """
+        return bool(ncs.ncsSRIsBackground(self.c_ncs))
+        
     def newRegion(self, image, gamma):
         self.image = image
 
@@ -235,6 +619,21 @@ class NCSCSubRegion(object):
         ncs.ncsSRSetU(self.c_ncs,
                       numpy.ascontiguousarray(u, dtype = numpy.float64))
 
+
+# FFTW planner flags, from fftw3.h.
+fftw_planners = {"estimate" : 1 << 6,
+                 "measure" : 0,
+                 "patient" : 1 << 5,
+                 "exhaustive" : 1 << 3}
+
+        
+def calibrationGamma(gamma):
+    """
+    Returns gamma as an array, gamma can also be a calibration object
+    with a gamma attribute.
+    """
+    return numpy.asarray(getattr(gamma, "gamma", gamma))
+
         
 def checkOTFMask(otf_mask):
     """
@@ -247,45 +646,231 @@ def checkOTFMask(otf_mask):
         return True
     
     
-def cReduceNoise(image, gamma, otf_mask, alpha, strict = True):
+def cReduceNoise(image, gamma, otf_mask, alpha, strict = True, u_init = None, bg_iterations = None, threads = 1, dtype = numpy.float64):
     """
     Run NCS on an image using pure C algorithm.
 
     image - The image to run NCS on (in units of e-).
-    gamma - CMOS variance (in units of e-).
+    gamma - CMOS variance (in units of e-), or a calibration object with
+            a gamma attribute like pyNCS's Calibration.
     otf_mask - M x M array containing the OTF mask, where M is usually a power
-               of 2, like 16.
+               of 2, like 16. The mask is fftshifted, with the zero frequency
+               at [0,0].
     alpha - NCS alpha term.
+    u_init - Optional initial estimate to start the solver from, for example
+             the NCS image of the previous frame.
+    bg_iterations - If set, sub-regions that look like pure background
+                    start from a closed form estimate and get at most
+                    this many solver iterations (0 keeps the estimate).
+    threads - Number of threads to spread the sub-regions over. The
+              result does not depend on it. This needs a library built
+              with OpenMP, otherwise it is ignored.
+    dtype - numpy.float64, or numpy.float32 for the single precision
+            library (see library()). The NCS image has this dtype.
     """
+    lib = library(dtype)
+    gamma = calibrationGamma(gamma)
     if strict:
         if (otf_mask.shape[0] != otf_mask.shape[1]):
             raise NCSCException("OTF must be square!")
 
         if ((otf_mask.shape[0]%2)!=0):
             raise NCSException("Sub region size must be divisible by 2!")
+
+        if not checkOTFMask(numpy.fft.ifftshift(otf_mask)):
+            raise NCSCException("OTF does not have the expected symmetry!")
         
-    ncs_image = numpy.zeros_like(image)
-    ncs.ncsReduceNoise(numpy.ascontiguousarray(ncs_image, dtype = numpy.float64),
-                       numpy.ascontiguousarray(image, dtype = numpy.float64),
-                       numpy.ascontiguousarray(gamma, dtype = numpy.float64),
-                       numpy.ascontiguousarray(otf_mask, dtype = numpy.float64),
-                       alpha,
-                       image.shape[0],
-                       image.shape[1],
-                       otf_mask.shape[0])
+    ncs_image = numpy.zeros(image.shape, dtype = dtype)
+    if (u_init is None) and (bg_iterations is None) and (threads == 1):
+        lib.ncsReduceNoise(ncs_image,
+                           numpy.ascontiguousarray(image, dtype = dtype),
+                           numpy.ascontiguousarray(gamma, dtype = dtype),
+                           numpy.ascontiguousarray(otf_mask, dtype = dtype),
+                           alpha,
+                           image.shape[0],
+                           image.shape[1],
+                           otf_mask.shape[0])
+    else:
+        if u_init is None:
+            u_init = image
+        if bg_iterations is None:
+            bg_iterations = -1
+        if strict and (u_init.shape != image.shape):
+            raise NCSCException("u_init must be the same size as the image!")
+        
+        lib.ncsReduceNoiseThreads(ncs_image,
+                                  numpy.ascontiguousarray(image, dtype = dtype),
+                                  numpy.ascontiguousarray(u_init, dtype = dtype),
+                                  numpy.ascontiguousarray(gamma, dtype = dtype),
+                                  numpy.ascontiguousarray(otf_mask, dtype = dtype),
+                                  alpha,
+                                  image.shape[0],
+                                  image.shape[1],
+                                  otf_mask.shape[0],
+                                  bg_iterations,
+                                  threads)
     return ncs_image
 
 
+def cReduceNoiseFrame(image, gamma, otf_mask, alpha, strict = True):
+    """
+    Run NCS on an image as a whole, without sub-regions, using pure C
+    algorithm. The image is edge padded out to the size of the OTF mask.
+
+    image - The image to run NCS on (in units of e-).
+    gamma - CMOS variance (in units of e-), or a calibration object with
+            a gamma attribute like pyNCS's Calibration.
+    otf_mask - Array containing the OTF mask for the padded frame, at
+               least 2 pixels larger than the image on each axis (see
+               frameSize()). As for cReduceNoise() the mask is fftshifted.
+    alpha - NCS alpha term.
+    """
+    gamma = calibrationGamma(gamma)
+    if strict:
+        if (otf_mask.shape[0] < (image.shape[0] + 2)) or (otf_mask.shape[1] < (image.shape[1] + 2)):
+            raise NCSCException("OTF must be at least 2 pixels larger than the image!")
+
+    ncs_image = numpy.ascontiguousarray(numpy.zeros_like(image), dtype = numpy.float64)
+    ret = ncs.ncsReduceNoiseFrame(ncs_image,
+                                  numpy.ascontiguousarray(image, dtype = numpy.float64),
+                                  numpy.ascontiguousarray(gamma, dtype = numpy.float64),
+                                  numpy.ascontiguousarray(otf_mask, dtype = numpy.float64),
+                                  alpha,
+                                  image.shape[0],
+                                  image.shape[1],
+                                  otf_mask.shape[0],
+                                  otf_mask.shape[1])
+    
+    if strict and (ret < 0):
+        raise NCSCException("Solver failed with error code {0:d}!".format(ret))
+
+    return ncs_image
+
+
+def cReduceNoiseStack(images, gamma, otf_mask, alpha, strict = True, bg_iterations = None, threads = 1, out = None, dtype = numpy.float64):
+    """
+    Run NCS on a stack of images using pure C algorithm. This is faster
+    than calling cReduceNoise() on each image, as the stack is converted
+    and the solver is set up only once.
+
+    images - N x X x Y stack of images to run NCS on (in units of e-).
+    gamma - X x Y CMOS variance (in units of e-), or a calibration object
+            with a gamma attribute like pyNCS's Calibration.
+    otf_mask - M x M array containing the OTF mask, fftshifted as for
+               cReduceNoise().
+    alpha - NCS alpha term.
+    bg_iterations - As for cReduceNoise().
+    threads - Number of threads to spread the sub-regions of all the 
+              images over, as for cReduceNoise().
+    out - Optional C contiguous N x X x Y array of dtype for the results.
+    dtype - As for cReduceNoise().
+
+    Returns the NCS images.
+    """
+    lib = library(dtype)
+    gamma = calibrationGamma(gamma)
+    if strict:
+        if (images.ndim != 3):
+            raise NCSCException("Images must be a 3D stack!")
+        
+        if (gamma.shape != images.shape[1:]):
+            raise NCSCException("Gamma must be the same size as the images!")
+        
+        if (otf_mask.shape[0] != otf_mask.shape[1]):
+            raise NCSCException("OTF must be square!")
+
+        if ((otf_mask.shape[0]%2)!=0):
+            raise NCSCException("Sub region size must be divisible by 2!")
+
+        if not checkOTFMask(numpy.fft.ifftshift(otf_mask)):
+            raise NCSCException("OTF does not have the expected symmetry!")
+
+    if out is None:
+        out = numpy.zeros(images.shape, dtype = dtype)
+    elif (out.shape != images.shape) or (out.dtype != dtype) or not out.flags["C_CONTIGUOUS"]:
+        raise NCSCException("out must be a C contiguous array of dtype the size of the images!")
+
+    if bg_iterations is None:
+        bg_iterations = -1
+        
+    lib.ncsReduceNoiseStack(out,
+                            numpy.ascontiguousarray(images, dtype = dtype),
+                            numpy.ascontiguousarray(gamma, dtype = dtype),
+                            numpy.ascontiguousarray(otf_mask, dtype = dtype),
+                            alpha,
+                            images.shape[0],
+                            images.shape[1],
+                            images.shape[2],
+                            otf_mask.shape[0],
+                            bg_iterations,
+                            threads)
+    return out
+
+
+def exportWisdom(filename, dtype = numpy.float64):
+    """
+    Save the FFTW wisdom of this session to a file, see importWisdom().
+    The single and double precision libraries have separate wisdom.
+    """
+    if (library(dtype).ncsFFTWExportWisdom(filename.encode()) == 0):
+        raise NCSCException("Could not write FFTW wisdom to " + filename + "!")
+
+
+def frameSize(shape):
+    """
+    Returns a frame size for cReduceNoiseFrame() for an image of the given
+    shape. This is at least 2 pixels larger on each axis, even, and only
+    has small prime factors so that the FFTs are fast.
+    """
+    f_size = []
+    for n in shape:
+        m = scipy.fft.next_fast_len(n + 2, real = True)
+        while ((m%2)!=0):
+            m = scipy.fft.next_fast_len(m + 1, real = True)
+        f_size.append(m)
+    return tuple(f_size)
+
+
+def importWisdom(filename, dtype = numpy.float64):
+    """
+    Load FFTW wisdom saved by exportWisdom(), so that planning with 
+    'measure' or 'patient' (see setPlanner()) does not have to time the
+    plans again for the sizes in the file.
+
+    Returns False if the file could not be read, as on the first run.
+    """
+    return (library(dtype).ncsFFTWImportWisdom(filename.encode()) != 0)
+
+
+def library(dtype):
+    """
+    Returns the C library for arrays of dtype, numpy.float64 or 
+    numpy.float32. The float32 library is only there if the C library
+    was built with single precision FFTW and L-BFGS, see the README. It
+    is usually faster but less accurate, as a rule of thumb the NCS
+    images differ by about 1e-4 of their maximum.
+    """
+    if (numpy.dtype(dtype) == numpy.float64):
+        return ncs
+    if (numpy.dtype(dtype) == numpy.float32):
+        if ncsf is None:
+            raise NCSCException("The single precision C library (ncsf) was not built!")
+        return ncsf
+    raise NCSCException("Unsupported dtype " + str(dtype) + ", use numpy.float64 or numpy.float32!")
+
+
 def pyReduceNoise(image, gamma, otf_mask, alpha, strict = True):
     """
     Run NCS on an image using a mixed C and Python algorithm.
     
     image - The image to run NCS on (in units of e-).
-    gamma - CMOS variance (in units of e-).
+    gamma - CMOS variance (in units of e-), or a calibration object with
+            a gamma attribute like pyNCS's Calibration.
     otf_mask - M x M array containing the OTF mask, where M is usually a power
                of 2, like 16.
     alpha - NCS alpha term.
     """
+    gamma = calibrationGamma(gamma)
     r_size = otf_mask.shape[0]
     s_size = r_size - 2
     
@@ -321,3 +906,25 @@ def pyReduceNoise(image, gamma, otf_mask, alpha, strict = True):
     ncs_sr.cleanup()
     return ncs_image
 
+
+
+def setPlanner(planner):
+    """
+    Set how FFTW plans the FFTs of the sub-regions and frames that are
+    created after this call. One of 'estimate' (the default), 'measure',
+    'patient' or 'exhaustive'. The slower planners time the candidate
+    plans the first time a size is used in a session, later calls look
+    the plan up. Use importWisdom() and exportWisdom() to keep the plans
+    between sessions, for example:
+
+    have_wisdom = importWisdom("ncs.wisdom")
+    setPlanner("measure")
+    ...
+    if not have_wisdom:
+        exportWisdom("ncs.wisdom")
+    """
+    if not planner in fftw_planners:
+        raise NCSCException("Unknown FFTW planner " + str(planner) + "!")
+    for lib in [ncs, ncsf]:
+        if lib is not None:
+            lib.ncsFFTWSetFlags(fftw_planners[planner])
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+#
+# Used for comparing how long the sub-region and the whole frame
+# solvers take on images of different sizes.
+#
+import numpy
+import time
+
+import pyCNCS.ncs_c as ncsC
+
+
+alpha = 0.1
+r_size = 16
+
+
+def createOTFMask(shape):
+   """
+   A high pass mask with the same cut-off (in units of the sampling
+   frequency) as pyOpenCLNCS.py_ref.createOTFMask() for any mask size.
+   """
+   gx = []
+   for n in shape:
+      x = (numpy.arange(n) - n//2)*(16.0/3.0)/n
+      gx.append(numpy.exp(-x*x))
+   rc_filter = 1.0 - numpy.outer(gx[0], gx[1])
+   rc_filter = rc_filter - numpy.min(rc_filter)
+   rc_filter = rc_filter/numpy.max(rc_filter)
+   return numpy.fft.fftshift(rc_filter)
+
+
+def createImage(im_size):
+   """
+   Gaussian spots on a background with shot noise and read noise.
+   """
+   numpy.random.seed(1)
+   
+   x = numpy.arange(im_size)
+   image = numpy.zeros((im_size, im_size)) + 10.0
+   for i in range(im_size*im_size//200):
+      [cx, cy] = numpy.random.uniform(low = 0.0, high = im_size, size = 2)
+      image += 100.0*numpy.outer(numpy.exp(-(x-cx)**2/2.0), numpy.exp(-(x-cy)**2/2.0))
+
+   gamma = numpy.random.uniform(low = 2.0, high = 4.0, size = (im_size, im_size))
+   image = numpy.random.poisson(image) + numpy.random.normal(scale = numpy.sqrt(gamma))
+   image[(image < 1.0)] = 1.0
+   
+   return [image, gamma]
+
+
+def profile(im_size):
+   """
+   Report how long it takes to reduce the noise in an image, with
+   sub-regions and as a whole frame.
+   """
+   [image, gamma] = createImage(im_size)
+
+   start_time = time.time()
+   ncs1 = ncsC.cReduceNoise(image, gamma, createOTFMask((r_size, r_size)), alpha)
+   e_time1 = time.time() - start_time
+
+   f_size = ncsC.frameSize(image.shape)
+   start_time = time.time()
+   ncs2 = ncsC.cReduceNoiseFrame(image, gamma, createOTFMask(f_size), alpha)
+   e_time2 = time.time() - start_time
+
+   diff = numpy.max(numpy.abs(ncs1 - ncs2))/numpy.max(ncs1)
+   print("{0:d} x {0:d}, sub-regions {1:.4f} seconds, frame {2:.4f} seconds, max difference {3:.2e}".format(im_size, e_time1, e_time2, diff))
+
+
+if (__name__ == "__main__"):
+   import argparse
+
+   parser = argparse.ArgumentParser(description = 'NCS sub-region versus whole frame')
+
+   parser.add_argument('--sizes', dest='sizes', type=int, nargs='+', required=False, default = [64, 128, 256, 512],
+                       help = "Image sizes to profile.")
+   args = parser.parse_args()
+
+   for im_size in args.sizes:
+      profile(im_size)
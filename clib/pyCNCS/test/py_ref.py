@@ -9,6 +9,15 @@ import scipy
 import scipy.optimize
 
 
+def backgroundU(data, gamma, otfmask, alpha):
+    s = numpy.mean(data + gamma)
+    tmp = numpy.fft.fft2(data)
+    tmp = tmp/(1.0 + 2.0*alpha*s*numpy.fft.ifftshift(otfmask)**2)
+    u = numpy.real(numpy.fft.ifft2(tmp))
+    u[(u<1.0e-6)] = 1.0e-6
+    return u
+
+
 def calcCost(u, data, gamma, otfmask, alpha):
     u = u.reshape(data.shape)
     noisepart = calcNoiseContribution(u, otfmask)
@@ -51,7 +60,7 @@ def calcNCGradient(u, otfmask):
 
 
 def calcNoiseContribution(u, otfmask):
-    normf = u.shape[0]
+    normf = numpy.sqrt(u.size)
     tmp = numpy.fft.fftshift(numpy.fft.fft2(u))
     tmp = numpy.abs(tmp)/normf
     tmp = (tmp*otfmask)**2
@@ -75,7 +84,12 @@ def ncsSolve(image, gamma, otfmask, alpha, verbose = True):
 
 
 def randomOTFMask(size):
-    psf = numpy.random.uniform(low = 0.0, high = 1.0, size = (size, size))
+    """
+    size is the mask size, or a (size x, size y) tuple for a rectangular mask.
+    """
+    if not isinstance(size, tuple):
+        size = (size, size)
+    psf = numpy.random.uniform(low = 0.0, high = 1.0, size = size)
     otfmask = numpy.real(numpy.fft.fftshift(numpy.fft.fft2(psf)))
 
     # Normalize properly.
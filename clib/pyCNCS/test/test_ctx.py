@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+"""
+Test NCS solver context.
+"""
+import numpy
+import pytest
+
+import pyCNCS.ncs_c as ncsC
+import pyCNCS.test.py_ref as pyRef
+
+
+def test_ctx_1():
+    """
+    Verify that a context gives the same results as cReduceNoise().
+    """
+    im_size = 30
+    r_size = 10
+    alpha = 0.02
+
+    gamma = numpy.random.uniform(low = 2.0, high = 4.0, size = (im_size, im_size + 5))
+    images = numpy.random.uniform(low = 0.01, high = 10.0, size = (3, im_size, im_size + 5))
+    otfmask_shift = numpy.fft.fftshift(pyRef.randomOTFMask(r_size))
+
+    ncs1 = numpy.array([ncsC.cReduceNoise(image, gamma, otfmask_shift, alpha) for image in images])
+    with ncsC.NCSCContext(shape = gamma.shape, gamma = gamma, otf_mask = otfmask_shift, alpha = alpha, threads = 2) as ncs_ctx:
+        for i in range(images.shape[0]):
+            assert(numpy.array_equal(ncs1[i], ncs_ctx.reduce(images[i])))
+
+        out = numpy.zeros_like(images)
+        ncs2 = ncs_ctx.reduceStack(images, out = out)
+        assert(ncs2 is out)
+        assert(numpy.array_equal(ncs1, ncs2))
+
+    assert(ncs_ctx.c_ncs is None)
+
+def test_ctx_2():
+    """
+    Verify that a context works with a new gamma and with initial estimates.
+    """
+    im_size = 30
+    r_size = 10
+    alpha = 0.02
+
+    gamma1 = numpy.random.uniform(low = 2.0, high = 4.0, size = (im_size, im_size))
+    gamma2 = numpy.random.uniform(low = 2.0, high = 4.0, size = (im_size, im_size))
+    image = numpy.random.uniform(low = 0.01, high = 10.0, size = (im_size, im_size))
+    u_init = numpy.random.uniform(low = 0.01, high = 10.0, size = (im_size, im_size))
+    otfmask_shift = numpy.fft.fftshift(pyRef.randomOTFMask(r_size))
+
+    with ncsC.NCSCContext(shape = image.shape, gamma = gamma1, otf_mask = otfmask_shift, alpha = alpha) as ncs_ctx:
+        ncs_ctx.setGamma(gamma2)
+        ncs1 = ncsC.cReduceNoise(image, gamma2, otfmask_shift, alpha)
+        assert(numpy.array_equal(ncs1, ncs_ctx.reduce(image)))
+
+        ncs2 = ncsC.cReduceNoise(image, gamma2, otfmask_shift, alpha, u_init = u_init)
+        assert(numpy.array_equal(ncs2, ncs_ctx.reduce(image, u_init = u_init)))
+
+def test_ctx_3():
+    """
+    Verify that a context and the functions take the OTF mask the same way,
+    and that they all check its symmetry.
+    """
+    im_size = 24
+    r_size = 8
+    alpha = 0.02
+
+    gamma = numpy.random.uniform(low = 2.0, high = 4.0, size = (im_size, im_size))
+    images = numpy.random.uniform(low = 0.01, high = 10.0, size = (2, im_size, im_size))
+
+    # A mask with no symmetry about its center, so a mask that was shifted
+    # one way and not the other gives different results.
+    otfmask = numpy.fft.fftshift(pyRef.randomOTFMask(r_size))
+    otfmask[1:4,0] = 0.0
+    otfmask[-3:,0] = 0.0
+
+    ncs1 = numpy.array([ncsC.cReduceNoise(image, gamma, otfmask, alpha) for image in images])
+    ncs2 = ncsC.cReduceNoiseStack(images, gamma, otfmask, alpha)
+    with ncsC.NCSCContext(shape = gamma.shape, gamma = gamma, otf_mask = otfmask, alpha = alpha) as ncs_ctx:
+        ncs3 = ncs_ctx.reduceStack(images)
+    assert(numpy.array_equal(ncs1, ncs2))
+    assert(numpy.array_equal(ncs1, ncs3))
+
+    ncs4 = ncsC.cReduceNoiseStack(images, gamma, numpy.fft.fftshift(otfmask), alpha)
+    assert(not numpy.allclose(ncs1, ncs4))
+
+    # Masks whose inverse FFT is not real.
+    otfmask[1,0] = 1.0
+    with pytest.raises(ncsC.NCSCException):
+        ncsC.cReduceNoise(images[0], gamma, otfmask, alpha)
+    with pytest.raises(ncsC.NCSCException):
+        ncsC.cReduceNoiseStack(images, gamma, otfmask, alpha)
+    with pytest.raises(ncsC.NCSCException):
+        ncsC.NCSCContext(shape = gamma.shape, gamma = gamma, otf_mask = otfmask, alpha = alpha)
+
+
+if (__name__ == "__main__"):
+    test_ctx_1()
+    test_ctx_2()
+    test_ctx_3()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""
+Test the single precision C library against the double precision one.
+"""
+import numpy
+import pytest
+
+import pyCNCS.ncs_c as ncsC
+
+
+def highPassMask(size):
+    """
+    A smooth high pass OTF mask, like the masks for real microscopes and
+    unlike pyRef.randomOTFMask(), so that the solver converges well.
+    """
+    k = numpy.fft.fftshift(numpy.fft.fftfreq(size))
+    kr = numpy.sqrt(k[:,None]*k[:,None] + k[None,:]*k[None,:])
+    return 1.0 - numpy.exp(-(kr/0.2)**2)
+
+def simImages(n_images, shape):
+    """
+    Gaussian spots on a background with Poisson noise.
+    """
+    rng = numpy.random.default_rng(1)
+    x = numpy.arange(shape[0])[:,None]
+    y = numpy.arange(shape[1])[None,:]
+    images = numpy.zeros((n_images,) + shape)
+    for i in range(n_images):
+        u = numpy.full(shape, 10.0)
+        for j in range(8):
+            [xc, yc] = rng.uniform(low = 0.0, high = shape)
+            u += 200.0*numpy.exp(-((x - xc)**2 + (y - yc)**2)/(2.0*1.5*1.5))
+        images[i] = rng.poisson(u)
+    return images
+
+def skipNoF32():
+    if ncsC.ncsf is None:
+        pytest.skip("The single precision C library was not built.")
+
+def test_f32_1():
+    """
+    Verify that single precision cReduceNoise() agrees with double precision.
+    """
+    skipNoF32()
+    alpha = 0.2
+
+    image = simImages(1, (40, 44))[0]
+    gamma = numpy.full(image.shape, 2.0)
+    otfmask_shift = numpy.fft.fftshift(highPassMask(16))
+
+    ncs1 = ncsC.cReduceNoise(image, gamma, otfmask_shift, alpha)
+    ncs2 = ncsC.cReduceNoise(image, gamma, otfmask_shift, alpha, dtype = numpy.float32)
+    assert(ncs2.dtype == numpy.float32)
+    assert(numpy.allclose(ncs1, ncs2, rtol = 0.0, atol = 1.0e-3*numpy.max(ncs1)))
+
+def test_f32_2():
+    """
+    Verify that single precision stacks and contexts agree with double precision.
+    """
+    skipNoF32()
+    alpha = 0.2
+
+    images = simImages(3, (40, 40))
+    gamma = numpy.random.uniform(low = 2.0, high = 4.0, size = images.shape[1:])
+    otfmask = highPassMask(16)
+    otfmask_shift = numpy.fft.fftshift(otfmask)
+
+    ncs1 = ncsC.cReduceNoiseStack(images, gamma, otfmask_shift, alpha)
+    ncs2 = ncsC.cReduceNoiseStack(images, gamma, otfmask_shift, alpha, threads = 2, dtype = numpy.float32)
+    assert(ncs2.dtype == numpy.float32)
+    assert(numpy.allclose(ncs1, ncs2, rtol = 0.0, atol = 1.0e-3*numpy.max(ncs1)))
+
+    with ncsC.NCSCContext(shape = gamma.shape, gamma = gamma, otf_mask = otfmask_shift, alpha = alpha, dtype = numpy.float32) as ncs_ctx:
+        assert(numpy.array_equal(ncs2, ncs_ctx.reduceStack(images)))
+
+def test_f32_3():
+    """
+    Verify that the output array must match the dtype.
+    """
+    skipNoF32()
+    images = simImages(1, (20, 20))
+    out = numpy.zeros(images.shape)
+    with pytest.raises(ncsC.NCSCException):
+        ncsC.cReduceNoiseStack(images, numpy.full(images.shape[1:], 2.0), numpy.fft.fftshift(highPassMask(8)), 0.2, out = out, dtype = numpy.float32)
+
+
+if (__name__ == "__main__"):
+    test_f32_1()
+    test_f32_2()
+    test_f32_3()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+Test NCS whole frame calculations.
+"""
+import numpy
+import scipy
+import scipy.optimize
+
+import pyCNCS.ncs_c as ncsC
+import pyCNCS.test.py_ref as pyRef
+
+def test_fr_1():
+    """
+    Test cost and cost gradient calculation on a rectangular frame.
+    """
+    f_size = (10, 14)
+    alpha = 0.2
+    ncs_fr = ncsC.NCSCFrame(f_size)
+
+    for i in range(5):
+        gamma = numpy.random.uniform(low = 2.0, high = 4.0, size = f_size)
+        image = numpy.random.uniform(low = 0.01, high = 10.0, size = f_size)
+        u = numpy.random.uniform(low = 0.01, high = 10.0, size = f_size)
+        otfmask = pyRef.randomOTFMask(f_size)
+
+        ncs_fr.setOTFMask(otfmask)
+        ncs_fr.newImage(image, gamma)
+        ncs_fr.setU(u)
+        [t1, g1] = ncs_fr.calcCostGradient(alpha)
+
+        t2 = pyRef.calcCost(u, image, gamma, otfmask, alpha)
+        g2 = pyRef.calcLLGradient(u, image, gamma) + alpha*pyRef.calcNCGradient(u, otfmask)
+
+        assert(numpy.allclose(t1,t2))
+        assert(numpy.allclose(g1.flatten(),g2,atol = 1.0e-4))
+
+    ncs_fr.cleanup()
+
+def test_fr_2():
+    """
+    Verify that the C solver agrees with scipy on the padded frame.
+    """
+    im_size = (9, 12)
+    alpha = 0.2
+    f_size = ncsC.frameSize(im_size)
+
+    gamma = numpy.random.uniform(low = 2.0, high = 4.0, size = im_size)
+    image = numpy.random.uniform(low = 0.01, high = 10.0, size = im_size)
+    otfmask = pyRef.randomOTFMask(f_size)
+
+    ncs1 = ncsC.cReduceNoiseFrame(image, gamma, numpy.fft.ifftshift(otfmask), alpha)
+
+    # Padded frame.
+    pad = ((1, f_size[0] - im_size[0] - 1), (1, f_size[1] - im_size[1] - 1))
+    pad_image = numpy.pad(image, pad, 'edge')
+    pad_gamma = numpy.pad(gamma, pad, 'edge')
+
+    ncs_fr = ncsC.NCSCFrame(f_size)
+    ncs_fr.setOTFMask(otfmask)
+    ncs_fr.newImage(pad_image, pad_gamma)
+
+    def fn(u):
+        ncs_fr.setU(u.reshape(f_size))
+        [cost, gradient] = ncs_fr.calcCostGradient(alpha)
+        return [cost, gradient.flatten()]
+
+    # Like the C solver this is unbounded, u only has to be larger than -gamma.
+    outi = scipy.optimize.minimize(fn,
+                                   pad_image.flatten(),
+                                   jac = True,
+                                   method = 'L-BFGS-B',
+                                   options = {'maxiter' : 1000, 'ftol' : 1.0e-12, 'gtol' : 1.0e-8})
+    ncs2 = outi.x.reshape(f_size)[1:im_size[0]+1,1:im_size[1]+1]
+    ncs_fr.cleanup()
+
+    norm_diff = numpy.max(numpy.abs(ncs1 - ncs2))/numpy.max(ncs1)
+    assert(norm_diff < 1.0e-3), str(norm_diff)
+
+    
+if (__name__ == "__main__"):
+    test_fr_1()
+    test_fr_2()
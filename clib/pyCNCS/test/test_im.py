@@ -5,6 +5,8 @@ Test NCS on an image.
 Hazen 04/19
 """
 import numpy
+import os
+import tempfile
 
 import pyCNCS.ncs_c as ncsC
 import pyCNCS.test.py_ref as pyRef
@@ -37,7 +39,131 @@ def test_im_1():
             
             assert(numpy.allclose(ncs1,ncs2))
 
+def test_im_2():
+    """
+    Verify that starting from an initial estimate works.
+    """
+    im_size = 30
+    r_size = 10
+    alpha = 0.02
+    
+    gamma = numpy.random.uniform(low = 2.0, high = 4.0, size = (im_size, im_size))
+    image = numpy.random.uniform(low = 0.01, high = 10.0, size = (im_size, im_size))
+    otfmask_shift = numpy.fft.fftshift(pyRef.randomOTFMask(r_size))
+
+    ncs1 = ncsC.cReduceNoise(image, gamma, otfmask_shift, alpha)
+
+    # Starting from the image is the same as the default.
+    ncs2 = ncsC.cReduceNoise(image, gamma, otfmask_shift, alpha, u_init = image)
+    assert(numpy.allclose(ncs1,ncs2))
+
+    # Starting from the solution should not move away from it, beyond
+    # the solver tolerance.
+    ncs3 = ncsC.cReduceNoise(image, gamma, otfmask_shift, alpha, u_init = ncs1)
+    norm_diff = numpy.max(numpy.abs(ncs1 - ncs3))/numpy.max(ncs1)
+    assert(norm_diff < 1.0e-3), str(norm_diff)
+
+def test_im_3():
+    """
+    Verify that a calibration object can be used in place of gamma.
+    """
+    class Calibration(object):
+        pass
+    
+    im_size = 30
+    r_size = 10
+    alpha = 0.02
+    
+    calibration = Calibration()
+    calibration.gamma = numpy.random.uniform(low = 2.0, high = 4.0, size = (im_size, im_size))
+    image = numpy.random.uniform(low = 0.01, high = 10.0, size = (im_size, im_size))
+    otfmask_shift = numpy.fft.fftshift(pyRef.randomOTFMask(r_size))
+
+    ncs1 = ncsC.cReduceNoise(image, calibration.gamma, otfmask_shift, alpha)
+    ncs2 = ncsC.cReduceNoise(image, calibration, otfmask_shift, alpha)
+    assert(numpy.allclose(ncs1,ncs2))
+
+def test_im_4():
+    """
+    Verify that the multithreaded version gives the same result on a 
+    variety of image sizes.
+    """
+    im_size = 30
+    r_size = 10
+    alpha = 0.02
+    
+    gamma = numpy.random.uniform(low = 2.0, high = 4.0, size = (im_size, im_size))
+    image = numpy.random.uniform(low = 0.01, high = 10.0, size = (im_size, im_size))
+    otfmask_shift = numpy.fft.fftshift(pyRef.randomOTFMask(r_size))
+
+    for ix in range(0,12,3):
+        for iy in range(0,12,5):
+            ncs1 = ncsC.cReduceNoise(image[ix:im_size,iy:im_size],
+                                     gamma[ix:im_size,iy:im_size],
+                                     otfmask_shift,
+                                     alpha)
+            ncs2 = ncsC.cReduceNoise(image[ix:im_size,iy:im_size],
+                                     gamma[ix:im_size,iy:im_size],
+                                     otfmask_shift,
+                                     alpha,
+                                     threads = 4)
+            assert(numpy.array_equal(ncs1,ncs2))
+
+def test_im_5():
+    """
+    Verify that running NCS on a stack gives the same results as running
+    it on each image.
+    """
+    im_size = 20
+    r_size = 10
+    alpha = 0.02
+    
+    gamma = numpy.random.uniform(low = 2.0, high = 4.0, size = (im_size, im_size + 3))
+    images = numpy.random.uniform(low = 0.01, high = 10.0, size = (5, im_size, im_size + 3))
+    otfmask_shift = numpy.fft.fftshift(pyRef.randomOTFMask(r_size))
+
+    ncs1 = numpy.array([ncsC.cReduceNoise(image, gamma, otfmask_shift, alpha) for image in images])
+    ncs2 = ncsC.cReduceNoiseStack(images, gamma, otfmask_shift, alpha)
+    assert(numpy.array_equal(ncs1,ncs2))
+
+    out = numpy.zeros_like(images)
+    ncs3 = ncsC.cReduceNoiseStack(images, gamma, otfmask_shift, alpha, threads = 3, out = out)
+    assert(ncs3 is out)
+    assert(numpy.array_equal(ncs1,ncs3))
+
+def test_im_6():
+    """
+    Verify that FFTW planning with 'measure' and saving and loading 
+    the FFTW wisdom works.
+    """
+    im_size = 30
+    r_size = 10
+    alpha = 0.02
+    
+    gamma = numpy.random.uniform(low = 2.0, high = 4.0, size = (im_size, im_size))
+    image = numpy.random.uniform(low = 0.01, high = 10.0, size = (im_size, im_size))
+    otfmask_shift = numpy.fft.fftshift(pyRef.randomOTFMask(r_size))
+
+    ncs1 = ncsC.cReduceNoise(image, gamma, otfmask_shift, alpha)
+    try:
+        ncsC.setPlanner("measure")
+        ncs2 = ncsC.cReduceNoise(image, gamma, otfmask_shift, alpha)
+    finally:
+        ncsC.setPlanner("estimate")
+    assert(numpy.allclose(ncs1,ncs2))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        wisdom = os.path.join(tmp_dir, "ncs.wisdom")
+        assert not ncsC.importWisdom(wisdom)
+        ncsC.exportWisdom(wisdom)
+        assert ncsC.importWisdom(wisdom)
+
     
 if (__name__ == "__main__"):
     test_im_1()
+    test_im_2()
+    test_im_3()
+    test_im_4()
+    test_im_5()
+    test_im_6()
     
@@ -129,7 +129,40 @@ def test_sr_5():
 
     ncs_sr.cleanup()
 
+def test_sr_6():
+    """
+    Test background detection and the background estimate.
+    """
+    im_size = 16
+    ncs_sr = ncsC.NCSCSubRegion(im_size)
+    alpha = 0.02
+
+    for i in range(10):
+        gamma = numpy.random.uniform(low = 2.0, high = 4.0, size = (im_size, im_size))
+        image = numpy.random.poisson(lam = 20.0, size = (im_size, im_size)) + numpy.random.normal(scale = numpy.sqrt(gamma))
+        otfmask = pyRef.randomOTFMask(im_size)
+
+        ncs_sr.newRegion(image, gamma)
+        ncs_sr.setOTFMask(otfmask)
+        ncs_sr.backgroundU(alpha)
+
+        u1 = pyRef.backgroundU(image, gamma, otfmask, alpha)
+        u2 = ncs_sr.getU()
+        assert(numpy.allclose(u1, u2))
+
+        # A flat tile is usually background, with a spot it is not.
+        image[8,8] += 200.0
+        ncs_sr.newRegion(image, gamma)
+        assert not ncs_sr.isBackground()
+
+    image = numpy.full((im_size, im_size), 20.0)
+    ncs_sr.newRegion(image, gamma)
+    assert ncs_sr.isBackground()
+        
+    ncs_sr.cleanup()
+
     
 if (__name__ == "__main__"):
     test_sr_5()
+    test_sr_6()
     
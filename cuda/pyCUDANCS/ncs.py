@@ -29,10 +29,13 @@ class NCSCUDA(object):
    def __init__(self, strict = True, **kwds):
       super().__init__(**kwds)
 
+      self.gamma = None
+      self.gamma_shape = None
+      self.gamma_tiles = None
       self.size = 16
       self.strict = strict
 
-   def reduceNoise(self, images, alpha, verbose = False):
+   def reduceNoise(self, images, alpha, verbose = False, background = False):
       """
       Ideally you process lots of images at the same time for 
       optimal GPU utilization.
@@ -42,27 +45,23 @@ class NCSCUDA(object):
 
       images - A list of images to run NCS on (in units of e-).
       alpha - NCS alpha term.
+      background - If True, sub-regions that look like pure background
+                   get a closed form estimate on the host, and only the
+                   rest are sent to the GPU.
       """
 
       s_size = self.size - 2
       im0_shape = images[0].shape
 
-      # First, figure out how many sub-regions in total.
-      pad_image = numpy.pad(images[0], 1, 'edge')
-      pad_gamma = numpy.pad(self.gamma, 1, 'edge').astype(numpy.float32)
-
-      num_sr = 0
-      for i in range(0, pad_image.shape[0], s_size):
-         for j in range(0, pad_image.shape[1], s_size):
-            num_sr += 1
-
-      num_sr = num_sr * len(images)
+      # The gamma sub-regions are the same for all the images.
+      gamma_tiles = self.gammaTiles(im0_shape)
+      num_sr = gamma_tiles.shape[0] * len(images)
       if verbose:
          print("Creating", num_sr, "sub-regions.")
 
       # Now chop up the images into lots of sub-regions.
       data_in = numpy.zeros((num_sr, self.size, self.size), dtype = numpy.float32)
-      gamma = numpy.zeros((num_sr, self.size, self.size), dtype = numpy.float32)
+      gamma = numpy.tile(gamma_tiles, (len(images), 1, 1))
       data_out = numpy.zeros((num_sr, self.size, self.size), dtype = numpy.float32)
       iters = numpy.zeros(num_sr, dtype = numpy.int32)
       status = numpy.zeros(num_sr, dtype = numpy.int32)
@@ -95,7 +94,6 @@ class NCSCUDA(object):
                ey = by + self.size
 
                data_in[counter,:,:] = pad_image[bx:ex,by:ey].astype(numpy.float32)
-               gamma[counter,:,:] = pad_gamma[bx:ex,by:ey]
 
                im_i[counter] = h
                im_bx[counter] = bx
@@ -108,25 +106,55 @@ class NCSCUDA(object):
       assert (counter == num_sr)
       assert (data_in.dtype == numpy.float32)
       assert (gamma.dtype == numpy.float32)
+
+      # Background sub-regions get the closed form estimate here, the
+      # kernel only runs on the others.
+      if background:
+         is_bg = isBackground(data_in, gamma)
+         data_out[is_bg] = backgroundU(data_in[is_bg], gamma[is_bg], self.otf_mask, alpha)
+         solve = numpy.flatnonzero(~is_bg)
+         if verbose:
+            print("Found", numpy.count_nonzero(is_bg), "background sub-regions.")
             
+         k_data_in = data_in[solve]
+         k_gamma = gamma[solve]
+      else:
+         solve = None
+         k_data_in = data_in
+         k_gamma = gamma
+      n_solve = k_data_in.shape[0]
+      k_data_out = numpy.zeros_like(k_data_in)
+      k_iters = numpy.zeros(n_solve, dtype = numpy.int32)
+      k_status = numpy.zeros(n_solve, dtype = numpy.int32)
+      
       # Run NCS noise reduction kernel on the sub-regions.
       #
       # FIXME: We could probably do a better job measuring the elapsed time.
       #
-      start_time = time.time()
-      ncsReduceNoise(drv.In(data_in),
-                     drv.In(gamma),
-                     drv.In(self.otf_mask),
-                     drv.Out(data_out),
-                     drv.Out(iters),
-                     drv.Out(status),
-                     numpy.float32(alpha),
-                     block = (16,1,1),
-                     grid = (num_sr,1))
-      e_time = time.time() - start_time
+      if (n_solve > 0):
+         start_time = time.time()
+         ncsReduceNoise(drv.In(k_data_in),
+                        drv.In(k_gamma),
+                        drv.In(self.otf_mask),
+                        drv.Out(k_data_out),
+                        drv.Out(k_iters),
+                        drv.Out(k_status),
+                        numpy.float32(alpha),
+                        block = (16,1,1),
+                        grid = (n_solve,1))
+         e_time = time.time() - start_time
       
-      if verbose:
-         print("Processed {0:d} sub-regions in {1:.6f} seconds.".format(num_sr, e_time))
+         if verbose:
+            print("Processed {0:d} sub-regions in {1:.6f} seconds.".format(n_solve, e_time))
+
+      if solve is None:
+         data_out = k_data_out
+         iters = k_iters
+         status = k_status
+      else:
+         data_out[solve] = k_data_out
+         iters[solve] = k_iters
+         status[solve] = k_status
 
       # Check status.
       failures = {}
@@ -172,13 +200,37 @@ class NCSCUDA(object):
 
       return nc_images
    
+   def gammaTiles(self, shape):
+      """
+      Returns the (N, 16, 16) gamma sub-regions for images of the given
+      shape. These are cut once and then reused until gamma changes.
+      """
+      if (self.gamma_tiles is None) or (self.gamma_shape != shape):
+         if self.strict and (self.gamma.shape != shape):
+            raise NCSCUDAException("gamma must be the same size as the images!")
+
+         s_size = self.size - 2
+         pad_gamma = numpy.pad(self.gamma, 1, 'edge')
+         tiles = []
+         for i in range(0, pad_gamma.shape[0], s_size):
+            bx = min(i, pad_gamma.shape[0] - self.size)
+            for j in range(0, pad_gamma.shape[1], s_size):
+               by = min(j, pad_gamma.shape[1] - self.size)
+               tiles.append(pad_gamma[bx:bx+self.size,by:by+self.size])
+         self.gamma_tiles = numpy.array(tiles, dtype = numpy.float32)
+         self.gamma_shape = shape
+      return self.gamma_tiles
+
    def setGamma(self, gamma):
       """
       The assumption is that this is the same for all the images.
       
-      gamma - CMOS variance (in units of e-).
+      gamma - CMOS variance (in units of e-), or a calibration object
+              with a gamma attribute like pyNCS's Calibration.
       """
-      self.gamma = gamma.astype(numpy.float32)
+      self.gamma = numpy.asarray(getattr(gamma, "gamma", gamma)).astype(numpy.float32)
+      self.gamma_shape = None
+      self.gamma_tiles = None
         
    def setOTFMask(self, otf_mask):
         
@@ -197,6 +249,24 @@ class NCSCUDA(object):
       self.otf_mask = numpy.fft.fftshift(otf_mask).astype(numpy.float32)
         
 
+def backgroundU(data, gamma, otf_mask, alpha):
+   """
+   Closed form estimate for background sub-regions, this matches
+   ncsSRBackgroundU() in the C library.
+
+   data - (N, 16, 16) sub-regions.
+   gamma - (N, 16, 16) CMOS variance.
+   otf_mask - The shifted OTF mask, as stored by NCSCUDA.setOTFMask().
+   alpha - NCS alpha term.
+   """
+   s = numpy.mean(data + gamma, axis = (1,2), keepdims = True)
+   tmp = numpy.fft.fft2(data)
+   tmp = tmp/(1.0 + 2.0*alpha*s*otf_mask*otf_mask)
+   u = numpy.real(numpy.fft.ifft2(tmp)).astype(numpy.float32)
+   u[(u<1.0e-6)] = 1.0e-6
+   return u
+
+
 def checkOTFMask(otf_mask):
    """
    Verify that the OTF mask has the correct symmetries.
@@ -208,7 +278,19 @@ def checkOTFMask(otf_mask):
       return True
      
 
-def reduceNoise(images, gamma, otf_mask, alpha, strict = True, verbose = False):
+def isBackground(data, gamma, n_sigma = 3.0):
+   """
+   Returns which of the (N, 16, 16) sub-regions look like pure background,
+   i.e. their spread about the mean is what shot noise plus read noise give.
+   This matches ncsSRIsBackground() in the C library.
+   """
+   n = data.shape[1]*data.shape[2]
+   m = numpy.mean(data, axis = (1,2), keepdims = True)
+   chi2 = numpy.sum((data - m)**2/(m + gamma), axis = (1,2))/(n - 1)
+   return (chi2 < 1.0 + n_sigma*numpy.sqrt(2.0/(n - 1)))
+
+
+def reduceNoise(images, gamma, otf_mask, alpha, strict = True, verbose = False, background = False):
    """
    Run NCS on an image using OpenCL.
 
@@ -216,11 +298,12 @@ def reduceNoise(images, gamma, otf_mask, alpha, strict = True, verbose = False):
          be replaced with a small positive value like 1.0.
     
    images - The image to run NCS on (in units of e-).
-   gamma - CMOS variance (in units of e-).
+   gamma - CMOS variance (in units of e-), or a calibration object.
    otf_mask - 16 x 16 array containing the OTF mask.
    alpha - NCS alpha term.
+   background - Solve background sub-regions in closed form on the host.
    """
    ncs = NCSCUDA()
    ncs.setOTFMask(otf_mask)
    ncs.setGamma(gamma)
-   return ncs.reduceNoise(images, alpha, verbose = verbose)
+   return ncs.reduceNoise(images, alpha, verbose = verbose, background = background)
@@ -810,6 +810,8 @@ void converged(__local int *w1,
  *       set to a small positive value like 1.0.
  *
  * data_in - Sub-region data in e-.
+ * u_init - Sub-region initial estimate, pass data_in again to start from
+ *          the data.
  * g_gamma - Sub-region CMOS variance in units of e-^2.
  * otf_mask - 16 x 16 array containing the OTF mask.
  * data_out - Storage for noise corrected sub-regions.
@@ -818,6 +820,7 @@ void converged(__local int *w1,
  * alpha - NCS alpha term.
  */
 __kernel void ncsReduceNoise(__global float4 *data_in,
+                             __global float4 *u_init,
                              __global float4 *g_gamma,
                              __global float4 *otf_mask,
                              __global float4 *data_out,
@@ -878,7 +881,7 @@ __kernel void ncsReduceNoise(__global float4 *data_in,
         data[k] = data_in[i_g+k];
         gamma[k] = g_gamma[i_g+k];
         otf_mask_sqr[k] = otf_mask[k] * otf_mask[k];
-        u_r[k] = data_in[i_g+k];
+        u_r[k] = u_init[i_g+k];
 	u_c[k] = (float4)(0.0f, 0.0f, 0.0f, 0.0f);
     }
     
@@ -41,10 +41,13 @@ class NCSOpenCL(object):
    def __init__(self, strict = True, **kwds):
       super().__init__(**kwds)
 
+      self.gamma = None
+      self.gamma_shape = None
+      self.gamma_tiles = None
       self.size = 16
       self.strict = strict
 
-   def reduceNoise(self, images, alpha, verbose = False):
+   def reduceNoise(self, images, alpha, verbose = False, u_init = None, background = False):
       """
       Ideally you process lots of images at the same time for 
       optimal GPU utilization.
@@ -54,27 +57,31 @@ class NCSOpenCL(object):
 
       images - A list of images to run NCS on (in units of e-).
       alpha - NCS alpha term.
+      u_init - Optional list of initial estimates, one for each image,
+               to start the solver from instead of the images.
+      background - If True, sub-regions that look like pure background
+                   get a closed form estimate on the host, and only the
+                   rest are sent to the GPU.
       """
 
       s_size = self.size - 2
       im0_shape = images[0].shape
 
-      # First, figure out how many sub-regions in total.
-      pad_image = numpy.pad(images[0], 1, 'edge')
-      pad_gamma = numpy.pad(self.gamma, 1, 'edge').astype(numpy.float32)
-
-      num_sr = 0
-      for i in range(0, pad_image.shape[0], s_size):
-         for j in range(0, pad_image.shape[1], s_size):
-            num_sr += 1
-
-      num_sr = num_sr * len(images)
+      # The gamma sub-regions are the same for all the images.
+      gamma_tiles = self.gammaTiles(im0_shape)
+      num_sr = gamma_tiles.shape[0] * len(images)
       if verbose:
          print("Creating", num_sr, "sub-regions.")
 
+      if u_init is not None:
+         if (len(u_init) != len(images)):
+            raise NCSOpenCLException("u_init must have one estimate for each image!")
+         
       # Now chop up the images into lots of sub-regions.
       data_in = numpy.zeros((num_sr, self.size, self.size), dtype = numpy.float32)
-      gamma = numpy.zeros((num_sr, self.size, self.size), dtype = numpy.float32)
+      if u_init is not None:
+         u_in = numpy.zeros((num_sr, self.size, self.size), dtype = numpy.float32)
+      gamma = numpy.tile(gamma_tiles, (len(images), 1, 1))
       data_out = numpy.zeros((num_sr, self.size, self.size), dtype = numpy.float32)
       iters = numpy.zeros(num_sr, dtype = numpy.int32)
       status = numpy.zeros(num_sr, dtype = numpy.int32)
@@ -92,6 +99,11 @@ class NCSOpenCL(object):
             raise NCSOpenCLException("All images must be the same size!")
             
          pad_image = numpy.pad(images[h], 1, 'edge')
+         if u_init is not None:
+            if (u_init[h].shape != im0_shape):
+               raise NCSOpenCLException("u_init must be the same size as the images!")
+            pad_u = numpy.pad(u_init[h], 1, 'edge')
+            
          for i in range(0, pad_image.shape[0], s_size):
             if ((i + self.size) > pad_image.shape[0]):
                bx = pad_image.shape[0] - self.size
@@ -107,7 +119,8 @@ class NCSOpenCL(object):
                ey = by + self.size
 
                data_in[counter,:,:] = pad_image[bx:ex,by:ey].astype(numpy.float32)
-               gamma[counter,:,:] = pad_gamma[bx:ex,by:ey]
+               if u_init is not None:
+                  u_in[counter,:,:] = pad_u[bx:ex,by:ey].astype(numpy.float32)
 
                im_i[counter] = h
                im_bx[counter] = bx
@@ -120,38 +133,76 @@ class NCSOpenCL(object):
       assert (counter == num_sr)
       assert (data_in.dtype == numpy.float32)
       assert (gamma.dtype == numpy.float32)
+
+      # Background sub-regions get the closed form estimate here, the
+      # kernel only runs on the others.
+      if background:
+         is_bg = isBackground(data_in, gamma)
+         data_out[is_bg] = backgroundU(data_in[is_bg], gamma[is_bg], self.otf_mask, alpha)
+         solve = numpy.flatnonzero(~is_bg)
+         if verbose:
+            print("Found", numpy.count_nonzero(is_bg), "background sub-regions.")
             
+         k_data_in = data_in[solve]
+         k_gamma = gamma[solve]
+         if u_init is not None:
+            u_in = u_in[solve]
+      else:
+         solve = None
+         k_data_in = data_in
+         k_gamma = gamma
+      n_solve = k_data_in.shape[0]
+      k_data_out = numpy.zeros_like(k_data_in)
+      k_iters = numpy.zeros(n_solve, dtype = numpy.int32)
+      k_status = numpy.zeros(n_solve, dtype = numpy.int32)
+
       # Run OpenCL noise reduction kernel on the sub-regions.
-      data_in_buffer = cl.Buffer(context, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, 
-                                 hostbuf = data_in)
-      gamma_buffer = cl.Buffer(context, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, 
-                               hostbuf = gamma)
-      otf_mask_buffer = cl.Buffer(context, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, 
-                                  hostbuf = self.otf_mask)
-      data_out_buffer = cl.Buffer(context, cl.mem_flags.WRITE_ONLY | cl.mem_flags.COPY_HOST_PTR, 
-                                  hostbuf = data_out)
-      iters_buffer = cl.Buffer(context, cl.mem_flags.WRITE_ONLY | cl.mem_flags.COPY_HOST_PTR, 
-                               hostbuf = iters)
-      status_buffer = cl.Buffer(context, cl.mem_flags.WRITE_ONLY | cl.mem_flags.COPY_HOST_PTR, 
-                                hostbuf = status)
-
-      ev1 = program.ncsReduceNoise(queue, (num_sr*16,), (16,),
-                                   data_in_buffer,
-                                   gamma_buffer,
-                                   otf_mask_buffer,
-                                   data_out_buffer,
-                                   iters_buffer,
-                                   status_buffer,
-                                   numpy.float32(alpha))
-
-      cl.enqueue_copy(queue, data_out, data_out_buffer).wait()
-      cl.enqueue_copy(queue, iters, iters_buffer).wait()
-      cl.enqueue_copy(queue, status, status_buffer).wait()
-      queue.finish()
+      if (n_solve > 0):
+         data_in_buffer = cl.Buffer(context, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, 
+                                    hostbuf = k_data_in)
+         if u_init is not None:
+            u_init_buffer = cl.Buffer(context, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, 
+                                      hostbuf = u_in)
+         else:
+            u_init_buffer = data_in_buffer
+         gamma_buffer = cl.Buffer(context, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, 
+                                  hostbuf = k_gamma)
+         otf_mask_buffer = cl.Buffer(context, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, 
+                                     hostbuf = self.otf_mask)
+         data_out_buffer = cl.Buffer(context, cl.mem_flags.WRITE_ONLY | cl.mem_flags.COPY_HOST_PTR, 
+                                     hostbuf = k_data_out)
+         iters_buffer = cl.Buffer(context, cl.mem_flags.WRITE_ONLY | cl.mem_flags.COPY_HOST_PTR, 
+                                  hostbuf = k_iters)
+         status_buffer = cl.Buffer(context, cl.mem_flags.WRITE_ONLY | cl.mem_flags.COPY_HOST_PTR, 
+                                   hostbuf = k_status)
+
+         ev1 = program.ncsReduceNoise(queue, (n_solve*16,), (16,),
+                                      data_in_buffer,
+                                      u_init_buffer,
+                                      gamma_buffer,
+                                      otf_mask_buffer,
+                                      data_out_buffer,
+                                      iters_buffer,
+                                      status_buffer,
+                                      numpy.float32(alpha))
+
+         cl.enqueue_copy(queue, k_data_out, data_out_buffer).wait()
+         cl.enqueue_copy(queue, k_iters, iters_buffer).wait()
+         cl.enqueue_copy(queue, k_status, status_buffer).wait()
+         queue.finish()
       
-      if verbose:
-         e_time = 1.0e-9*(ev1.profile.end - ev1.profile.start)
-         print("Processed {0:d} sub-regions in {1:.6f} seconds.".format(num_sr, e_time))
+         if verbose:
+            e_time = 1.0e-9*(ev1.profile.end - ev1.profile.start)
+            print("Processed {0:d} sub-regions in {1:.6f} seconds.".format(n_solve, e_time))
+
+      if solve is None:
+         data_out = k_data_out
+         iters = k_iters
+         status = k_status
+      else:
+         data_out[solve] = k_data_out
+         iters[solve] = k_iters
+         status[solve] = k_status
 
       # Check status.
       failures = {}
@@ -197,13 +248,37 @@ class NCSOpenCL(object):
 
       return nc_images
    
+   def gammaTiles(self, shape):
+      """
+      Returns the (N, 16, 16) gamma sub-regions for images of the given
+      shape. These are cut once and then reused until gamma changes.
+      """
+      if (self.gamma_tiles is None) or (self.gamma_shape != shape):
+         if self.strict and (self.gamma.shape != shape):
+            raise NCSOpenCLException("gamma must be the same size as the images!")
+
+         s_size = self.size - 2
+         pad_gamma = numpy.pad(self.gamma, 1, 'edge')
+         tiles = []
+         for i in range(0, pad_gamma.shape[0], s_size):
+            bx = min(i, pad_gamma.shape[0] - self.size)
+            for j in range(0, pad_gamma.shape[1], s_size):
+               by = min(j, pad_gamma.shape[1] - self.size)
+               tiles.append(pad_gamma[bx:bx+self.size,by:by+self.size])
+         self.gamma_tiles = numpy.array(tiles, dtype = numpy.float32)
+         self.gamma_shape = shape
+      return self.gamma_tiles
+
    def setGamma(self, gamma):
       """
       The assumption is that this is the same for all the images.
       
-      gamma - CMOS variance (in units of e-).
+      gamma - CMOS variance (in units of e-), or a calibration object
+              with a gamma attribute like pyNCS's Calibration.
       """
-      self.gamma = gamma.astype(numpy.float32)
+      self.gamma = numpy.asarray(getattr(gamma, "gamma", gamma)).astype(numpy.float32)
+      self.gamma_shape = None
+      self.gamma_tiles = None
         
    def setOTFMask(self, otf_mask):
         
@@ -222,6 +297,24 @@ class NCSOpenCL(object):
       self.otf_mask = numpy.fft.fftshift(otf_mask).astype(numpy.float32)
         
 
+def backgroundU(data, gamma, otf_mask, alpha):
+   """
+   Closed form estimate for background sub-regions, this matches
+   ncsSRBackgroundU() in the C library.
+
+   data - (N, 16, 16) sub-regions.
+   gamma - (N, 16, 16) CMOS variance.
+   otf_mask - The shifted OTF mask, as stored by NCSOpenCL.setOTFMask().
+   alpha - NCS alpha term.
+   """
+   s = numpy.mean(data + gamma, axis = (1,2), keepdims = True)
+   tmp = numpy.fft.fft2(data)
+   tmp = tmp/(1.0 + 2.0*alpha*s*otf_mask*otf_mask)
+   u = numpy.real(numpy.fft.ifft2(tmp)).astype(numpy.float32)
+   u[(u<1.0e-6)] = 1.0e-6
+   return u
+
+
 def checkOTFMask(otf_mask):
    """
    Verify that the OTF mask has the correct symmetries.
@@ -233,7 +326,19 @@ def checkOTFMask(otf_mask):
       return True
      
 
-def reduceNoise(images, gamma, otf_mask, alpha, strict = True, verbose = False):
+def isBackground(data, gamma, n_sigma = 3.0):
+   """
+   Returns which of the (N, 16, 16) sub-regions look like pure background,
+   i.e. their spread about the mean is what shot noise plus read noise give.
+   This matches ncsSRIsBackground() in the C library.
+   """
+   n = data.shape[1]*data.shape[2]
+   m = numpy.mean(data, axis = (1,2), keepdims = True)
+   chi2 = numpy.sum((data - m)**2/(m + gamma), axis = (1,2))/(n - 1)
+   return (chi2 < 1.0 + n_sigma*numpy.sqrt(2.0/(n - 1)))
+
+
+def reduceNoise(images, gamma, otf_mask, alpha, strict = True, verbose = False, warm_start = False, background = False):
    """
    Run NCS on an image using OpenCL.
 
@@ -241,11 +346,22 @@ def reduceNoise(images, gamma, otf_mask, alpha, strict = True, verbose = False):
          be replaced with a small positive value like 1.0.
     
    images - The image to run NCS on (in units of e-).
-   gamma - CMOS variance (in units of e-).
+   gamma - CMOS variance (in units of e-), or a calibration object.
    otf_mask - 16 x 16 array containing the OTF mask.
    alpha - NCS alpha term.
+   warm_start - Start the solver for each image from the NCS result of
+                the previous image. The images are then processed one at
+                a time, so this only pays off if it saves more iterations
+                than the GPU loses by working on fewer sub-regions.
+   background - Solve background sub-regions in closed form on the host.
    """
    ncs = NCSOpenCL()
    ncs.setOTFMask(otf_mask)
    ncs.setGamma(gamma)
-   return ncs.reduceNoise(images, alpha, verbose = verbose)
+   if not warm_start:
+      return ncs.reduceNoise(images, alpha, verbose = verbose, background = background)
+
+   nc_images = ncs.reduceNoise(images[:1], alpha, verbose = verbose, background = background)
+   for image in images[1:]:
+      nc_images += ncs.reduceNoise([image], alpha, verbose = verbose, u_init = [nc_images[-1]], background = background)
+   return nc_images
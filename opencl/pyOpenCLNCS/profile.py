@@ -72,6 +72,7 @@ def profile(n_reps):
                              hostbuf = status)
    
    ev1 = program.ncsReduceNoise(queue, (16*n_reps,), (16,),
+                                data_buffer,
                                 data_buffer,
                                 gamma_buffer,
                                 otf_mask_buffer,
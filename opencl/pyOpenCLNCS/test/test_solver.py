@@ -68,6 +68,7 @@ def test_ncs_noise_reduction_1():
 
    # OpenCL noise reduction.
    program.ncsReduceNoise(queue, (16,), (16,),
+                          data_buffer,
                           data_buffer,
                           gamma_buffer,
                           otf_mask_buffer,
@@ -131,6 +132,7 @@ def test_ncs_noise_reduction_2():
 
    # OpenCL noise reduction.
    program.ncsReduceNoise(queue, (n_reps*16,), (16,),
+                          data_buffer,
                           data_buffer,
                           gamma_buffer,
                           otf_mask_buffer,
@@ -55,7 +55,9 @@ if __name__ == "__main__":
     NA = 1.35
     iterationN = 15
     alpha = 0.2    
-    out = ncs.reducenoise(Rs,imsd[0:1],subvar,subgain,imgsz,Pixelsize,NA,Lambda,alpha,iterationN)
+    metrics = ncs.Metrics()
+    out = ncs.reducenoise(Rs,imsd[0:1],subvar,subgain,imgsz,Pixelsize,NA,Lambda,alpha,iterationN,metrics=metrics)
+    print('Noise reduction timings:', metrics.summary())
 
     f,(ax1,ax2) = plt.subplots(1,2,sharey=False)
     ax1.imshow(imsd[0],aspect='equal',cmap=plt.cm.gray)
@@ -56,7 +56,9 @@ if __name__ == "__main__":
     Rs = 8
     iterationN = 15
     alpha = 0.1    
-    out = ncs.reducenoise(Rs,imsd[0:1],varsub,gainsub,imgsz,Pixelsize,NA,Lambda,alpha,iterationN)
+    metrics = ncs.Metrics()
+    out = ncs.reducenoise(Rs,imsd[0:1],varsub,gainsub,imgsz,Pixelsize,NA,Lambda,alpha,iterationN,metrics=metrics)
+    print('Noise reduction timings:', metrics.summary())
 
     f,(ax1,ax2) = plt.subplots(1,2,sharey=False)
     ax1.imshow(imsd[0],aspect='equal',cmap=plt.cm.gray)
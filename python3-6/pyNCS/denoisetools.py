@@ -14,43 +14,59 @@
 """
 
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 import h5py
 import matplotlib.pyplot as plt
 import scipy.io as sio
 import scipy.signal as sig
 import scipy.optimize as optimize
 import scipy.fftpack as ft
+import scipy.fft as sfft
 import time
+import os
 import multiprocessing as mp
+try:
+    import multiprocessing.shared_memory as shm
+except ImportError:
+    # Python < 3.8, SharedTiles falls back to sending the tiles to the
+    # workers with each task
+    shm = None
+import concurrent.futures as cf
+import collections
+import threading
+import hashlib
+import tempfile
+import zlib
+import contextlib
 
 
-def segpadimg(img,R1):
+def tileview(img,R1):
+    # read-only (Ns,Ns,R1+2,R1+2) view of the overlapping tiles of the edge
+    # padded img, [ii,jj] is the tile of column block ii and row block jj.
+    # Only the padding copies data
     R = img.shape[0]
     Ns = R//R1
-    ims0 = img[:,0:R1+1]
-    for ii in np.arange(1,Ns-1,1):
-        tmp = img[:,ii*R1-1:(ii+1)*R1+1] 
-        ims0 = np.concatenate((ims0,tmp),axis=1)
-    tmp = img[:,(Ns-1)*R1-1:]
-    ims0 = np.concatenate((ims0,tmp),axis=1)
-    
-    ims1 = ims0[0:R1+1,:]
-    for ii in np.arange(1,Ns-1,1):
-        tmp = ims0[ii*R1-1:(ii+1)*R1+1,:]
-        ims1 = np.concatenate((ims1,tmp),axis=0)
-    tmp = ims0[(Ns-1)*R1-1:,:]
-    ims1 = np.concatenate((ims1,tmp),axis=0)
-    ims2 = np.lib.pad(ims1,((1,1),(1,1)),'edge')
-    imgsegs = segimg(ims2,R1+2)
-    return imgsegs
+    imgpad = np.pad(img,1,'edge')
+    s0,s1 = imgpad.strides
+    return as_strided(imgpad,shape=(Ns,Ns,R1+2,R1+2),strides=(R1*s1,R1*s0,s0,s1),writeable=False)
+
+def segpadimg(img,R1,out=None,dtype=np.float64):
+    # out, if given, is a preallocated (Ns*Ns,R1+2,R1+2) array (for example
+    # a slice of a shared buffer) that the tiles are written into,
+    # otherwise one of type dtype is allocated
+    tiles = tileview(img,R1)
+    Ns = tiles.shape[0]
+    if out is None:
+        out = np.empty((Ns*Ns,R1+2,R1+2),dtype=dtype)
+    out.reshape(tiles.shape)[...] = tiles
+    return out
 
 def segimg(img,R1):
     R = img.shape[0]
     Ns = R//R1
-    imgsegs = np.zeros((Ns*Ns,R1,R1))
-    for ii in np.arange(0,Ns,1):
-        tmp = img[:,ii*R1:(ii+1)*R1]
-        imgsegs[ii*Ns:(ii+1)*Ns,:,:] = tmp.reshape((Ns,R1,R1))
+    imgsegs = np.empty((Ns*Ns,R1,R1))
+    blocks = img[:Ns*R1,:Ns*R1].reshape(Ns,R1,Ns,R1)
+    imgsegs.reshape(Ns,Ns,R1,R1)[...] = blocks.transpose(2,0,1,3)
     return imgsegs
 
 def padedge(ims,p,axis):
@@ -72,18 +88,17 @@ def interpad(ims, p):
     imspd = padedge(ims1,p,axis = 1)
     return imspd
 
-def stitchpadimg(imgseg):
+def stitchpadimg(imgseg,out=None):
+    # inverse of segpadimg, the inner part of each tile is scattered into
+    # out (allocated if not given) with a single vectorized copy
     N = imgseg.shape[0]
-    R1 = int(np.sqrt(N)) 
-    a = []
-    b = []
-    for ii in range(N):
-        a.append(imgseg[ii,1:-1,1:-1])
-        if np.mod(ii+1,R1) == 0:
-            b.append(np.vstack(a))
-            a = []
-    imgstitch = np.hstack(b)
-    return imgstitch
+    Ns = int(np.sqrt(N))
+    R1 = imgseg.shape[1]-2
+    if out is None:
+        out = np.empty((Ns*R1,Ns*R1),dtype=imgseg.dtype)
+    inner = imgseg[:,1:-1,1:-1].reshape(Ns,Ns,R1,R1)
+    out.reshape(Ns,R1,Ns,R1)[...] = inner.transpose(1,2,0,3)
+    return out
 
 def binimage(imgin, ibin):
     sz = imgin.shape[0]   
@@ -94,9 +109,11 @@ def binimage(imgin, ibin):
     return imgbin
 
 def genkspace(R,pixelsize):
-    X,Y = np.meshgrid(np.arange(-R/2,R/2,1),np.arange(-R/2,R/2,1))
+    # R is the grid size, or (rows,columns) for a rectangular grid
+    Ry,Rx = (R,R) if np.isscalar(R) else R
+    X,Y = np.meshgrid(np.arange(-Rx/2,Rx/2,1)*(Ry/Rx),np.arange(-Ry/2,Ry/2,1))
     Zo = np.sqrt(X**2+Y**2)
-    scale = R*pixelsize
+    scale = Ry*pixelsize
     kr = Zo/scale
     return kr
 
@@ -115,41 +132,33 @@ def genpsfparam(R,pixelsize,NA,Lambda):
     return PSFn,pupil,OTFn
     #return PSFn
     
-def SRhist(xsz,ysz,x,y):
+def SRhist(xsz,ysz,x,y,histim=None):
+    # 2D histogram of the localizations (x,y), counts are added to histim
+    # if it is given. x and y are read frm points at a time, so they can
+    # also be memmapped arrays
     N = x.shape[0]
-    frm = 10000
-    Ns = N//frm+1
-    histim = np.zeros([xsz,ysz])
-    for ss in range(Ns):
-        st = ss*frm
-        if ss == Ns-1:
-            ed = N
-        else:
-            ed = (ss+1)*frm
-        tmpx = np.floor(x[st:ed])
-        tmpy = np.floor(y[st:ed])
-        tmpx = tmpx.astype(int)
-        tmpy = tmpy.astype(int)
+    frm = 1000000
+    if histim is None:
+        histim = np.zeros([xsz,ysz])
+    for st in range(0,N,frm):
+        tmpx = np.floor(x[st:st+frm]).astype(int)
+        tmpy = np.floor(y[st:st+frm]).astype(int)
         mask = (tmpx<xsz) & (tmpy<ysz) & (tmpx>=0) & (tmpy>=0)
-        currx = tmpx[mask]
-        curry = tmpy[mask]
-        idx = np.vstack([currx,curry])
-        idx = idx.transpose()
-        idx = idx.tolist()
-        
-        histim[currx,curry] = 1
-        x0,y0 = histim.nonzero() # find non zero indices
-        idx0 = np.argwhere(histim) # find non zero coordinates pair 
-        N0 = idx0.shape[0]
-        idx0 = idx0.tolist()
-        for nn in range(N0):
-            histim[x0[nn],y0[nn]] += idx.count(idx0[nn])
-            
-    return histim    
+        idx = tmpx[mask]*ysz+tmpy[mask]
+        histim += np.bincount(idx,minlength=xsz*ysz).reshape(xsz,ysz)
+    return histim
+
+def SRhistchunks(xsz,ysz,chunks,histim=None):
+    # SRhist over an iterable of (x,y) localization chunks, for data that
+    # arrives in pieces or doesn't fit in memory
+    if histim is None:
+        histim = np.zeros([xsz,ysz])
+    for x,y in chunks:
+        SRhist(xsz,ysz,x,y,histim)
+    return histim
         
 def genidealimage(R,pixelsize,zoom,NA,Lambda,fpath):
     sz = R*zoom
-    cc = sz//2
     Ri = zoom*5//2
     
     #fmat = h5py.loadmat(fpath)
@@ -171,9 +180,7 @@ def genidealimage(R,pixelsize,zoom,NA,Lambda,fpath):
     ys = yco/scale
     histim = SRhist(sz,sz,xs,ys)  
     histim[histim>1] = 1
-    res = genpsfparam(sz,pixelsize/zoom,NA,Lambda)
-    PSFn = res[0]
-    kernel = PSFn[cc-Ri:cc+Ri,cc-Ri:cc+Ri]
+    kernel = opticscache.psfkernel(sz,pixelsize/zoom,NA,Lambda,Ri)
     normimgL = sig.fftconvolve(histim,kernel,mode='same')
     normimgL = np.abs(normimgL.transpose())
     
@@ -189,6 +196,264 @@ def cropimage(ims,R,startx,starty):
     roi = ims[starty:starty+R,startx:startx+R]
     return roi
 
+class Metrics(object):
+    # collects the wall time spent in each stage of the noise reduction,
+    # 'calibration' (gamma, its tiles and the OTF mask weights), 'tiling',
+    # 'solve', 'stitching' and 'io' (frame sources and sinks), and the
+    # number of tiles solved and their iterations. Pass it as metrics to
+    # reducenoise, reducenoisestream, Denoiser, the frame sources or
+    # H5FrameSink and read summary(). callback, if given, is called as
+    # callback(stage,seconds) for every timed step, to feed a monitoring
+    # system. With worker processes ('frames' schedule and streams) the
+    # tiling, solve and stitching times are summed over the workers.
+    stages = ('calibration','tiling','solve','stitching','io')
+
+    def __init__(self,callback=None):
+        self.callback = callback
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.times = dict.fromkeys(self.stages,0.0)
+            self.tiles = 0
+            self.iterations = 0
+
+    def add(self,stage,seconds):
+        with self.lock:
+            self.times[stage] = self.times.get(stage,0.0)+seconds
+        if self.callback is not None:
+            self.callback(stage,seconds)
+
+    @contextlib.contextmanager
+    def timer(self,stage):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage,time.perf_counter()-t)
+
+    def addtiles(self,stats):
+        # stats is the tilestatsdtype array of the solved tiles
+        with self.lock:
+            self.tiles += stats.size
+            self.iterations += int(stats['nit'].sum())
+
+    def summary(self):
+        # seconds per stage, plus tiles, iterations, tiles/s (over the
+        # solve time) and iterations/tile
+        with self.lock:
+            out = dict(self.times)
+            out['tiles'] = self.tiles
+            out['iterations'] = self.iterations
+            out['tiles/s'] = self.tiles/self.times['solve'] if self.times['solve'] > 0 else 0.0
+            out['iterations/tile'] = self.iterations/self.tiles if self.tiles > 0 else 0.0
+        return out
+
+def getmetrics(metrics):
+    # metrics is None, a Metrics or a callback(stage,seconds) function
+    if (metrics is None) or isinstance(metrics,Metrics):
+        return metrics
+    return Metrics(callback=metrics)
+
+@contextlib.contextmanager
+def notimer():
+    # no-op stand in for Metrics.timer (contextlib.nullcontext needs 3.7)
+    yield
+
+def stagetimer(metrics,stage):
+    # metrics.timer(stage), or a no-op if metrics is None
+    return notimer() if metrics is None else metrics.timer(stage)
+
+class FrameSource(object):
+    # lazy (N,Y,X) stack of frames on disk. Only the frames that are asked
+    # for are read, cropped to the R x R window at (startx,starty) as in
+    # cropimage (the whole frame if R is None). Iterating reads blocks of
+    # frames that line up with the storage chunks and yields one frame at
+    # a time, so it can be passed straight to reducenoisestream. Reads are
+    # timed as 'io' if metrics is given.
+    def __init__(self,data,R=None,startx=0,starty=0,transpose=False,blockframes=1,metrics=None):
+        # data is an h5py dataset or a memmap, transpose means that the
+        # frames are stored (N,X,Y) as MATLAB does in v7.3 files
+        self.data = data
+        self.metrics = getmetrics(metrics)
+        self.transpose = transpose
+        self.blockframes = max(int(blockframes),1)
+        ny,nx = data.shape[1:] if not transpose else data.shape[:0:-1]
+        if R is None:
+            self.window = (slice(0,ny),slice(0,nx))
+        else:
+            assert (starty+R <= ny) and (startx+R <= nx), "ROI should lie inside the frame"
+            self.window = (slice(starty,starty+R),slice(startx,startx+R))
+
+    @property
+    def shape(self):
+        ys,xs = self.window
+        return (self.data.shape[0],ys.stop-ys.start,xs.stop-xs.start)
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def read(self,start,stop):
+        ys,xs = self.window
+        with stagetimer(self.metrics,'io'):
+            if self.transpose:
+                return np.asarray(self.data[start:stop,xs,ys]).transpose(0,2,1)
+            return np.asarray(self.data[start:stop,ys,xs])
+
+    def __getitem__(self,index):
+        if isinstance(index,slice):
+            start,stop,step = index.indices(len(self))
+            if step == 1:
+                return self.read(start,stop)
+            return np.stack([self[ii] for ii in range(start,stop,step)])
+        ii = int(index)
+        if ii < 0:
+            ii += len(self)
+        if not 0 <= ii < len(self):
+            raise IndexError('frame index out of range')
+        return self.read(ii,ii+1)[0]
+
+    def __iter__(self):
+        # the first block may be short so that the reads after it start
+        # on a block boundary
+        N = len(self)
+        ii = 0
+        while ii < N:
+            stop = min((ii//self.blockframes+1)*self.blockframes,N)
+            for frame in self.read(ii,stop):
+                yield frame
+            ii = stop
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+class H5FrameSource(FrameSource):
+    # dataset key of an HDF5 file, which includes MATLAB v7.3 .mat files.
+    # Those store the frames transposed, which is detected from the MATLAB
+    # header unless matlab is given.
+    def __init__(self,fpath,key,R=None,startx=0,starty=0,matlab=None,metrics=None):
+        if matlab is None:
+            with open(fpath,'rb') as fid:
+                matlab = fid.read(10) == b'MATLAB 7.3'
+        self.h5file = h5py.File(fpath,'r')
+        data = self.h5file[key]
+        assert data.ndim == 3, "dataset should be a 3D stack of frames"
+        if data.chunks is not None:
+            blockframes = data.chunks[0]
+        else:
+            # contiguous, read about 16 MB at a time
+            blockframes = 2**24//(data.dtype.itemsize*data.shape[1]*data.shape[2])
+        FrameSource.__init__(self,data,R,startx,starty,matlab,blockframes,metrics)
+
+    def close(self):
+        self.h5file.close()
+
+class NpyFrameSource(FrameSource):
+    # (N,Y,X) .npy file, memory mapped
+    def __init__(self,fpath,R=None,startx=0,starty=0,metrics=None):
+        data = np.load(fpath,mmap_mode='r')
+        assert data.ndim == 3, "array should be a 3D stack of frames"
+        blockframes = 2**24//(data.itemsize*data.shape[1]*data.shape[2])
+        FrameSource.__init__(self,data,R,startx,starty,False,blockframes,metrics)
+
+class RawFrameSource(FrameSource):
+    # headerless camera dump of (Y,X) frames, uint16 by default. offset
+    # is the number of bytes to skip at the start of the file.
+    def __init__(self,fpath,framesz,R=None,startx=0,starty=0,dtype=np.uint16,offset=0,metrics=None):
+        ny,nx = framesz
+        framebytes = ny*nx*np.dtype(dtype).itemsize
+        N = (os.path.getsize(fpath)-offset)//framebytes
+        data = np.memmap(fpath,dtype=dtype,mode='r',offset=offset,shape=(N,ny,nx))
+        FrameSource.__init__(self,data,R,startx,starty,False,2**24//framebytes,metrics)
+
+def openframes(fpath,key='ims',framesz=None,R=None,startx=0,starty=0,metrics=None):
+    # pick the frame source from the file, key is the dataset of .mat and
+    # HDF5 files and framesz the (Y,X) frame size of raw files
+    ext = os.path.splitext(fpath)[1].lower()
+    if ext == '.npy':
+        return NpyFrameSource(fpath,R,startx,starty,metrics)
+    if h5py.is_hdf5(fpath):
+        return H5FrameSource(fpath,key,R,startx,starty,metrics=metrics)
+    if ext == '.mat':
+        raise ValueError(fpath+' is not a v7.3 .mat file, load it with scipy.io.loadmat')
+    assert framesz is not None, "framesz is needed for raw files"
+    return RawFrameSource(fpath,framesz,R,startx,starty,metrics=metrics)
+
+class H5FrameSink(object):
+    # writes frames one at a time to the (N,Y,X) dataset key of an HDF5
+    # file, chunked one frame per chunk and gzip compressed. The chunks are
+    # compressed by a pool of workers threads (zlib releases the GIL) while
+    # the caller goes on solving, and are written in order as they finish.
+    # At most 2*workers frames wait to be written. attrs (for example
+    # alpha, Rs, pixelsize, NA, Lambda, Type, backend) are stored with the
+    # dataset to record how it was made. With metrics, the time the caller
+    # spends waiting for and writing chunks is timed as 'io'.
+    def __init__(self,fpath,framesz,key='ims',dtype=np.float32,level=4,workers=2,metrics=None,**attrs):
+        ny,nx = framesz
+        self.metrics = getmetrics(metrics)
+        self.h5file = h5py.File(fpath,'w')
+        self.data = self.h5file.create_dataset(key,shape=(0,ny,nx),maxshape=(None,ny,nx),dtype=dtype,chunks=(1,ny,nx),compression='gzip',compression_opts=level)
+        for name,value in attrs.items():
+            if value is not None:
+                self.data.attrs[name] = value
+        self.dtype = np.dtype(dtype)
+        self.level = level
+        self.maxpending = 2*workers
+        self.pool = cf.ThreadPoolExecutor(max_workers=workers)
+        self.pending = collections.deque()
+        self.count = 0
+
+    def compress(self,frame):
+        return zlib.compress(np.ascontiguousarray(frame,dtype=self.dtype).tobytes(),self.level)
+
+    def flush(self,wait=False):
+        # write the finished chunks at the head of the queue, or all of
+        # them if wait is True
+        with stagetimer(self.metrics,'io'):
+            while self.pending and (wait or self.pending[0].done()):
+                chunk = self.pending.popleft().result()
+                ii = self.data.shape[0]
+                self.data.resize(ii+1,axis=0)
+                self.data.id.write_direct_chunk((ii,0,0),chunk)
+
+    def write(self,frame):
+        assert frame.shape == self.data.shape[1:], "frame should be " + str(self.data.shape[1:])
+        self.pending.append(self.pool.submit(self.compress,frame))
+        self.count += 1
+        self.flush()
+        while len(self.pending) > self.maxpending:
+            with stagetimer(self.metrics,'io'):
+                self.pending[0].result()
+            self.flush()
+
+    def writeframes(self,frames):
+        # write every frame of an iterable, such as reducenoisestream
+        for frame in frames:
+            self.write(frame)
+        return self.count
+
+    def close(self):
+        if self.h5file:
+            try:
+                self.flush(wait=True)
+            finally:
+                self.pool.shutdown()
+                self.h5file.close()
+                self.h5file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
 def gennoisemap(R,fpath):
     
     #fmat = h5py.loadmat(fpath)
@@ -210,11 +475,12 @@ def addnoise(varmap,gainmap,normimg,I,bg,offset):
     scmosimg += offset
     return scmosimg,poissonimg 
     
-def gendatastack(normimg,varmap,gainmap,I,bg,offset,N):
+def gendatastack(normimg,varmap,gainmap,I,bg,offset,N,dtype=np.float64):
+    # dtype is the precision of the stacks, see reducenoise for float32
     R = normimg.shape[0]
-    ims = np.zeros([N,R,R])
-    imsp = np.zeros([N,R,R])
-    imsd = np.zeros([N,R,R])
+    ims = np.zeros([N,R,R],dtype=dtype)
+    imsp = np.zeros([N,R,R],dtype=dtype)
+    imsd = np.zeros([N,R,R],dtype=dtype)
     for ii in range(N):
         noiseimg = addnoise(varmap,gainmap,normimg,I,bg,offset)
         ims[ii] = noiseimg[0]
@@ -260,6 +526,133 @@ def genfilter(R,pixelsize,NA,Lambda,Type='OTFweighted',w=1,h=0.7):
     rcfilter = 1-rcfilter
     return rcfilter
 
+class OpticsCache(object):
+    # size bounded LRU cache of k-space grids, OTF filter masks and PSF
+    # kernels, keyed on the optics they were computed for. The arrays are
+    # returned read-only as they are shared. If cachedir is set, entries
+    # are also saved there as .npy files and loaded back by later runs.
+    # Files are written under a temporary name and renamed, so that other
+    # processes sharing cachedir never load a partly written file.
+    def __init__(self,maxsize=32,cachedir=None):
+        self.maxsize = maxsize
+        self.cachedir = cachedir
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def cachekey(self,key):
+        # numpy scalars as Python numbers, so that np.float64(0.1) and 0.1
+        # give the same file
+        if isinstance(key,tuple):
+            return tuple(self.cachekey(k) for k in key)
+        if isinstance(key,np.generic):
+            return key.item()
+        return key
+
+    def filename(self,key):
+        return os.path.join(self.cachedir,hashlib.sha1(repr(key).encode()).hexdigest()+'.npy')
+
+    def get(self,key,fn):
+        key = self.cachekey(key)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+        arr = None
+        if self.cachedir is not None and os.path.exists(self.filename(key)):
+            arr = np.load(self.filename(key))
+        if arr is None:
+            arr = np.array(fn())
+            if self.cachedir is not None:
+                self.save(key,arr)
+        arr.setflags(write=False)
+        with self.lock:
+            self.entries[key] = arr
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return arr
+
+    def save(self,key,arr):
+        os.makedirs(self.cachedir,exist_ok=True)
+        fd,tmpname = tempfile.mkstemp(suffix='.tmp',dir=self.cachedir)
+        try:
+            with os.fdopen(fd,'wb') as fid:
+                np.save(fid,arr)
+            os.replace(tmpname,self.filename(key))
+        except BaseException:
+            os.remove(tmpname)
+            raise
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def kspace(self,R,pixelsize):
+        return self.get(('kspace',R,pixelsize),lambda: genkspace(R,pixelsize))
+
+    def filter(self,R,pixelsize,NA,Lambda,Type='OTFweighted',w=1,h=0.7):
+        return self.get(('filter',R,pixelsize,NA,Lambda,Type,w,h),lambda: genfilter(R,pixelsize,NA,Lambda,Type,w,h))
+
+    def psfkernel(self,R,pixelsize,NA,Lambda,Ri):
+        # central 2*Ri x 2*Ri part of the normalized PSF on an R x R grid
+        def fn():
+            cc = R//2
+            PSFn = genpsfparam(R,pixelsize,NA,Lambda)[0]
+            return PSFn[cc-Ri:cc+Ri,cc-Ri:cc+Ri]
+        return self.get(('psfkernel',R,pixelsize,NA,Lambda,Ri),fn)
+
+# default cache used by reducenoise and genidealimage
+opticscache = OpticsCache()
+
+class Calibration(object):
+    # camera calibration in the form the solvers use. gamma = var/gain^2 is
+    # computed once, and its padded tiles are cached per tile size and
+    # dtype, so repeated calls on the same camera neither recompute nor
+    # re-tile it. varmap and gainmap are (R,R), or (N,R,R) for one
+    # calibration per frame, and gainmap=None takes varmap as gamma.
+    # roi() returns the (cached) calibration of a region of interest, cut
+    # out as cropimage does. The arrays are read-only as they are shared
+    def __init__(self,varmap,gainmap=None):
+        gamma = np.array(varmap,dtype=np.float64) if gainmap is None else varmap/gainmap/gainmap
+        gamma.setflags(write=False)
+        self.gamma = gamma
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self,key,fn):
+        with self.lock:
+            if key not in self.entries:
+                arr = fn()
+                if isinstance(arr,np.ndarray):
+                    arr.setflags(write=False)
+                self.entries[key] = arr
+            return self.entries[key]
+
+    def roi(self,R,startx,starty):
+        return self.get(('roi',R,startx,starty),lambda: Calibration(self.gamma[...,starty:starty+R,startx:startx+R]))
+
+    def tiles(self,Rs,dtype=np.float64):
+        # (Ns*Ns,Rs+2,Rs+2) gamma tiles in segpadimg order, or
+        # (N,Ns*Ns,Rs+2,Rs+2) for a per-frame calibration
+        def fn():
+            if self.gamma.ndim == 2:
+                return segpadimg(self.gamma,Rs,dtype=dtype)
+            return np.stack([segpadimg(gamma,Rs,dtype=dtype) for gamma in self.gamma])
+        return self.get(('tiles',Rs,np.dtype(dtype).str),fn)
+
+    def frametiles(self,ii,Rs,dtype=np.float64):
+        # gamma tiles of frame ii
+        tiles = self.tiles(Rs,dtype)
+        return tiles if self.gamma.ndim == 2 else tiles[ii]
+
+    def framegamma(self,ii):
+        # gamma of frame ii, or of the frames in slice ii
+        return self.gamma if self.gamma.ndim == 2 else self.gamma[ii]
+
+def calibration(varmap,gainmap):
+    # varmap and gainmap, or a Calibration passed as varmap
+    return varmap if isinstance(varmap,Calibration) else Calibration(varmap,gainmap)
+
 def calcost(u,data,var,gain,otfmask,alpha):
     u = u.reshape(data.shape)
     noisepart = calnoisecontri(u,otfmask)
@@ -278,57 +671,762 @@ def calnoisecontri(u,otfmask):
     noisepart = ims2.sum()    
     return noisepart
 
-def segoptim(u0seg,varseg,gainseg,otfmask,alpha,iterationN,ind):
+def noiseweights(otfmask):
+    # weights for calnoisecontrigrad, computed once per OTF mask. The mask
+    # is unshifted, squared, symmetrized and cut to the rfft2 half
+    # spectrum. wcost counts the bins that stand for two conjugate bins
+    # twice, wgrad gives the gradient through irfft2. The mask does not
+    # have to be square
+    n1 = otfmask.shape[1]
+    mask = ft.ifftshift(otfmask)
+    mask2 = mask*mask
+    mask2 = (mask2+np.roll(np.flip(mask2,(0,1)),1,axis=(0,1)))/2
+    mask2 = mask2[:,:n1//2+1]
+    count = np.full(n1//2+1,2.0)
+    count[0] = 1
+    if n1%2 == 0:
+        count[-1] = 1
+    wcost = mask2*count/otfmask.size
+    wgrad = 2.0*mask2
+    return wcost,wgrad
+
+def calnoisecontrigrad(u,weights):
+    # noise contribution and its gradient for a tile or a stack of tiles,
+    # with one rfft2/irfft2 pair. weights come from noiseweights
+    wcost,wgrad = weights
+    ims1 = sfft.rfft2(u,axes=(-2,-1))
+    power = ims1.real*ims1.real
+    power += ims1.imag*ims1.imag
+    power *= wcost
+    noisepart = power.sum(axis=(-2,-1))
+    ims1 *= wgrad
+    noisegrad = sfft.irfft2(ims1,s=u.shape[-2:],axes=(-2,-1),overwrite_x=True)
+    return noisepart,noisegrad
+
+def batchcostgrad(u,data,gamma,otfmask,alpha):
+    # per-tile cost and analytic gradient for a (n_tiles,R1,R1) stack of
+    # tiles. otfmask is the OTF mask or, to skip preparing it on every
+    # call, its noiseweights
+    if not isinstance(otfmask,tuple):
+        otfmask = noiseweights(otfmask)
+    noisepart,gradient = calnoisecontrigrad(u,otfmask)
+    t1 = data+gamma
+    t2 = u+gamma
+    likelihood = (u-t1*np.log(t2)).sum(axis=(-2,-1))
+    fcost = likelihood+alpha*noisepart
+    gradient *= alpha
+    gradient += 1
+    gradient -= t1/t2
+    return fcost,gradient
+
+def calcostgrad(u,data,gamma,otfmask,alpha):
+    # cost and analytic gradient of calcost, for scipy.optimize
+    u = u.reshape((1,)+data.shape)
+    fcost,gradient = batchcostgrad(u,data,gamma,otfmask,alpha)
+    return fcost[0],gradient.ravel()
+
+def batchlbfgs(fun,x0,lb,maxiter,maxcor=6,ftol=2.2e-9,gtol=1e-5,maxls=20):
+    # L-BFGS run on many independent problems at once. x0 is (n,p), one
+    # problem per row, and fun(x,ind) returns the costs (n,) and gradients
+    # (n,p) of the problems with indices ind. Each problem has its own
+    # history, step length and convergence state, so converged problems
+    # drop out while the rest keep iterating. Bounds are handled by
+    # projection onto x>=lb.
+    #
+    # status is 0 for converged, 1 for reached maxiter and 2 for a failed
+    # line search, as in scipy's L-BFGS-B. gnorm is the largest component
+    # of the projected gradient, the quantity that gtol is tested against.
+    c1 = 1e-4
+    eps = np.finfo(x0.dtype).eps
+    x = np.maximum(x0,lb)
+    n,p = x.shape
+    f,g = fun(x,np.arange(n))
+    S = np.zeros((maxcor,n,p),dtype=x.dtype)
+    Y = np.zeros((maxcor,n,p),dtype=x.dtype)
+    rho = np.zeros((maxcor,n),dtype=x.dtype)
+    h0 = 1/np.maximum(np.sqrt((g*g).sum(axis=1)),eps)
+    nit = np.zeros(n,dtype=int)
+    status = np.ones(n,dtype=int)
+    pg = np.where((x<=lb)&(g>0),0,g)
+    active = np.abs(pg).max(axis=1)>gtol
+    status[~active] = 0
+    for it in range(maxiter):
+        act = np.flatnonzero(active)
+        if act.size == 0:
+            break
+        xa = x[act]
+        fa = f[act]
+        ga = g[act]
+
+        # two-loop recursion, newest pair first
+        slots = [(it-1-jj)%maxcor for jj in range(min(it,maxcor))]
+        q = ga.copy()
+        alphas = []
+        for sl in slots:
+            a = rho[sl,act]*(S[sl,act]*q).sum(axis=1)
+            q -= a[:,None]*Y[sl,act]
+            alphas.append(a)
+        r = h0[act][:,None]*q
+        for sl,a in zip(reversed(slots),reversed(alphas)):
+            b = rho[sl,act]*(Y[sl,act]*r).sum(axis=1)
+            r += (a-b)[:,None]*S[sl,act]
+        d = -r
+        d[(xa<=lb)&(d<0)] = 0
+        notdescent = (ga*d).sum(axis=1)>=0
+        if notdescent.any():
+            d[notdescent] = -ga[notdescent]*h0[act[notdescent]][:,None]
+            d[(xa<=lb)&(d<0)] = 0
+
+        # backtracking line search on the projected path
+        step = np.ones(act.size,dtype=x.dtype)
+        xn = xa.copy()
+        fn = fa.copy()
+        gn = ga.copy()
+        pending = np.arange(act.size)
+        for ls in range(maxls):
+            xt = np.maximum(xa[pending]+step[pending,None]*d[pending],lb)
+            ft_,gt_ = fun(xt,act[pending])
+            ok = ft_<=fa[pending]+c1*(ga[pending]*(xt-xa[pending])).sum(axis=1)
+            acc = pending[ok]
+            xn[acc] = xt[ok]
+            fn[acc] = ft_[ok]
+            gn[acc] = gt_[ok]
+            pending = pending[~ok]
+            if pending.size == 0:
+                break
+            step[pending] *= 0.5
+        failed = np.zeros(act.size,dtype=bool)
+        failed[pending] = True
+        status[act[failed]] = 2
+        active[act[failed]] = False
+
+        # history update, skipping pairs that fail the curvature condition
+        done = ~failed
+        acc = act[done]
+        s = xn[done]-xa[done]
+        y = gn[done]-ga[done]
+        sy = (s*y).sum(axis=1)
+        yy = (y*y).sum(axis=1)
+        good = sy>eps*yy
+        sl = it%maxcor
+        S[sl,acc] = s
+        Y[sl,acc] = y
+        rho[sl,acc] = np.where(good,1/np.where(good,sy,1),0)
+        h0[acc] = np.where(good,sy/np.where(good,yy,1),h0[acc])
+        nit[acc] += 1
+        fold = f[acc]
+        x[acc] = xn[done]
+        f[acc] = fn[done]
+        g[acc] = gn[done]
+
+        # convergence tests, as in scipy's L-BFGS-B
+        pg = np.where((x[acc]<=lb)&(g[acc]>0),0,g[acc])
+        conv = (np.abs(pg).max(axis=1)<=gtol)|((fold-f[acc])<=ftol*np.maximum(np.maximum(np.abs(fold),np.abs(f[acc])),1))
+        status[acc[conv]] = 0
+        active[acc[conv]] = False
+    pg = np.where((x<=lb)&(g>0),0,g)
+    return x,{'nit':nit,'cost':f,'gnorm':np.abs(pg).max(axis=1),'status':status}
+
+# per-tile solver statistics, as returned with returnstats=True
+tilestatsdtype = np.dtype([('nit',np.int32),('cost',np.float64),('gnorm',np.float64),('status',np.int8)])
+
+def backgroundtiles(u0seg,gammaseg,nsigma=3):
+    # flags the tiles that look like flat background: the spread of the
+    # counts about the tile mean is what shot noise plus read noise
+    # (gamma) give, i.e. the reduced chi-square is within nsigma of 1
+    npix = u0seg.shape[-2]*u0seg.shape[-1]
+    m = u0seg.mean(axis=(-2,-1),keepdims=True)
+    chi2 = ((u0seg-m)**2/(m+gammaseg)).sum(axis=(-2,-1))/(npix-1)
+    return chi2 < 1+nsigma*np.sqrt(2/(npix-1))
+
+def backgroundsolve(u0seg,gammaseg,weights,alpha):
+    # closed-form estimate for background tiles. With the likelihood
+    # replaced by its quadratic expansion about the data, and its
+    # curvature 1/(data+gamma) by the tile mean, the cost is diagonal in
+    # k-space and each frequency is just scaled down
+    s = (u0seg+gammaseg).mean(axis=(-2,-1),keepdims=True)
+    ims1 = sfft.rfft2(u0seg,axes=(-2,-1))
+    ims1 /= 1+alpha*s*weights[1]
+    return sfft.irfft2(ims1,s=u0seg.shape[-2:],axes=(-2,-1),overwrite_x=True)
+
+def batchoptim(u0seg,gammaseg,otfmask,alpha,iterationN,x0seg=None,ftol=2.2e-9,gtol=1e-5,stats=None,bgiterationN=None):
+    # solve every tile of u0seg with one batched L-BFGS, starting from the
+    # data or from the initial estimate x0seg. stats, if given, is a
+    # tilestatsdtype array that receives the statistics of each tile.
+    # With bgiterationN, background tiles start from backgroundsolve and
+    # get at most bgiterationN iterations
+    shape = u0seg.shape
+    if not isinstance(otfmask,tuple):
+        otfmask = noiseweights(otfmask)
+    if x0seg is None:
+        x0seg = u0seg
+    x0 = np.maximum(x0seg.reshape(shape[0],-1),0)
+    if bgiterationN is None:
+        groups = [(np.arange(shape[0]),iterationN)]
+    else:
+        bg = backgroundtiles(u0seg,gammaseg)
+        x0[bg] = np.maximum(backgroundsolve(u0seg[bg],gammaseg[bg],otfmask,alpha).reshape(-1,x0.shape[1]),0)
+        groups = [(np.flatnonzero(~bg),iterationN),(np.flatnonzero(bg),bgiterationN)]
+    useg = np.empty_like(x0)
+    for sel,maxiter in groups:
+        if sel.size == 0:
+            continue
+        def fun(x,ind):
+            fcost,gradient = batchcostgrad(x.reshape((-1,)+shape[1:]),u0seg[sel[ind]],gammaseg[sel[ind]],otfmask,alpha)
+            return fcost,gradient.reshape(x.shape)
+        useg[sel],info = batchlbfgs(fun,x0[sel],0.0,maxiter,ftol=ftol,gtol=gtol)
+        if stats is not None:
+            for key in tilestatsdtype.names:
+                stats[key][sel] = info[key]
+    return useg.reshape(shape)
+
+def tilesolve(u0i,gammai,otfmask,alpha,iterationN,x0i=None,ftol=2.2e-9,gtol=1e-5,bgiterationN=None):
+    # solve one tile with scipy's L-BFGS-B, returning the solution and its
+    # (nit,cost,gnorm,status) statistics. bgiterationN is as in batchoptim
+    if (bgiterationN is not None) and backgroundtiles(u0i,gammai):
+        x0i = backgroundsolve(u0i,gammai,otfmask if isinstance(otfmask,tuple) else noiseweights(otfmask),alpha)
+        iterationN = bgiterationN
+    opts = {'disp':False,'maxiter':iterationN,'ftol':ftol,'gtol':gtol}
+    if x0i is None:
+        x0i = u0i
+    # bound to positive values so that we don't get NANs when calculating
+    # the log likelihood
+    bounds = optimize.Bounds(np.zeros(u0i.size),np.full(u0i.size,np.inf))
+    if iterationN == 0:
+        # L-BFGS-B would still take one step
+        x = np.maximum(x0i.ravel(),0)
+        fun,jac = calcostgrad(x,u0i,gammai,otfmask,alpha)
+        outi = optimize.OptimizeResult(x=x,fun=fun,jac=jac,nit=0,status=1)
+    else:
+        outi = optimize.minimize(calcostgrad,np.maximum(x0i.ravel(),0),args=(u0i,gammai,otfmask,alpha),jac=True,bounds=bounds,method='L-BFGS-B',options=opts)
+    outix = outi.x.reshape(u0i.shape)
+    pg = np.where((outi.x<=0)&(outi.jac>0),0,outi.jac)
+    return outix,(outi.nit,outi.fun,np.abs(pg).max(),min(outi.status,2))
+
+def tileoptim(u0i,gammai,otfmask,alpha,iterationN,x0i=None,ftol=2.2e-9,gtol=1e-5):
+    return tilesolve(u0i,gammai,otfmask,alpha,iterationN,x0i,ftol,gtol)[0]
+
+def segoptim(u0seg,varseg,gainseg,otfmask,alpha,iterationN,ind,ftol=2.2e-9,gtol=1e-5,bgiterationN=None):
+    # legacy per-tile task, optimf now goes through optimshared
     u0i = u0seg[ind]
     vari = varseg[ind]
     gaini = gainseg[ind]
-    #sig.fftpack = pft.interfaces.scipy_fftpack   
-    #pft.interfaces.cache.enable() 
-    opts = {'disp':False,'maxiter':iterationN}
-    outi = optimize.minimize(calcost,u0i,args=(u0i,vari,gaini,otfmask,alpha),method='L-BFGS-B',options=opts)
-    outix = outi.x.reshape(u0i.shape)
-    return outix
-    
+    gammai = vari/gaini/gaini
+    return tilesolve(u0i,gammai,otfmask,alpha,iterationN,None,ftol,gtol,bgiterationN)[0]
+
+class SharedTiles(object):
+    # tile buffers in shared memory, so that worker processes read their
+    # tiles and write their results in place and only tile indices have
+    # to be sent to them. The buffers are created once and reused for
+    # every frame. With a useg buffer the tile statistics go to stats.
+    # Without shared memory (shm is None) the buffers are ordinary arrays
+    # and desc returns the array itself.
+    def __init__(self,ntiles,fsz,dtype=np.float64,keys=('u0seg','gammaseg','useg')):
+        shape = (ntiles,fsz,fsz)
+        self.blocks = {}
+        for key in keys:
+            setattr(self,key,self.create(key,shape,dtype))
+        if 'useg' in keys:
+            self.stats = self.create('stats',(ntiles,),tilestatsdtype)
+
+    def create(self,key,shape,dtype):
+        if shm is None:
+            self.blocks[key] = None
+            return np.zeros(shape,dtype=dtype)
+        nbytes = int(np.prod(shape))*np.dtype(dtype).itemsize
+        block = shm.SharedMemory(create=True,size=max(nbytes,1))
+        self.blocks[key] = block
+        arr = np.ndarray(shape,dtype=dtype,buffer=block.buf)
+        _published[block.name] = arr
+        return arr
+
+    def desc(self,key):
+        arr = getattr(self,key)
+        if self.blocks[key] is None:
+            return arr
+        return (self.blocks[key].name,arr.shape,arr.dtype)
+
+    def close(self):
+        for key in self.blocks:
+            setattr(self,key,None)
+        for block in self.blocks.values():
+            if block is None:
+                continue
+            _published.pop(block.name,None)
+            block.close()
+            block.unlink()
+        self.blocks = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+# buffers created by this process (also seen by workers forked after they
+# were created) and buffers this process has attached to by name
+_published = {}
+_attached = {}
 
-def optimf(u0,varseg,gainseg,otfmask,Rs,R,alpha,iterationN):
+def attachshared(desc):
+    # map a SharedTiles buffer in a worker, keeping it mapped for the
+    # following tasks
+    name,shape,dtype = desc
+    if name in _published:
+        return _published[name]
+    if name not in _attached:
+        block = shm.SharedMemory(name=name)
+        _attached[name] = (block,np.ndarray(shape,dtype=dtype,buffer=block.buf))
+    return _attached[name][1]
+
+def releaseshared(keep):
+    for name in list(_attached.keys()):
+        if name not in keep:
+            block,arr = _attached.pop(name)
+            del arr
+            block.close()
+
+def segoptimshared(u0desc,gammadesc,outdesc,otfmask,alpha,iterationN,inds,x0desc=None,statsdesc=None,ftol=2.2e-9,gtol=1e-5,bgiterationN=None):
+    descs = [desc for desc in (u0desc,gammadesc,outdesc,x0desc,statsdesc) if desc]
+    releaseshared([desc[0] for desc in descs])
+    u0seg = attachshared(u0desc)
+    gammaseg = attachshared(gammadesc)
+    useg = attachshared(outdesc)
+    x0seg = attachshared(x0desc) if x0desc else u0seg
+    stats = attachshared(statsdesc) if statsdesc else None
+    for ind in inds:
+        useg[ind],tilestats = tilesolve(u0seg[ind],gammaseg[ind],otfmask,alpha,iterationN,x0seg[ind],ftol,gtol,bgiterationN)
+        if stats is not None:
+            stats[ind] = tilestats
+    return len(inds)
+
+def segoptimtiles(u0seg,gammaseg,otfmask,alpha,iterationN,x0seg,ftol=2.2e-9,gtol=1e-5,bgiterationN=None):
+    # segoptimshared for tiles sent with the task, when there is no
+    # shared memory. Returns the solved tiles and their statistics
+    useg = np.empty_like(u0seg)
+    stats = np.zeros(u0seg.shape[0],dtype=tilestatsdtype)
+    for ii in range(u0seg.shape[0]):
+        useg[ii],stats[ii] = tilesolve(u0seg[ii],gammaseg[ii],otfmask,alpha,iterationN,x0seg[ii],ftol,gtol,bgiterationN)
+    return useg,stats
+
+def defaultworkers():
+    # number of cores this process is allowed to run on
+    if hasattr(os,'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return mp.cpu_count()
+
+def optimshared(n,shared,otfmask,alpha,iterationN,executor,workers=None,ftol=2.2e-9,gtol=1e-5,bgiterationN=None):
+    # solve the first n tiles of shared on executor, sending the workers
+    # chunks of tile indices. The tiles and the matching gamma tiles must
+    # already be in shared.u0seg and shared.gammaseg, and the initial
+    # estimates in shared.x0seg if shared has one. Without shared memory
+    # each chunk is sent its own tiles instead
+    if workers is None:
+        workers = defaultworkers()
+    chunk = max(1,-(-n//(4*workers)))
+    if shm is None:
+        x0seg = shared.x0seg if 'x0seg' in shared.blocks else shared.u0seg
+        chunks = [slice(ii,min(ii+chunk,n)) for ii in range(0,n,chunk)]
+        results = [executor.submit(segoptimtiles,shared.u0seg[sel],shared.gammaseg[sel],otfmask,alpha,iterationN,x0seg[sel],ftol,gtol,bgiterationN) for sel in chunks]
+        for sel,p in zip(chunks,results):
+            shared.useg[sel],shared.stats[sel] = p.result()
+        return shared.useg[:n]
+    args = (shared.desc('u0seg'),shared.desc('gammaseg'),shared.desc('useg'),otfmask,alpha,iterationN)
+    x0desc = shared.desc('x0seg') if 'x0seg' in shared.blocks else None
+    statsdesc = shared.desc('stats') if 'stats' in shared.blocks else None
+    results = [executor.submit(segoptimshared,*args,range(ii,min(ii+chunk,n)),x0desc,statsdesc,ftol,gtol,bgiterationN) for ii in range(0,n,chunk)]
+    [p.result() for p in results]
+    return shared.useg[:n]
+
+def optimf(u0,varseg,gainseg,otfmask,Rs,R,alpha,iterationN,executor=None,shared=None,ftol=2.2e-9,gtol=1e-5,returnstats=False,bgiterationN=None,metrics=None):
+    # one frame through optimshared. varseg and gainseg are the segpadimg
+    # tiles of varmap and gainmap, or varseg is a Calibration and gainseg None
+    # executor: pool reused across frames, else a temporary one
+    # shared: SharedTiles reused across frames, else a temporary one
+    # the other arguments are as in reducenoise
     Ns = R//Rs
-    u0seg = segpadimg(u0,Rs)
-    useg = np.zeros(u0seg.shape)#
-    t = time.time()
-    pool = mp.Pool(processes=8)
-    results = [pool.apply_async(segoptim, args=(u0seg,varseg,gainseg,otfmask,alpha,iterationN,ind)) for ind in range(Ns*Ns)]
-    outi = [p.get() for p in results]
-    useg = np.array(outi)
-    pool.close()
-    pool.join()
-    elapsed = time.time()-t
-    print('Elapsed time for noise reduction:', elapsed)
-    out = stitchpadimg(useg)
-    out[out<0] = 1e-6     
+    metrics = getmetrics(metrics)
+    if executor is None:
+        with cf.ProcessPoolExecutor(max_workers=defaultworkers()) as pool:
+            return optimf(u0,varseg,gainseg,otfmask,Rs,R,alpha,iterationN,pool,shared,ftol,gtol,returnstats,bgiterationN,metrics)
+    if shared is None:
+        with SharedTiles(Ns*Ns,Rs+2) as shared:
+            return optimf(u0,varseg,gainseg,otfmask,Rs,R,alpha,iterationN,executor,shared,ftol,gtol,returnstats,bgiterationN,metrics)
+    with stagetimer(metrics,'tiling'):
+        if isinstance(varseg,Calibration):
+            shared.gammaseg[:Ns*Ns] = varseg.tiles(Rs,shared.gammaseg.dtype)
+        else:
+            shared.gammaseg[:Ns*Ns] = varseg/gainseg/gainseg
+        segpadimg(u0,Rs,out=shared.u0seg[:Ns*Ns])
+    with stagetimer(metrics,'solve'):
+        useg = optimshared(Ns*Ns,shared,otfmask,alpha,iterationN,executor,None,ftol,gtol,bgiterationN)
+    stats = shared.stats[:Ns*Ns].copy()
+    if metrics is not None:
+        metrics.addtiles(stats)
+    with stagetimer(metrics,'stitching'):
+        out = stitchpadimg(useg)
+        out[out<0] = 1e-6     
+    if returnstats:
+        return out,imagestats(stats,Ns)
     return out
 
-def reducenoise(Rs,imsd,varmap,gainmap,R,pixelsize,NA,Lambda,alpha,iterationN,Type='OTFweighted',w=1,h=0.7):
-    fsz = Rs+2  
+def imagestats(stats,Ns):
+    # reorder tile statistics from segpadimg order to (...,tile row,tile
+    # column) order
+    return np.ascontiguousarray(stats.reshape(-1,Ns,Ns).swapaxes(-1,-2)).reshape(stats.shape[:-1]+(Ns,Ns))
+
+def optimbatch(u0,gammaseg,otfmask,Rs,R,alpha,iterationN,x0=None,ftol=2.2e-9,gtol=1e-5,stats=None,bgiterationN=None,metrics=None):
+    # like optimf, but solves the tiles of one or more frames together
+    # with batchoptim. u0 is (N,R,R), gammaseg holds the tiles of one frame
+    # and sets the precision. x0, if given, is an (N,R,R) initial estimate
+    # and stats an (N*Ns*Ns,) tilestatsdtype array for the statistics
+    N = u0.shape[0]
+    Ns = R//Rs
+    metrics = getmetrics(metrics)
+    with stagetimer(metrics,'tiling'):
+        u0seg = np.empty((N*Ns*Ns,Rs+2,Rs+2),dtype=gammaseg.dtype)
+        for ii in range(N):
+            segpadimg(u0[ii],Rs,out=u0seg[ii*Ns*Ns:(ii+1)*Ns*Ns])
+        x0seg = None
+        if x0 is not None:
+            x0seg = np.empty_like(u0seg)
+            for ii in range(N):
+                segpadimg(x0[ii],Rs,out=x0seg[ii*Ns*Ns:(ii+1)*Ns*Ns])
+        if gammaseg.shape[0] != u0seg.shape[0]:
+            gammaseg = np.tile(gammaseg,(N,1,1))
+    if (stats is None) and (metrics is not None):
+        stats = np.zeros(u0seg.shape[0],dtype=tilestatsdtype)
+    with stagetimer(metrics,'solve'):
+        useg = batchoptim(u0seg,gammaseg,otfmask,alpha,iterationN,x0seg,ftol,gtol,stats,bgiterationN)
+    if metrics is not None:
+        metrics.addtiles(stats)
+    with stagetimer(metrics,'stitching'):
+        out = np.empty(u0.shape,dtype=useg.dtype)
+        for ii in range(N):
+            stitchpadimg(useg[ii*Ns*Ns:(ii+1)*Ns*Ns],out=out[ii])
+        out[out<0] = 1e-6
+    return out
+
+def framesize(shape):
+    # size of the padded frame for the whole-frame solver: at least one
+    # pixel of padding on every side, like the tiles, and rounded up to
+    # an even size that has only small prime factors so the FFTs are fast
+    fsz = []
+    for n in shape:
+        m = sfft.next_fast_len(n+2,real=True)
+        while m%2:
+            m = sfft.next_fast_len(m+1,real=True)
+        fsz.append(m)
+    return tuple(fsz)
+
+def frameoptim(u0,gamma,otfmask,alpha,iterationN,solver='batch',x0=None,ftol=2.2e-9,gtol=1e-5,stats=None,bgiterationN=None):
+    # solve (N,H,W) frames whole instead of tile by tile, with one real
+    # FFT of the padded frame per cost evaluation. otfmask (or its
+    # noiseweights) sets the padded frame size, see framesize. The frames
+    # are edge padded, so the periodic boundary of the FFT only meets the
+    # frame edges. gamma is (H,W) or (N,H,W), x0 an optional (N,H,W)
+    # initial estimate and stats an (N,) tilestatsdtype array
+    N,H,W = u0.shape
+    if not isinstance(otfmask,tuple):
+        otfmask = noiseweights(otfmask)
+    fsz = (otfmask[0].shape[0],(otfmask[0].shape[1]-1)*2)
+    pad = ((0,0),(1,fsz[0]-H-1),(1,fsz[1]-W-1))
+    u0p = np.pad(u0,pad,'edge')
+    gammap = np.broadcast_to(np.pad(gamma.reshape((-1,H,W)),pad,'edge'),u0p.shape)
+    x0p = None if x0 is None else np.pad(x0,pad,'edge')
+    if solver == 'batch':
+        up = batchoptim(u0p,gammap,otfmask,alpha,iterationN,x0p,ftol,gtol,stats,bgiterationN)
+    else:
+        up = np.empty_like(u0p)
+        for ii in range(N):
+            up[ii],st = tilesolve(u0p[ii],gammap[ii],otfmask,alpha,iterationN,None if x0p is None else x0p[ii],ftol,gtol,bgiterationN)
+            if stats is not None:
+                stats[ii] = st
+    out = up[:,1:H+1,1:W+1]
+    out[out<0] = 1e-6
+    return out
+
+def warmestimate(u0,prev,warmstart):
+    # initial estimate for the frames u0 when warm starting from the
+    # denoised frame prev, a blend of the two weighted by warmstart
+    if (warmstart is None) or (prev is None):
+        return None
+    return warmstart*prev + (1-warmstart)*u0
+
+def framesolve(u0,gammaseg,otfmask,Rs,R,alpha,iterationN,solver,ftol=2.2e-9,gtol=1e-5,bgiterationN=None):
+    # solve all the tiles of one frame in this process, this is the task
+    # for schedule='frames'. gammaseg is either the gamma tiles or the
+    # SharedTiles description of them. Returns the frame, the tile
+    # statistics and the tiling, solve and stitching times
+    if isinstance(gammaseg,tuple):
+        releaseshared((gammaseg[0],))
+        gammaseg = attachshared(gammaseg)
+    t0 = time.perf_counter()
+    u0seg = segpadimg(u0,Rs,dtype=gammaseg.dtype)
+    stats = np.zeros(u0seg.shape[0],dtype=tilestatsdtype)
+    t1 = time.perf_counter()
+    if solver == 'batch':
+        useg = batchoptim(u0seg,gammaseg,otfmask,alpha,iterationN,None,ftol,gtol,stats,bgiterationN)
+    else:
+        useg = np.empty_like(u0seg)
+        for ii in range(u0seg.shape[0]):
+            useg[ii],stats[ii] = tilesolve(u0seg[ii],gammaseg[ii],otfmask,alpha,iterationN,None,ftol,gtol,bgiterationN)
+    t2 = time.perf_counter()
+    out = stitchpadimg(useg)
+    out[out<0] = 1e-6
+    t3 = time.perf_counter()
+    return out,stats,{'tiling':t1-t0,'solve':t2-t1,'stitching':t3-t2}
+
+def addframemetrics(metrics,result):
+    # record the statistics and times of a framesolve result, and return
+    # the frame and its statistics
+    out,stats,times = result
+    if metrics is not None:
+        for stage,seconds in times.items():
+            metrics.add(stage,seconds)
+        metrics.addtiles(stats)
+    return out,stats
+
+def reducenoise(Rs,imsd,varmap,gainmap,R,pixelsize,NA,Lambda,alpha,iterationN,Type='OTFweighted',w=1,h=0.7,solver='scipy',batchframes=1,workers=None,executor=None,schedule='tiles',dtype=np.float64,warmstart=None,ftol=2.2e-9,gtol=1e-5,returnstats=False,bgiterationN=None,metrics=None):
+    # solver: 'scipy' (L-BFGS-B per tile) or 'batch' (all tiles of batchframes frames together)
+    # workers, executor: process pool size, or an existing pool to use
+    # schedule: 'tiles' sends tiles to the workers, 'frames' whole frames
+    # dtype: precision of the tiles and of the returned stack. 'batch' runs in dtype, 'scipy'
+    #   gets dtype data and gamma but iterates in float64. float32 is within 1e-2 of the
+    #   image maximum of float64 for 'batch' (2e-4 on average) and within 1e-4 for 'scipy'
+    # warmstart: start each batch from this blend of the last result and the data ('tiles' only)
+    # ftol, gtol: L-BFGS stopping tolerances on the cost reduction and the projected gradient
+    # returnstats: also return the (N,Ns,Ns) tilestatsdtype statistics
+    # bgiterationN: iteration limit for background tiles, which start from backgroundsolve
+    # Rs=None solves whole frames instead of tiles (frameoptim)
+    # varmap can be a Calibration, with gainmap None
+    # metrics: a Metrics or a callable(stage,seconds)
     assert imsd.ndim==3, "imsd should be a 3D matrix"
+    assert solver in ('scipy','batch'), "solver should be 'scipy' or 'batch'"
+    assert schedule in ('tiles','frames'), "schedule should be 'tiles' or 'frames'"
+    assert (warmstart is None) or (schedule == 'tiles'), "warmstart needs schedule='tiles'"
+    metrics = getmetrics(metrics)
+    with stagetimer(metrics,'calibration'):
+        cal = calibration(varmap,gainmap)
+        if Rs is not None:
+            cal.tiles(Rs,dtype)
+        fsz = framesize(imsd.shape[1:]) if Rs is None else Rs+2
+        noisemask = tuple(wt.astype(dtype) for wt in noiseweights(opticscache.filter(fsz,pixelsize,NA,Lambda,Type,w,h)))
+    return solveframes(Rs,imsd,cal,noisemask,R,alpha,iterationN,solver,batchframes,workers,executor,schedule,dtype,warmstart,ftol,gtol,returnstats,bgiterationN,metrics=metrics)
+
+def solveframes(Rs,imsd,cal,noisemask,R,alpha,iterationN,solver='scipy',batchframes=1,workers=None,executor=None,schedule='tiles',dtype=np.float64,warmstart=None,ftol=2.2e-9,gtol=1e-5,returnstats=False,bgiterationN=None,shared=None,metrics=None):
+    # reducenoise after the setup, cal is a Calibration and noisemask the noiseweights
+    # shared: SharedTiles of the 'tiles' schedule to reuse, else one is created
     N = imsd.shape[0]
-    outL = np.zeros(imsd.shape)
-    rcfilter = genfilter(fsz,pixelsize,NA,Lambda,Type,w,h)
-    if gainmap.ndim == 2:
-        varseg = segpadimg(varmap,Rs)
-        gainseg = segpadimg(gainmap,Rs)
-        for ii in range(N):
-            out = optimf(imsd[ii],varseg,gainseg,rcfilter,Rs,R,alpha,iterationN)
-            outL[ii] = out
-    if gainmap.ndim == 3:
-        for ii in range(N):            
-            varseg = segpadimg(varmap[ii],Rs)
-            gainseg = segpadimg(gainmap[ii],Rs)
-            out = optimf(imsd[ii],varseg,gainseg,rcfilter,Rs,R,alpha,iterationN)
-            outL[ii] = out
-    return outL
-    
+    if Rs is None:
+        outL = np.zeros(imsd.shape,dtype=dtype)
+        stats = np.zeros(N,dtype=tilestatsdtype)
+        for ii in range(0,N,batchframes):
+            sel = slice(ii,min(ii+batchframes,N))
+            x0 = warmestimate(imsd[sel],outL[ii-1] if ii > 0 else None,warmstart)
+            with stagetimer(metrics,'solve'):
+                outL[sel] = frameoptim(imsd[sel].astype(dtype),cal.framegamma(sel).astype(dtype),noisemask,alpha,iterationN,solver,x0,ftol,gtol,stats[sel],bgiterationN)
+        if metrics is not None:
+            metrics.addtiles(stats)
+        return (outL,stats.reshape(N,1,1)) if returnstats else outL
+    fsz = Rs+2
+    Ns = R//Rs
+    outL = np.zeros(imsd.shape,dtype=dtype)
+    stats = np.zeros((N,Ns*Ns),dtype=tilestatsdtype)
+    if (solver == 'batch') and (schedule == 'tiles'):
+        gammaseg = cal.tiles(Rs,dtype)
+        for ii in range(0,N,batchframes):
+            if cal.gamma.ndim == 3:
+                gammaseg = cal.tiles(Rs,dtype)[ii:ii+batchframes].reshape(-1,fsz,fsz)
+            x0 = warmestimate(imsd[ii:ii+batchframes],outL[ii-1] if ii > 0 else None,warmstart)
+            outL[ii:ii+batchframes] = optimbatch(imsd[ii:ii+batchframes],gammaseg,noisemask,Rs,R,alpha,iterationN,x0,ftol,gtol,stats[ii:ii+batchframes].reshape(-1),bgiterationN,metrics)
+        return (outL,imagestats(stats,Ns)) if returnstats else outL
+    if workers is None:
+        workers = defaultworkers()
+    if executor is None:
+        with cf.ProcessPoolExecutor(max_workers=workers) as pool:
+            return solveframes(Rs,imsd,cal,noisemask,R,alpha,iterationN,solver,batchframes,workers,pool,schedule,dtype,warmstart,ftol,gtol,returnstats,bgiterationN,metrics=metrics)
+    if schedule == 'frames':
+        with SharedTiles(Ns*Ns,fsz,dtype,keys=('gammaseg',)) as shared:
+            if cal.gamma.ndim == 2:
+                shared.gammaseg[...] = cal.tiles(Rs,dtype)
+            # keep a bounded number of frames in flight
+            pending = collections.deque()
+            for ii in range(N):
+                if cal.gamma.ndim == 2:
+                    gammaseg = shared.desc('gammaseg')
+                else:
+                    gammaseg = cal.frametiles(ii,Rs,dtype)
+                pending.append((ii,executor.submit(framesolve,imsd[ii],gammaseg,noisemask,Rs,R,alpha,iterationN,solver,ftol,gtol,bgiterationN)))
+                if len(pending) >= 2*workers:
+                    jj,p = pending.popleft()
+                    outL[jj],stats[jj] = addframemetrics(metrics,p.result())
+            while pending:
+                jj,p = pending.popleft()
+                outL[jj],stats[jj] = addframemetrics(metrics,p.result())
+        return (outL,imagestats(stats,Ns)) if returnstats else outL
+    if shared is None:
+        keys = ('u0seg','gammaseg','useg') + (('x0seg',) if warmstart is not None else ())
+        with SharedTiles(batchframes*Ns*Ns,fsz,dtype,keys) as shared:
+            return solveframes(Rs,imsd,cal,noisemask,R,alpha,iterationN,solver,batchframes,workers,executor,schedule,dtype,warmstart,ftol,gtol,returnstats,bgiterationN,shared,metrics)
+    if cal.gamma.ndim == 2:
+        shared.gammaseg[:Ns*Ns] = cal.tiles(Rs,dtype)
+        shared.gammaseg[Ns*Ns:].reshape(batchframes-1,Ns*Ns,fsz,fsz)[...] = shared.gammaseg[:Ns*Ns]
+    for ii in range(0,N,batchframes):
+        nf = min(batchframes,N-ii)
+        with stagetimer(metrics,'tiling'):
+            for jj in range(nf):
+                tiles = slice(jj*Ns*Ns,(jj+1)*Ns*Ns)
+                if cal.gamma.ndim == 3:
+                    shared.gammaseg[tiles] = cal.frametiles(ii+jj,Rs,dtype)
+                segpadimg(imsd[ii+jj],Rs,out=shared.u0seg[tiles])
+                if warmstart is not None:
+                    x0 = warmestimate(imsd[ii+jj],outL[ii-1] if ii > 0 else None,warmstart)
+                    segpadimg(imsd[ii+jj] if x0 is None else x0,Rs,out=shared.x0seg[tiles])
+        with stagetimer(metrics,'solve'):
+            useg = optimshared(nf*Ns*Ns,shared,noisemask,alpha,iterationN,executor,workers,ftol,gtol,bgiterationN)
+        stats[ii:ii+nf] = shared.stats[:nf*Ns*Ns].reshape(nf,Ns*Ns)
+        if metrics is not None:
+            metrics.addtiles(stats[ii:ii+nf])
+        with stagetimer(metrics,'stitching'):
+            for jj in range(nf):
+                out = stitchpadimg(useg[jj*Ns*Ns:(jj+1)*Ns*Ns],out=outL[ii+jj])
+                out[out<0] = 1e-6
+    return (outL,imagestats(stats,Ns)) if returnstats else outL
 
-    
-    
-    
-    
\ No newline at end of file
+def reducenoisestream(Rs,frames,varmap,gainmap,R,pixelsize,NA,Lambda,alpha,iterationN,Type='OTFweighted',w=1,h=0.7,solver='scipy',workers=None,executor=None,window=None,dtype=np.float64,ftol=2.2e-9,gtol=1e-5,bgiterationN=None,metrics=None):
+    # generator version of reducenoise for stacks that do not fit in
+    # memory. frames is any iterable of (R,R) frames (a list, a memmap,
+    # a frame source, ...) and the denoised frames are yielded in order.
+    # Whole frames go to the workers as with schedule='frames'. At most
+    # window frames (default 2*workers) are in flight, and new frames are
+    # only read from frames when the caller asks for the next result, so
+    # a slow consumer holds back the reading and the solving.
+    # gainmap and varmap are (R,R), or (N,R,R) indexed by frame number,
+    # or varmap is a Calibration and gainmap None.
+    # ftol, gtol, bgiterationN and metrics are as in reducenoise.
+    fsz = Rs+2
+    assert solver in ('scipy','batch'), "solver should be 'scipy' or 'batch'"
+    Ns = R//Rs
+    if workers is None:
+        workers = defaultworkers()
+    if window is None:
+        window = 2*workers
+    assert window >= 1, "window should be at least 1"
+    metrics = getmetrics(metrics)
+    if executor is None:
+        with stagetimer(metrics,'calibration'):
+            cal = calibration(varmap,gainmap)
+        with cf.ProcessPoolExecutor(max_workers=workers) as pool:
+            yield from reducenoisestream(Rs,frames,cal,None,R,pixelsize,NA,Lambda,alpha,iterationN,Type,w,h,solver,workers,pool,window,dtype,ftol,gtol,bgiterationN,metrics)
+        return
+    with stagetimer(metrics,'calibration'):
+        noisemask = tuple(wt.astype(dtype) for wt in noiseweights(opticscache.filter(fsz,pixelsize,NA,Lambda,Type,w,h)))
+        cal = calibration(varmap,gainmap)
+        if cal.gamma.ndim == 2:
+            cal.tiles(Rs,dtype)
+    with SharedTiles(Ns*Ns,fsz,dtype,keys=('gammaseg',)) as shared:
+        if cal.gamma.ndim == 2:
+            shared.gammaseg[...] = cal.tiles(Rs,dtype)
+        pending = collections.deque()
+        try:
+            for ii,frame in enumerate(frames):
+                if cal.gamma.ndim == 2:
+                    gammaseg = shared.desc('gammaseg')
+                else:
+                    gammaseg = cal.frametiles(ii,Rs,dtype)
+                pending.append(executor.submit(framesolve,np.asarray(frame),gammaseg,noisemask,Rs,R,alpha,iterationN,solver,ftol,gtol,bgiterationN))
+                if len(pending) >= window:
+                    yield addframemetrics(metrics,pending.popleft().result())[0]
+            while pending:
+                yield addframemetrics(metrics,pending.popleft().result())[0]
+        finally:
+            # the caller stopped early, drop the queued frames before the
+            # shared gamma tiles go away
+            for p in pending:
+                p.cancel()
+            cf.wait(pending)
+
+class Denoiser(object):
+    # reducenoise with everything that does not depend on the frames set
+    # up once and kept between calls: the Calibration and its gamma tiles,
+    # the noise weights of the OTF mask, the worker pool and the shared
+    # tile buffers of the 'tiles' schedule. The pool and the buffers are
+    # created by the first call that needs them and kept until close().
+    # scipy.fft caches its own FFT plans, so there are none to hold here.
+    # varmap can be a Calibration (with gainmap None), and executor an
+    # existing pool, which close() then leaves running. A per-frame
+    # calibration is indexed from the first frame of each call. metrics
+    # collects over all calls, including the setup. The other arguments
+    # are as in reducenoise
+    def __init__(self,Rs,varmap,gainmap,R,pixelsize,NA,Lambda,alpha,iterationN,Type='OTFweighted',w=1,h=0.7,solver='scipy',batchframes=1,workers=None,executor=None,schedule='tiles',dtype=np.float64,warmstart=None,ftol=2.2e-9,gtol=1e-5,bgiterationN=None,metrics=None):
+        assert solver in ('scipy','batch'), "solver should be 'scipy' or 'batch'"
+        assert schedule in ('tiles','frames'), "schedule should be 'tiles' or 'frames'"
+        assert (warmstart is None) or (schedule == 'tiles'), "warmstart needs schedule='tiles'"
+        self.Rs = Rs
+        self.R = R
+        self.optics = (pixelsize,NA,Lambda,Type,w,h)
+        self.alpha = alpha
+        self.iterationN = iterationN
+        self.solver = solver
+        self.batchframes = batchframes
+        self.workers = defaultworkers() if workers is None else workers
+        self.schedule = schedule
+        self.dtype = dtype
+        self.warmstart = warmstart
+        self.ftol = ftol
+        self.gtol = gtol
+        self.bgiterationN = bgiterationN
+        self.metrics = getmetrics(metrics)
+        with stagetimer(self.metrics,'calibration'):
+            self.calibration = calibration(varmap,gainmap)
+            if Rs is not None:
+                self.calibration.tiles(Rs,dtype)
+            fsz = framesize((R,R)) if Rs is None else Rs+2
+            self.noisemask = tuple(wt.astype(dtype) for wt in noiseweights(opticscache.filter(fsz,*self.optics)))
+        self.executor = executor
+        self.ownexecutor = executor is None
+        self.shared = None
+
+    def pool(self):
+        if self.executor is None:
+            self.executor = cf.ProcessPoolExecutor(max_workers=self.workers)
+        return self.executor
+
+    def __call__(self,frames,returnstats=False):
+        # denoise (N,R,R) frames, or a single (R,R) frame
+        frames = np.asarray(frames)
+        single = frames.ndim == 2
+        if single:
+            frames = frames[None]
+        executor = None
+        if (self.Rs is not None) and ((self.solver == 'scipy') or (self.schedule == 'frames')):
+            executor = self.pool()
+            if (self.schedule == 'tiles') and (self.shared is None):
+                Ns = self.R//self.Rs
+                keys = ('u0seg','gammaseg','useg') + (('x0seg',) if self.warmstart is not None else ())
+                self.shared = SharedTiles(self.batchframes*Ns*Ns,self.Rs+2,self.dtype,keys)
+        out = solveframes(self.Rs,frames,self.calibration,self.noisemask,self.R,self.alpha,self.iterationN,self.solver,self.batchframes,self.workers,executor,self.schedule,self.dtype,self.warmstart,self.ftol,self.gtol,returnstats,self.bgiterationN,self.shared,self.metrics)
+        if single:
+            return (out[0][0],out[1][0]) if returnstats else out[0]
+        return out
+
+    def stream(self,frames,window=None):
+        # as reducenoisestream, with this denoiser's calibration and pool
+        assert self.Rs is not None, "stream needs tiles"
+        pixelsize,NA,Lambda,Type,w,h = self.optics
+        return reducenoisestream(self.Rs,frames,self.calibration,None,self.R,pixelsize,NA,Lambda,self.alpha,self.iterationN,Type,w,h,solver=self.solver,workers=self.workers,executor=self.pool(),window=window,dtype=self.dtype,ftol=self.ftol,gtol=self.gtol,bgiterationN=self.bgiterationN,metrics=self.metrics)
+
+    def close(self):
+        if self.shared is not None:
+            self.shared.close()
+            self.shared = None
+        if self.ownexecutor and (self.executor is not None):
+            self.executor.shutdown()
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""
+Simulated data and reference versions of pyNCS functions for testing.
+"""
+import numpy
+
+
+def simStack(n_frames = 3, R = 32, n_spots = 6, seed = 1):
+    """
+    Frames of Gaussian spots on a background with camera noise, in
+    photons as reducenoise takes them, and the camera's variance and
+    gain maps.
+    """
+    rng = numpy.random.default_rng(seed)
+    x = numpy.arange(R)[:,None]
+    y = numpy.arange(R)[None,:]
+    u = numpy.full((R, R), 10.0)
+    for i in range(n_spots):
+        [xc, yc] = rng.uniform(low = 0.0, high = R, size = 2)
+        u += 200.0*numpy.exp(-((x - xc)**2 + (y - yc)**2)/(2.0*1.5*1.5))
+    varmap = rng.uniform(low = 2.0, high = 50.0, size = (R, R))
+    gainmap = rng.uniform(low = 1.8, high = 2.2, size = (R, R))
+    imsd = rng.poisson(u, size = (n_frames, R, R)) + rng.normal(scale = numpy.sqrt(varmap)/gainmap, size = (n_frames, R, R))
+    return [imsd, varmap, gainmap]
+
+def segpadimg(img, R1):
+    """
+    The loop version of segpadimg that tileview replaced.
+    """
+    R = img.shape[0]
+    Ns = R//R1
+    ims0 = img[:,0:R1+1]
+    for ii in numpy.arange(1, Ns-1, 1):
+        tmp = img[:,ii*R1-1:(ii+1)*R1+1]
+        ims0 = numpy.concatenate((ims0, tmp), axis = 1)
+    tmp = img[:,(Ns-1)*R1-1:]
+    ims0 = numpy.concatenate((ims0, tmp), axis = 1)
+
+    ims1 = ims0[0:R1+1,:]
+    for ii in numpy.arange(1, Ns-1, 1):
+        tmp = ims0[ii*R1-1:(ii+1)*R1+1,:]
+        ims1 = numpy.concatenate((ims1, tmp), axis = 0)
+    tmp = ims0[(Ns-1)*R1-1:,:]
+    ims1 = numpy.concatenate((ims1, tmp), axis = 0)
+    ims2 = numpy.pad(ims1, ((1,1),(1,1)), "edge")
+    return segimg(ims2, R1+2)
+
+def segimg(img, R1):
+    """
+    The loop version of segimg.
+    """
+    R = img.shape[0]
+    Ns = R//R1
+    imgsegs = numpy.zeros((Ns*Ns, R1, R1))
+    for ii in numpy.arange(0, Ns, 1):
+        tmp = img[:,ii*R1:(ii+1)*R1]
+        imgsegs[ii*Ns:(ii+1)*Ns,:,:] = tmp.reshape((Ns, R1, R1))
+    return imgsegs
+
+def stitchpadimg(imgseg):
+    """
+    The loop version of stitchpadimg.
+    """
+    N = imgseg.shape[0]
+    R1 = int(numpy.sqrt(N))
+    a = []
+    b = []
+    for ii in range(N):
+        a.append(imgseg[ii,1:-1,1:-1])
+        if numpy.mod(ii+1, R1) == 0:
+            b.append(numpy.vstack(a))
+            a = []
+    return numpy.hstack(b)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""
+Test the fast path for background tiles.
+"""
+import numpy
+
+import pyNCS.denoisetools as ncs
+
+
+alpha = 0.2
+r_size = 10
+
+def simTiles(n_tiles, background, spot = 0.0, seed = 1):
+    """
+    Tiles of a flat background, with a Gaussian spot of height spot,
+    with shot noise and read noise, and their gamma tiles.
+    """
+    rng = numpy.random.default_rng(seed)
+    x = numpy.arange(r_size)[:,None]
+    y = numpy.arange(r_size)[None,:]
+    u = background + spot*numpy.exp(-((x - 5.0)**2 + (y - 4.0)**2)/(2.0*1.5*1.5))
+    gamma = rng.uniform(low = 0.5, high = 12.0, size = (n_tiles, r_size, r_size))
+    u0 = rng.poisson(u, size = gamma.shape) + rng.normal(scale = numpy.sqrt(gamma))
+    return [u0, gamma]
+
+def weights():
+    return ncs.noiseweights(ncs.genfilter(r_size, 0.1, 1.4, 0.7))
+
+def test_background_1():
+    """
+    Test that flat tiles are background and tiles with a spot are not.
+    """
+    for background in [10.0, 50.0, 200.0]:
+        [u0, gamma] = simTiles(8, background)
+        assert(numpy.all(ncs.backgroundtiles(u0, gamma)))
+
+        [u0, gamma] = simTiles(8, background, spot = 200.0)
+        assert(not numpy.any(ncs.backgroundtiles(u0, gamma)))
+
+def test_background_2():
+    """
+    Test backgroundsolve against a full L-BFGS solve of background tiles.
+    """
+    for background in [10.0, 50.0]:
+        [u0, gamma] = simTiles(4, background)
+        u_bg = ncs.backgroundsolve(u0, gamma, weights(), alpha)
+        u_full = ncs.batchoptim(u0, gamma, weights(), alpha, 200)
+
+        cost0 = ncs.batchcostgrad(numpy.maximum(u0, 0.01), u0, gamma, weights(), alpha)[0]
+        cost_bg = ncs.batchcostgrad(u_bg, u0, gamma, weights(), alpha)[0]
+        cost_full = ncs.batchcostgrad(u_full, u0, gamma, weights(), alpha)[0]
+
+        # Most of the cost reduction, and close to the solution on the scale of the noise.
+        assert(numpy.all((cost_bg - cost_full) < 0.1*(cost0 - cost_full)))
+        rms = numpy.sqrt(numpy.mean((u_bg - u_full)**2, axis = (1, 2)))
+        assert(numpy.all(rms < 0.15*numpy.std(u0, axis = (1, 2))))
+
+def test_background_3():
+    """
+    Test that bgiterationN = 0 keeps the closed form for background tiles
+    and leaves the other tiles alone.
+    """
+    [u0_bg, gamma_bg] = simTiles(3, 20.0, seed = 2)
+    [u0_spot, gamma_spot] = simTiles(3, 20.0, spot = 200.0, seed = 3)
+    u0 = numpy.concatenate((u0_bg, u0_spot))
+    gamma = numpy.concatenate((gamma_bg, gamma_spot))
+    is_bg = ncs.backgroundtiles(u0, gamma)
+    assert(numpy.array_equal(is_bg, [True]*3 + [False]*3))
+
+    u_bg = numpy.maximum(ncs.backgroundsolve(u0_bg, gamma_bg, weights(), alpha), 0.0)
+
+    # Batched solver.
+    stats = numpy.zeros(6, dtype = ncs.tilestatsdtype)
+    u1 = ncs.batchoptim(u0, gamma, weights(), alpha, 50)
+    u2 = ncs.batchoptim(u0, gamma, weights(), alpha, 50, stats = stats, bgiterationN = 0)
+    assert(numpy.allclose(u2[3:], u1[3:], rtol = 1.0e-12, atol = 0.0))
+    assert(numpy.allclose(u2[:3], u_bg))
+    assert(numpy.all(stats["nit"][:3] == 0))
+    assert(numpy.all(stats["nit"][3:] > 0))
+
+    # scipy solver.
+    for i in range(6):
+        [v1, stats1] = ncs.tilesolve(u0[i], gamma[i], weights(), alpha, 50)
+        [v2, stats2] = ncs.tilesolve(u0[i], gamma[i], weights(), alpha, 50, bgiterationN = 0)
+        if is_bg[i]:
+            assert(numpy.allclose(v2, u_bg[i]))
+            assert(stats2[0] == 0)
+        else:
+            assert(numpy.array_equal(v1, v2))
+            assert(stats1 == stats2)
+
+
+if (__name__ == "__main__"):
+    test_background_1()
+    test_background_2()
+    test_background_3()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""
+Test the cached camera calibration.
+"""
+import numpy
+
+import pyNCS.denoisetools as ncs
+import pyNCS.test.py_ref as pyRef
+
+
+R = 32
+Rs = 8
+args = (R, 0.1, 1.4, 0.7, 0.2, 10)
+
+def test_calibration_1():
+    """
+    Test that reducenoise gives the same results with a Calibration as with the maps.
+    """
+    [imsd, varmap, gainmap] = pyRef.simStack(n_frames = 2)
+    varmaps = numpy.stack((varmap, 1.5*varmap))
+    gainmaps = numpy.stack((gainmap, 0.9*gainmap))
+    for [var, gain] in [[varmap, gainmap], [varmaps, gainmaps]]:
+        cal = ncs.Calibration(var, gain)
+        for kwds in [{"solver" : "scipy"}, {"solver" : "batch"}, {"schedule" : "frames"}]:
+            ncs1 = ncs.reducenoise(Rs, imsd, var, gain, *args, workers = 2, **kwds)
+            ncs2 = ncs.reducenoise(Rs, imsd, cal, None, *args, workers = 2, **kwds)
+            assert(numpy.array_equal(ncs1, ncs2))
+
+    # The per-frame calibration is used per frame.
+    ncs1 = ncs.reducenoise(Rs, imsd[1:], varmaps[1], gainmaps[1], *args, workers = 1)
+    assert(numpy.array_equal(ncs1[0], ncs2[1]))
+
+def test_calibration_2():
+    """
+    Test that the gamma tiles are computed once and reused.
+    """
+    [imsd, varmap, gainmap] = pyRef.simStack(n_frames = 2)
+    calls = []
+    segpadimg = ncs.segpadimg
+    def countingSegpadimg(img, R1, *args, **kwds):
+        calls.append(img.shape)
+        return segpadimg(img, R1, *args, **kwds)
+
+    try:
+        ncs.segpadimg = countingSegpadimg
+        for [var, gain] in [[varmap, gainmap], [numpy.stack((varmap, varmap)), numpy.stack((gainmap, gainmap))]]:
+            cal = ncs.Calibration(var, gain)
+            assert(numpy.array_equal(cal.gamma, var/gain/gain))
+
+            del calls[:]
+            tiles = cal.tiles(Rs)
+            assert(len(calls) == var.size//(R*R))
+            assert(cal.tiles(Rs) is tiles)
+            assert(not tiles.flags.writeable)
+            assert(cal.tiles(Rs, numpy.float32) is not tiles)
+            assert(cal.tiles(Rs, numpy.float32).dtype == numpy.float32)
+
+            for i in range(2):
+                frame_tiles = cal.frametiles(i, Rs)
+                assert(numpy.shares_memory(frame_tiles, tiles))
+                assert(numpy.array_equal(frame_tiles, segpadimg(cal.framegamma(i), Rs)))
+
+            # reducenoise only tiles the frames.
+            del calls[:]
+            ncs.reducenoise(Rs, imsd, cal, None, *args, solver = "batch")
+            assert(len(calls) == imsd.shape[0])
+            assert(cal.tiles(Rs) is tiles)
+    finally:
+        ncs.segpadimg = segpadimg
+
+def test_calibration_3():
+    """
+    Test gamma given directly and regions of interest.
+    """
+    [imsd, varmap, gainmap] = pyRef.simStack(n_frames = 1)
+    gamma = varmap/gainmap/gainmap
+    cal = ncs.Calibration(gamma)
+    assert(numpy.array_equal(cal.gamma, gamma))
+    assert(ncs.calibration(cal, None) is cal)
+
+    roi = cal.roi(16, 4, 8)
+    assert(cal.roi(16, 4, 8) is roi)
+    assert(numpy.array_equal(roi.gamma, ncs.cropimage(gamma, 16, 4, 8)))
+
+
+if (__name__ == "__main__"):
+    test_calibration_1()
+    test_calibration_2()
+    test_calibration_3()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""
+Test the Denoiser against reducenoise.
+"""
+import concurrent.futures
+import numpy
+import pytest
+
+import pyNCS.denoisetools as ncs
+import pyNCS.test.py_ref as py_ref
+
+
+R = 32
+Rs = 8
+optics = (0.1, 1.4, 0.7)
+alpha = 0.2
+iterationN = 10
+
+def sharedExists(name):
+    try:
+        block = ncs.shm.SharedMemory(name = name)
+    except FileNotFoundError:
+        return False
+    block.close()
+    return True
+
+def test_denoiser_1():
+    """
+    Test that a Denoiser gives the same results as reducenoise, over several calls.
+    """
+    [imsd, varmap, gainmap] = py_ref.simStack()
+    for kwds in [{"solver" : "scipy"},
+                 {"solver" : "scipy", "batchframes" : 2, "warmstart" : 0.5},
+                 {"solver" : "batch"},
+                 {"solver" : "scipy", "schedule" : "frames"}]:
+        [ref, ref_stats] = ncs.reducenoise(Rs, imsd, varmap, gainmap, R, *optics, alpha, iterationN, workers = 2, returnstats = True, **kwds)
+        with ncs.Denoiser(Rs, varmap, gainmap, R, *optics, alpha, iterationN, workers = 2, **kwds) as denoiser:
+            [out, stats] = denoiser(imsd, returnstats = True)
+            assert(numpy.array_equal(out, ref))
+            assert(numpy.array_equal(stats, ref_stats))
+
+            # Calls after the first reuse the setup.
+            assert(numpy.array_equal(denoiser(imsd), ref))
+            if "warmstart" not in kwds:
+                assert(numpy.array_equal(denoiser(imsd[1]), ref[1]))
+
+def test_denoiser_2():
+    """
+    Test the Denoiser stream against reducenoisestream.
+    """
+    [imsd, varmap, gainmap] = py_ref.simStack()
+    ref = list(ncs.reducenoisestream(Rs, imsd, varmap, gainmap, R, *optics, alpha, iterationN, workers = 2))
+    with ncs.Denoiser(Rs, varmap, gainmap, R, *optics, alpha, iterationN, workers = 2) as denoiser:
+        out = list(denoiser.stream(iter(imsd), window = 2))
+    assert(numpy.array_equal(numpy.array(out), numpy.array(ref)))
+
+def test_denoiser_3():
+    """
+    Test that close() releases the worker pool and the shared memory.
+    """
+    [imsd, varmap, gainmap] = py_ref.simStack(n_frames = 1)
+    denoiser = ncs.Denoiser(Rs, varmap, gainmap, R, *optics, alpha, iterationN, workers = 2)
+    denoiser(imsd)
+    executor = denoiser.executor
+    names = [block.name for block in denoiser.shared.blocks.values() if block is not None]
+    if ncs.shm is not None:
+        assert(len(names) > 0)
+        assert(all(sharedExists(name) for name in names))
+
+    denoiser.close()
+    assert(denoiser.executor is None)
+    assert(denoiser.shared is None)
+    with pytest.raises(RuntimeError):
+        executor.submit(abs, 1)
+    for name in names:
+        assert(name not in ncs._published)
+        assert(not sharedExists(name))
+
+    # A pool that was passed in is left running.
+    with concurrent.futures.ProcessPoolExecutor(max_workers = 2) as pool:
+        with ncs.Denoiser(Rs, varmap, gainmap, R, *optics, alpha, iterationN, executor = pool) as denoiser:
+            denoiser(imsd)
+        assert(pool.submit(abs, -1).result() == 1)
+
+
+if (__name__ == "__main__"):
+    test_denoiser_1()
+    test_denoiser_2()
+    test_denoiser_3()
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+"""
+Test float32 noise reduction against float64.
+"""
+import numpy
+
+import pyNCS.denoisetools as ncs
+import pyNCS.test.py_ref as pyRef
+
+
+def test_dtype_1():
+    """
+    Test that float32 results are within the documented bounds of float64.
+    """
+    for [R, Rs, n_spots] in [[32, 8, 6], [64, 16, 20]]:
+        [imsd, varmap, gainmap] = pyRef.simStack(n_frames = 2, R = R, n_spots = n_spots)
+        for [solver, max_err, mean_err] in [["scipy", 1.0e-4, 1.0e-6], ["batch", 1.0e-2, 2.0e-4]]:
+            ncs64 = ncs.reducenoise(Rs, imsd, varmap, gainmap, R, 0.1, 1.4, 0.7, 0.2, 50, solver = solver, workers = 1)
+            ncs32 = ncs.reducenoise(Rs, imsd, varmap, gainmap, R, 0.1, 1.4, 0.7, 0.2, 50, solver = solver, workers = 1, dtype = numpy.float32)
+
+            assert(ncs64.dtype == numpy.float64)
+            assert(ncs32.dtype == numpy.float32)
+            diff = numpy.abs(ncs32 - ncs64)/numpy.max(ncs64)
+            assert(numpy.max(diff) < max_err)
+            assert(numpy.mean(diff) < mean_err)
+
+def test_dtype_2():
+    """
+    Test that gendatastack returns stacks of dtype.
+    """
+    [imsd, varmap, gainmap] = pyRef.simStack(n_frames = 1)
+    normimg = numpy.ones(varmap.shape)
+    stacks = ncs.gendatastack(normimg, varmap, gainmap, 100, 10, 100, 2, dtype = numpy.float32)
+    for stack in stacks[:3]:
+        assert(stack.dtype == numpy.float32)
+        assert(stack.shape == (2,) + varmap.shape)
+
+
+if (__name__ == "__main__"):
+    test_dtype_1()
+    test_dtype_2()
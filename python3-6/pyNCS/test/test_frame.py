@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""
+Test solving whole frames (reducenoise with Rs = None).
+"""
+import numpy
+
+import pyNCS.denoisetools as ncs
+import pyNCS.test.py_ref as pyRef
+
+
+alpha = 0.2
+
+def frameCost(u, data, gamma):
+    """
+    Cost of the frames u, edge padded to framesize as frameoptim does.
+    """
+    [N, H, W] = u.shape
+    fsz = ncs.framesize((H, W))
+    pad = ((0, 0), (1, fsz[0] - H - 1), (1, fsz[1] - W - 1))
+    weights = ncs.noiseweights(ncs.genfilter(fsz, 0.1, 1.4, 0.7))
+    gamma = numpy.broadcast_to(numpy.pad(gamma, pad[1:], "edge"), (N,) + fsz)
+    return ncs.batchcostgrad(numpy.pad(u, pad, "edge"), numpy.pad(data, pad, "edge"), gamma, weights, alpha)[0]
+
+def test_frame_1():
+    """
+    Test that whole frames get about the same cost reduction as tiles, for
+    even frames and for odd frames that framesize pads.
+    """
+    for [R, Rs] in [[32, 8], [33, 11]]:
+        [imsd, varmap, gainmap] = pyRef.simStack(n_frames = 2, R = R)
+        gamma = varmap/gainmap/gainmap
+        if (R%2) == 1:
+            assert(ncs.framesize((R, R)) == (36, 36))
+
+        tiled = ncs.reducenoise(Rs, imsd, varmap, gainmap, R, 0.1, 1.4, 0.7, alpha, 50, workers = 1)
+        data_cost = frameCost(imsd, imsd, gamma)
+        tiled_cost = frameCost(tiled, imsd, gamma)
+        assert(numpy.all(tiled_cost < data_cost))
+
+        frames = []
+        for solver in ["scipy", "batch"]:
+            [frame, stats] = ncs.reducenoise(None, imsd, varmap, gainmap, R, 0.1, 1.4, 0.7, alpha, 50, solver = solver, returnstats = True)
+            assert(frame.shape == imsd.shape)
+            assert(stats.shape == (2, 1, 1))
+            assert(numpy.all(stats["status"] == 0))
+            assert(numpy.all(frame >= 0.0))
+
+            frame_cost = frameCost(frame, imsd, gamma)
+            assert(numpy.all((data_cost - frame_cost) > 0.9*(data_cost - tiled_cost)))
+            assert(numpy.max(numpy.abs(frame - tiled)) < 0.1*numpy.max(tiled))
+            frames.append(frame)
+
+        # Both solvers minimize the same cost.
+        assert(numpy.max(numpy.abs(frames[0] - frames[1])) < 2.0e-3*numpy.max(frames[0]))
+
+def test_frame_2():
+    """
+    Test frameoptim on a rectangular odd sized frame, with an initial estimate.
+    """
+    [imsd, varmap, gainmap] = pyRef.simStack(n_frames = 1, R = 33)
+    imsd = imsd[:, :, :29]
+    gamma = (varmap/gainmap/gainmap)[:, :29]
+    fsz = ncs.framesize(imsd.shape[1:])
+    assert(fsz == (36, 32))
+
+    otfmask = ncs.genfilter(fsz, 0.1, 1.4, 0.7)
+    stats1 = numpy.zeros(1, dtype = ncs.tilestatsdtype)
+    u1 = ncs.frameoptim(imsd, gamma, otfmask, alpha, 50, stats = stats1)
+    assert(u1.shape == imsd.shape)
+    assert(stats1["status"][0] == 0)
+
+    # Starting from the solution converges faster, to the same frame.
+    stats2 = numpy.zeros(1, dtype = ncs.tilestatsdtype)
+    u2 = ncs.frameoptim(imsd, gamma, otfmask, alpha, 50, x0 = u1, stats = stats2)
+    assert(stats2["nit"][0] < stats1["nit"][0])
+    assert(numpy.allclose(u1, u2, rtol = 0.0, atol = 1.0e-3*numpy.max(u1)))
+
+
+if (__name__ == "__main__"):
+    test_frame_1()
+    test_frame_2()
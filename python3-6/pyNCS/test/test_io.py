@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+"""
+Test reading frames from files and writing them.
+"""
+import h5py
+import numpy
+import os
+import pytest
+import tempfile
+import zlib
+
+import pyNCS.denoisetools as ncs
+
+
+def makeFrames(n_frames = 10, ny = 12, nx = 16):
+    """
+    Frames that are all different, and not square so that a transposed
+    read shows.
+    """
+    return numpy.arange(n_frames*ny*nx, dtype = numpy.uint16).reshape(n_frames, ny, nx)
+
+def checkSource(source, frames, R, startx, starty):
+    """
+    Check a frame source against the frames it should return.
+    """
+    roi = frames[:, starty:starty+R, startx:startx+R]
+    for i in range(frames.shape[0]):
+        assert(numpy.array_equal(ncs.cropimage(frames[i], R, startx, starty), roi[i]))
+
+    assert(source.shape == roi.shape)
+    assert(len(source) == roi.shape[0])
+    assert(numpy.array_equal(source[3], roi[3]))
+    assert(numpy.array_equal(source[-1], roi[-1]))
+    assert(numpy.array_equal(source[2:7], roi[2:7]))
+    assert(numpy.array_equal(source[1:9:3], roi[1:9:3]))
+    assert(numpy.array_equal(numpy.array(list(source)), roi))
+    with pytest.raises(IndexError):
+        source[roi.shape[0]]
+
+def recordReads(source):
+    """
+    Returns the list that the (start, stop) of every read of source go to.
+    """
+    reads = []
+    read = source.read
+    def recordRead(start, stop):
+        reads.append((start, stop))
+        return read(start, stop)
+    source.read = recordRead
+    return reads
+
+def test_io_1():
+    """
+    Test reading a chunked HDF5 dataset, in blocks of chunks.
+    """
+    frames = makeFrames()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fname = os.path.join(tmp_dir, "frames.h5")
+        with h5py.File(fname, "w") as h5:
+            h5.create_dataset("movie", data = frames, chunks = (3, 12, 16))
+
+        with ncs.openframes(fname, key = "movie", R = 8, startx = 5, starty = 2) as source:
+            assert(isinstance(source, ncs.H5FrameSource))
+            checkSource(source, frames, 8, 5, 2)
+
+            reads = recordReads(source)
+            assert(len(list(source)) == 10)
+            assert(reads == [(0, 3), (3, 6), (6, 9), (9, 10)])
+
+        with ncs.openframes(fname, key = "movie") as source:
+            assert(numpy.array_equal(source[:], frames))
+
+def test_io_2():
+    """
+    Test reading a MATLAB v7.3 .mat file, which holds the frames transposed.
+    """
+    frames = makeFrames()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fname = os.path.join(tmp_dir, "frames.mat")
+        with h5py.File(fname, "w", userblock_size = 512) as h5:
+            h5.create_dataset("ims", data = frames.transpose(0, 2, 1))
+        with open(fname, "r+b") as fp:
+            fp.write(b"MATLAB 7.3 MAT-file")
+
+        with ncs.openframes(fname, R = 8, startx = 5, starty = 2) as source:
+            assert(source.transpose)
+            checkSource(source, frames, 8, 5, 2)
+
+        # Without the MATLAB header it is an ordinary HDF5 file.
+        with ncs.H5FrameSource(fname, "ims", matlab = False) as source:
+            assert(numpy.array_equal(source[:], frames.transpose(0, 2, 1)))
+
+def test_io_3():
+    """
+    Test reading .npy and raw files.
+    """
+    frames = makeFrames()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fname = os.path.join(tmp_dir, "frames.npy")
+        numpy.save(fname, frames)
+        with ncs.openframes(fname, R = 8, startx = 5, starty = 2) as source:
+            assert(isinstance(source, ncs.NpyFrameSource))
+            checkSource(source, frames, 8, 5, 2)
+
+        fname = os.path.join(tmp_dir, "frames.dat")
+        with open(fname, "wb") as fp:
+            fp.write(b"header")
+            fp.write(frames.tobytes())
+        with ncs.RawFrameSource(fname, (12, 16), R = 8, startx = 5, starty = 2, offset = 6) as source:
+            checkSource(source, frames, 8, 5, 2)
+
+        fname = os.path.join(tmp_dir, "frames.raw")
+        frames.tofile(fname)
+        with ncs.openframes(fname, framesz = (12, 16), R = 8, startx = 5, starty = 2) as source:
+            assert(isinstance(source, ncs.RawFrameSource))
+            checkSource(source, frames, 8, 5, 2)
+
+            # The block size is smaller than the stack.
+            source.blockframes = 4
+            reads = recordReads(source)
+            assert(numpy.array_equal(numpy.array(list(source)), frames[:, 2:10, 5:13]))
+            assert(reads == [(0, 4), (4, 8), (8, 10)])
+
+def test_io_4():
+    """
+    Test the checks on the files and the region of interest.
+    """
+    frames = makeFrames()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fname = os.path.join(tmp_dir, "frames.mat")
+        with open(fname, "wb") as fp:
+            fp.write(b"MATLAB 5.0 MAT-file")
+        with pytest.raises(ValueError):
+            ncs.openframes(fname)
+
+        fname = os.path.join(tmp_dir, "frames.raw")
+        frames.tofile(fname)
+        with pytest.raises(AssertionError):
+            ncs.openframes(fname)
+        with pytest.raises(AssertionError):
+            ncs.openframes(fname, framesz = (12, 16), R = 8, startx = 9, starty = 2)
+
+def test_io_5():
+    """
+    Test writing frames with H5FrameSink and reading them back with h5py.
+    """
+    frames = makeFrames(n_frames = 9).astype(numpy.float64) + 0.25
+    metrics = ncs.Metrics()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fname = os.path.join(tmp_dir, "ncs.h5")
+        with ncs.H5FrameSink(fname, (12, 16), key = "ncs", level = 6, workers = 2, metrics = metrics,
+                             alpha = 0.2, Rs = 16, Type = "OTFweighted", backend = None) as sink:
+            sink.write(frames[0])
+            assert(sink.writeframes(frame for frame in frames[1:]) == 9)
+            with pytest.raises(AssertionError):
+                sink.write(frames[0, :8])
+
+        with h5py.File(fname, "r") as h5:
+            data = h5["ncs"]
+            assert(data.shape == frames.shape)
+            assert(data.dtype == numpy.float32)
+            assert(data.chunks == (1, 12, 16))
+            assert(data.compression == "gzip")
+            assert(data.compression_opts == 6)
+            assert(numpy.array_equal(data[:], frames.astype(numpy.float32)))
+
+            # The chunks are written pre-compressed, check that they are zlib streams.
+            [filter_mask, chunk] = data.id.read_direct_chunk((4, 0, 0))
+            assert(numpy.array_equal(numpy.frombuffer(zlib.decompress(chunk), dtype = numpy.float32).reshape(12, 16), frames[4]))
+
+            assert(dict(data.attrs) == {"alpha" : 0.2, "Rs" : 16, "Type" : "OTFweighted"})
+
+        # And through openframes.
+        with ncs.openframes(fname, key = "ncs", R = 8, startx = 5, starty = 2) as source:
+            checkSource(source, frames.astype(numpy.float32), 8, 5, 2)
+
+    assert(metrics.summary()["io"] > 0.0)
+
+
+if (__name__ == "__main__"):
+    test_io_1()
+    test_io_2()
+    test_io_3()
+    test_io_4()
+    test_io_5()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+"""
+Test the analytic cost gradient and the batched L-BFGS solver.
+"""
+import numpy
+import scipy.optimize
+
+import pyNCS.denoisetools as ncs
+
+
+def simTiles(r_size, alpha = 0.2):
+    """
+    Tiles of a simulated image of Gaussian spots on a background with
+    shot noise, with their gamma tiles and the noise weights.
+    """
+    rng = numpy.random.default_rng(1)
+    im_size = 4*r_size
+    x = numpy.arange(im_size)[:,None]
+    y = numpy.arange(im_size)[None,:]
+    u = numpy.full((im_size, im_size), 10.0)
+    for i in range(12):
+        [xc, yc] = rng.uniform(low = 0.0, high = im_size, size = 2)
+        u += 200.0*numpy.exp(-((x - xc)**2 + (y - yc)**2)/(2.0*1.5*1.5))
+    gamma = rng.uniform(low = 0.5, high = 12.0, size = u.shape)
+    image = rng.poisson(u) + rng.normal(scale = numpy.sqrt(gamma))
+
+    data = ncs.segpadimg(image, r_size)
+    gammaseg = ncs.segpadimg(gamma, r_size)
+    weights = ncs.noiseweights(ncs.genfilter(r_size + 2, 0.1, 1.4, 0.7))
+    return [data, gammaseg, weights]
+
+def batchFun(data, gamma, weights, alpha):
+    """
+    The fun(x,ind) of batchlbfgs for the tiles in data.
+    """
+    def fun(x, ind):
+        [cost, grad] = ncs.batchcostgrad(x.reshape((-1,) + data.shape[1:]), data[ind], gamma[ind], weights, alpha)
+        return [cost, grad.reshape(x.shape)]
+    return fun
+
+def test_lbfgs_1():
+    """
+    Test that calcostgrad gives the cost of calcost, for even and odd tiles.
+    """
+    alpha = 0.3
+    for im_size in [10, 11]:
+        for i in range(5):
+            otfmask = numpy.random.uniform(low = 0.0, high = 1.0, size = (im_size, im_size))
+            gamma = numpy.random.uniform(low = 2.0, high = 4.0, size = (im_size, im_size))
+            image = numpy.random.uniform(low = 0.01, high = 10.0, size = (im_size, im_size))
+            u = numpy.random.uniform(low = 0.01, high = 10.0, size = (im_size, im_size))
+
+            t1 = ncs.calcostgrad(u.ravel(), image, gamma, otfmask, alpha)[0]
+            t2 = ncs.calcost(u.ravel(), image, gamma, numpy.ones_like(gamma), otfmask, alpha)
+
+            assert(numpy.allclose(t1, t2, rtol = 1.0e-10))
+
+def test_lbfgs_2():
+    """
+    Test the calcostgrad gradient against finite differences, for even and odd tiles.
+    """
+    alpha = 0.3
+    for im_size in [10, 11]:
+        otfmask = numpy.random.uniform(low = 0.0, high = 1.0, size = (im_size, im_size))
+        gamma = numpy.random.uniform(low = 2.0, high = 4.0, size = (im_size, im_size))
+        image = numpy.random.uniform(low = 0.01, high = 10.0, size = (im_size, im_size))
+        u = numpy.random.uniform(low = 0.01, high = 10.0, size = im_size*im_size)
+
+        grad = ncs.calcostgrad(u, image, gamma, otfmask, alpha)[1]
+        fd_grad = scipy.optimize.approx_fprime(u, lambda x : ncs.calcost(x, image, gamma, 1.0, otfmask, alpha), 1.0e-6)
+
+        assert(numpy.allclose(grad, fd_grad, atol = 1.0e-4))
+
+def test_lbfgs_3():
+    """
+    Test that batchlbfgs reaches the cost of scipy's L-BFGS-B.
+    """
+    alpha = 0.2
+    for r_size in [8, 9]:
+        [data, gamma, weights] = simTiles(r_size)
+        n = data.shape[0]
+        x0 = data.reshape(n, -1)
+
+        [x, stats] = ncs.batchlbfgs(batchFun(data, gamma, weights, alpha), x0, 0.0, 200)
+
+        for i in range(n):
+            bounds = scipy.optimize.Bounds(numpy.zeros(x0.shape[1]), numpy.full(x0.shape[1], numpy.inf))
+            ref = scipy.optimize.minimize(ncs.calcostgrad, numpy.maximum(x0[i], 0.0),
+                                          args = (data[i], gamma[i], weights, alpha),
+                                          jac = True,
+                                          bounds = bounds,
+                                          method = "L-BFGS-B",
+                                          options = {"maxiter" : 200})
+
+            assert(stats["status"][i] == 0)
+            assert(numpy.allclose(stats["cost"][i], ncs.calcostgrad(x[i], data[i], gamma[i], weights, alpha)[0]))
+            assert(stats["cost"][i] <= ref.fun + 1.0e-6*abs(ref.fun))
+            assert(numpy.all(x[i] >= 0.0))
+
+def test_lbfgs_4():
+    """
+    Test the batchlbfgs status codes and statistics.
+    """
+    alpha = 0.2
+    [data, gamma, weights] = simTiles(8)
+    n = data.shape[0]
+    x0 = data.reshape(n, -1)
+    fun = batchFun(data, gamma, weights, alpha)
+
+    # Reached maxiter.
+    [x, stats] = ncs.batchlbfgs(fun, x0, 0.0, 2)
+    assert(numpy.all(stats["status"] == 1))
+    assert(numpy.all(stats["nit"] == 2))
+
+    # Converged, the projected gradient is below gtol.
+    [x, stats] = ncs.batchlbfgs(fun, x0, 0.0, 200, gtol = 1.0e-3, ftol = 0.0)
+    [cost, grad] = fun(x, numpy.arange(n))
+    pg = numpy.where((x <= 0.0)&(grad > 0.0), 0.0, grad)
+    assert(numpy.all(stats["status"] == 0))
+    assert(numpy.all(stats["nit"] < 200))
+    assert(numpy.allclose(stats["gnorm"], numpy.abs(pg).max(axis = 1)))
+    assert(numpy.all(stats["gnorm"] <= 1.0e-3))
+
+    # Already converged at the start.
+    [x1, stats] = ncs.batchlbfgs(fun, x, 0.0, 200, gtol = 1.0e-3)
+    assert(numpy.array_equal(x, x1))
+    assert(numpy.all(stats["status"] == 0))
+    assert(numpy.all(stats["nit"] == 0))
+
+    # Line search failure, the gradient points the wrong way for the odd tiles.
+    def badFun(x, ind):
+        [cost, grad] = fun(x, ind)
+        grad[ind%2 == 1] *= -1.0
+        return [cost, grad]
+
+    [x, stats] = ncs.batchlbfgs(badFun, x0, 0.0, 20)
+    assert(numpy.all(stats["status"][1::2] == 2))
+    assert(numpy.all(stats["status"][0::2] != 2))
+
+
+if (__name__ == "__main__"):
+    test_lbfgs_1()
+    test_lbfgs_2()
+    test_lbfgs_3()
+    test_lbfgs_4()
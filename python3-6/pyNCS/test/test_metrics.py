@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""
+Test the stage timing metrics.
+"""
+import numpy
+
+import pyNCS.denoisetools as ncs
+import pyNCS.test.py_ref as pyRef
+
+
+R = 32
+Rs = 8
+args = (R, 0.1, 1.4, 0.7, 0.2, 10)
+
+def test_metrics_1():
+    """
+    Test that the metrics count the tiles and iterations of reducenoise.
+    """
+    [imsd, varmap, gainmap] = pyRef.simStack(n_frames = 2)
+    N = imsd.shape[0]
+    Ns = R//Rs
+    for kwds in [{"solver" : "scipy"}, {"solver" : "batch"}, {"schedule" : "frames"}]:
+        metrics = ncs.Metrics()
+        [out, stats] = ncs.reducenoise(Rs, imsd, varmap, gainmap, *args, workers = 2, returnstats = True, metrics = metrics, **kwds)
+        summary = metrics.summary()
+
+        for stage in ncs.Metrics.stages:
+            assert(stage in summary)
+        for stage in ["calibration", "tiling", "solve", "stitching"]:
+            assert(summary[stage] > 0.0)
+        assert(summary["tiles"] == N*Ns*Ns)
+        assert(summary["iterations"] == int(stats["nit"].sum()))
+        assert(numpy.isclose(summary["tiles/s"], summary["tiles"]/summary["solve"]))
+        assert(numpy.isclose(summary["iterations/tile"], summary["iterations"]/summary["tiles"]))
+
+        # Metrics add up over calls until reset.
+        ncs.reducenoise(Rs, imsd, varmap, gainmap, *args, workers = 2, metrics = metrics, **kwds)
+        assert(metrics.summary()["tiles"] == 2*N*Ns*Ns)
+        metrics.reset()
+        assert(metrics.summary()["tiles"] == 0)
+
+def test_metrics_2():
+    """
+    Test that a callable is called with each stage and its time.
+    """
+    [imsd, varmap, gainmap] = pyRef.simStack(n_frames = 2)
+    calls = []
+    def callback(stage, seconds):
+        calls.append((stage, seconds))
+
+    ncs.reducenoise(Rs, imsd, varmap, gainmap, *args, solver = "batch", metrics = callback)
+    stages = set(stage for [stage, seconds] in calls)
+    assert(stages == set(["calibration", "tiling", "solve", "stitching"]))
+    assert(all(isinstance(seconds, float) and (seconds >= 0.0) for [stage, seconds] in calls))
+    assert(len([stage for [stage, seconds] in calls if stage == "solve"]) == imsd.shape[0])
+
+def test_metrics_3():
+    """
+    Test that no metrics gives the same results.
+    """
+    [imsd, varmap, gainmap] = pyRef.simStack(n_frames = 1)
+    ncs1 = ncs.reducenoise(Rs, imsd, varmap, gainmap, *args, solver = "batch")
+    ncs2 = ncs.reducenoise(Rs, imsd, varmap, gainmap, *args, solver = "batch", metrics = ncs.Metrics())
+    assert(numpy.array_equal(ncs1, ncs2))
+    with ncs.stagetimer(None, "solve"):
+        pass
+
+
+if (__name__ == "__main__"):
+    test_metrics_1()
+    test_metrics_2()
+    test_metrics_3()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""
+Test the OpticsCache.
+"""
+import numpy
+import os
+import pytest
+import tempfile
+
+import pyNCS.denoisetools as ncs
+
+
+def countCalls(fn):
+    """
+    Returns fn wrapped to count its calls, and the list the count is in.
+    """
+    calls = [0]
+    def countedFn():
+        calls[0] += 1
+        return fn()
+    return [countedFn, calls]
+
+def test_optics_1():
+    """
+    Test the LRU eviction and that the arrays are read-only.
+    """
+    cache = ncs.OpticsCache(maxsize = 2)
+    [fn, calls] = countCalls(lambda : numpy.ones((4, 4)))
+    a = cache.get(("a",), fn)
+    cache.get(("b",), fn)
+    assert(calls[0] == 2)
+
+    # Using "a" makes "b" the least recently used, so "c" evicts it.
+    assert(cache.get(("a",), fn) is a)
+    cache.get(("c",), fn)
+    assert(calls[0] == 3)
+    assert(list(cache.entries) == [("a",), ("c",)])
+    cache.get(("a",), fn)
+    assert(calls[0] == 3)
+    cache.get(("b",), fn)
+    assert(calls[0] == 4)
+
+    assert(not a.flags.writeable)
+    with pytest.raises(ValueError):
+        a[0,0] = 2.0
+
+    k = cache.kspace(8, 0.1)
+    assert(numpy.array_equal(k, ncs.genkspace(8, 0.1)))
+    assert(not k.flags.writeable)
+
+def test_optics_2():
+    """
+    Test that numpy scalars in the key give the same entry as Python numbers.
+    """
+    cache = ncs.OpticsCache()
+    [fn, calls] = countCalls(lambda : numpy.ones(3))
+    cache.get(("filter", 8, 0.1, 1.4), fn)
+    cache.get(("filter", numpy.int64(8), numpy.float64(0.1), 1.4), fn)
+    cache.get(("filter", (numpy.int32(8), 8), 0.1), fn)
+    cache.get(("filter", (8, 8), numpy.float64(0.1)), fn)
+    assert(calls[0] == 2)
+    assert(cache.cachekey(("filter", (numpy.int32(8), 8), numpy.float64(0.1))) == ("filter", (8, 8), 0.1))
+    assert(type(cache.cachekey(numpy.float64(0.1))) is float)
+
+def test_optics_3():
+    """
+    Test saving the entries to cachedir and loading them back.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache = ncs.OpticsCache(cachedir = tmp_dir)
+        f1 = cache.filter(16, 0.1, 1.4, 0.7)
+        assert(os.listdir(tmp_dir) == [os.path.basename(cache.filename(("filter", 16, 0.1, 1.4, 0.7, "OTFweighted", 1, 0.7)))])
+
+        # A new cache, as in a later run, loads the file rather than calling fn.
+        cache = ncs.OpticsCache(cachedir = tmp_dir)
+        [fn, calls] = countCalls(lambda : numpy.zeros((16, 16)))
+        f2 = cache.get(("filter", numpy.int64(16), numpy.float64(0.1), 1.4, 0.7, "OTFweighted", 1, 0.7), fn)
+        assert(calls[0] == 0)
+        assert(numpy.array_equal(f1, f2))
+        assert(not f2.flags.writeable)
+
+        # The temporary files are renamed to the entry's file.
+        cache.kspace(16, 0.1)
+        assert(sorted(os.listdir(tmp_dir)) == sorted(os.path.basename(cache.filename(key)) for key in [("filter", 16, 0.1, 1.4, 0.7, "OTFweighted", 1, 0.7), ("kspace", 16, 0.1)]))
+
+
+if (__name__ == "__main__"):
+    test_optics_1()
+    test_optics_2()
+    test_optics_3()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""
+Test the localization histograms against numpy.histogram2d.
+"""
+import numpy
+import os
+import tempfile
+
+import pyNCS.denoisetools as ncs
+
+
+def simPoints(xsz, ysz, n_points, seed = 1):
+    """
+    Localizations in the histogram and out of it on every side.
+    """
+    rng = numpy.random.default_rng(seed)
+    x = rng.uniform(low = -0.2*xsz, high = 1.2*xsz, size = n_points)
+    y = rng.uniform(low = -0.2*ysz, high = 1.2*ysz, size = n_points)
+    x[:4] = [-0.5, xsz + 0.5, 1.0, 1.0]
+    y[:4] = [1.0, 1.0, -1.0e-6, ysz + 3.0]
+    return [x, y]
+
+def refHist(xsz, ysz, x, y):
+    """
+    numpy.histogram2d with pixel bins. histogram2d counts x == xsz in the
+    last bin while SRhist drops it, so points exactly on the far edges are
+    removed first.
+    """
+    mask = (x < xsz) & (y < ysz)
+    return numpy.histogram2d(x[mask], y[mask], bins = [xsz, ysz], range = [[0, xsz], [0, ysz]])[0]
+
+def test_srhist_1():
+    """
+    Test SRhist against numpy.histogram2d, with points outside the histogram.
+    """
+    for [xsz, ysz] in [[16, 16], [20, 12], [7, 31]]:
+        [x, y] = simPoints(xsz, ysz, 5000)
+        ref = refHist(xsz, ysz, x, y)
+        histim = ncs.SRhist(xsz, ysz, x, y)
+        assert(histim.shape == (xsz, ysz))
+        assert(numpy.array_equal(histim, ref))
+        assert(histim.sum() < x.size)
+
+        # Points on the far edges are not in the histogram.
+        assert(not ncs.SRhist(xsz, ysz, numpy.array([xsz, 0.0]), numpy.array([0.0, ysz])).any())
+
+    # More points than SRhist reads at a time.
+    [x, y] = simPoints(64, 48, 2500000)
+    assert(numpy.array_equal(ncs.SRhist(64, 48, x, y), refHist(64, 48, x, y)))
+
+def test_srhist_2():
+    """
+    Test adding counts to histim, SRhistchunks and memmapped points.
+    """
+    [xsz, ysz] = [20, 12]
+    [x, y] = simPoints(xsz, ysz, 3000)
+    ref = refHist(xsz, ysz, x, y)
+
+    histim = numpy.ones((xsz, ysz))
+    assert(ncs.SRhist(xsz, ysz, x, y, histim) is histim)
+    assert(numpy.array_equal(histim, ref + 1.0))
+
+    chunks = [(x[i:i+700], y[i:i+700]) for i in range(0, x.size, 700)]
+    assert(numpy.array_equal(ncs.SRhistchunks(xsz, ysz, chunks), ref))
+    assert(numpy.array_equal(ncs.SRhistchunks(xsz, ysz, iter(chunks)), ref))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fname = os.path.join(tmp_dir, "x.npy")
+        numpy.save(fname, x)
+        xm = numpy.load(fname, mmap_mode = "r")
+        assert(numpy.array_equal(ncs.SRhist(xsz, ysz, xm, y), ref))
+        del xm
+
+
+if (__name__ == "__main__"):
+    test_srhist_1()
+    test_srhist_2()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""
+Test reducenoisestream against reducenoise.
+"""
+import numpy
+
+import pyNCS.denoisetools as ncs
+import pyNCS.test.py_ref as py_ref
+
+
+R = 32
+Rs = 8
+optics = (0.1, 1.4, 0.7)
+alpha = 0.2
+iterationN = 10
+
+class CountedFrames(object):
+    """
+    A generator of frames that counts how many have been read.
+    """
+    def __init__(self, frames):
+        self.frames = frames
+        self.n_read = 0
+
+    def __iter__(self):
+        for frame in self.frames:
+            self.n_read += 1
+            yield frame
+
+def test_stream_1():
+    """
+    Test that reducenoisestream gives the frames of reducenoise, with both solvers.
+    """
+    [imsd, varmap, gainmap] = py_ref.simStack(n_frames = 5)
+    for [solver, schedule] in [["scipy", "tiles"], ["scipy", "frames"], ["batch", "tiles"]]:
+        ref = ncs.reducenoise(Rs, imsd, varmap, gainmap, R, *optics, alpha, iterationN, solver = solver, workers = 2, schedule = schedule)
+        for frames in [imsd, list(imsd), (frame for frame in imsd)]:
+            out = numpy.array(list(ncs.reducenoisestream(Rs, frames, varmap, gainmap, R, *optics, alpha, iterationN, solver = solver, workers = 2)))
+            assert(numpy.array_equal(out, ref))
+
+    # A gain and variance map per frame.
+    gainmaps = gainmap*numpy.linspace(0.9, 1.1, imsd.shape[0])[:,None,None]
+    ref = ncs.reducenoise(Rs, imsd, varmap, gainmaps, R, *optics, alpha, iterationN, workers = 2)
+    out = numpy.array(list(ncs.reducenoisestream(Rs, iter(imsd), varmap, gainmaps, R, *optics, alpha, iterationN, workers = 2)))
+    assert(numpy.array_equal(out, ref))
+
+def test_stream_2():
+    """
+    Test that no more than window frames are read ahead of the caller.
+    """
+    [imsd, varmap, gainmap] = py_ref.simStack(n_frames = 6)
+    for window in [1, 2, 4]:
+        frames = CountedFrames(imsd)
+        stream = ncs.reducenoisestream(Rs, frames, varmap, gainmap, R, *optics, alpha, iterationN, workers = 2, window = window)
+        assert(frames.n_read == 0)
+        for [i, frame] in enumerate(stream):
+            assert(frames.n_read == min(i + window, imsd.shape[0]))
+        assert(i == imsd.shape[0] - 1)
+
+    # Stopping early reads no more frames.
+    frames = CountedFrames(imsd)
+    stream = ncs.reducenoisestream(Rs, frames, varmap, gainmap, R, *optics, alpha, iterationN, workers = 2, window = 2)
+    next(stream)
+    stream.close()
+    assert(frames.n_read == 2)
+
+
+if (__name__ == "__main__"):
+    test_stream_1()
+    test_stream_2()
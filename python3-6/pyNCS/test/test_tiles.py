@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""
+Test tiling and stitching frames against the loop versions in py_ref.
+"""
+import numpy
+
+import pyNCS.denoisetools as ncs
+import pyNCS.test.py_ref as py_ref
+
+
+sizes = [[16, 8], [16, 4], [32, 16], [24, 6], [15, 4], [17, 8], [20, 6], [9, 4]]
+
+def padTiles(img, Rs):
+    """
+    The tiles of img sliced one at a time from the edge padded frame, in
+    segpadimg order. The loop versions in py_ref only handle frames that
+    are a multiple of Rs, this also covers those that are not.
+    """
+    Ns = img.shape[0]//Rs
+    imgpad = numpy.pad(img, 1, "edge")
+    tiles = []
+    for ii in range(Ns):
+        for jj in range(Ns):
+            tiles.append(imgpad[jj*Rs:(jj+1)*Rs+2, ii*Rs:(ii+1)*Rs+2])
+    return numpy.array(tiles)
+
+def test_tiles_1():
+    """
+    Test tileview and segpadimg, including frames that are not a multiple of the tile size.
+    """
+    rng = numpy.random.default_rng(1)
+    for [R, Rs] in sizes:
+        img = rng.uniform(size = (R, R))
+        ref = padTiles(img, Rs)
+        if (R%Rs == 0):
+            assert(numpy.array_equal(ref, py_ref.segpadimg(img, Rs)))
+        Ns = R//Rs
+
+        tiles = ncs.tileview(img, Rs)
+        assert(tiles.shape == (Ns, Ns, Rs+2, Rs+2))
+        assert(not tiles.flags.writeable)
+        assert(numpy.array_equal(tiles.reshape(ref.shape), ref))
+
+        assert(numpy.array_equal(ncs.segpadimg(img, Rs), ref))
+        assert(ncs.segpadimg(img, Rs, dtype = numpy.float32).dtype == numpy.float32)
+
+        # Into a slice of a larger buffer.
+        buf = numpy.zeros((Ns*Ns + 3, Rs+2, Rs+2))
+        out = ncs.segpadimg(img, Rs, out = buf[2:2+Ns*Ns])
+        assert(numpy.shares_memory(out, buf))
+        assert(numpy.array_equal(buf[2:2+Ns*Ns], ref))
+        assert(not buf[:2].any() and not buf[2+Ns*Ns:].any())
+
+def test_tiles_2():
+    """
+    Test stitchpadimg, and that stitching the tiles gives the frame back.
+    """
+    rng = numpy.random.default_rng(2)
+    for [R, Rs] in sizes:
+        img = rng.uniform(size = (R, R))
+        Ns = R//Rs
+        tiles = ncs.segpadimg(img, Rs)
+
+        stitched = ncs.stitchpadimg(tiles)
+        assert(numpy.array_equal(stitched, py_ref.stitchpadimg(tiles)))
+        assert(numpy.array_equal(stitched, img[:Ns*Rs,:Ns*Rs]))
+
+        out = numpy.empty((Ns*Rs, Ns*Rs))
+        assert(ncs.stitchpadimg(tiles, out = out) is out)
+        assert(numpy.array_equal(out, stitched))
+
+        # Tiles that are not edge padded images, as reducenoise returns.
+        tiles = rng.uniform(size = tiles.shape)
+        assert(numpy.array_equal(ncs.stitchpadimg(tiles), py_ref.stitchpadimg(tiles)))
+
+def test_tiles_3():
+    """
+    Test segimg and binimage.
+    """
+    rng = numpy.random.default_rng(3)
+    for [R, Rs] in [[16, 8], [16, 4], [18, 3]]:
+        img = rng.uniform(size = (R, R))
+        assert(numpy.array_equal(ncs.segimg(img, Rs), py_ref.segimg(img, Rs)))
+        assert(numpy.allclose(ncs.binimage(img, Rs), img.reshape(R//Rs, Rs, R//Rs, Rs).sum(axis = (1, 3)).T))
+
+
+if (__name__ == "__main__"):
+    test_tiles_1()
+    test_tiles_2()
+    test_tiles_3()